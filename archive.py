@@ -0,0 +1,217 @@
+"""Memory-mapped archive of slope runs.
+
+An archive is a directory of columnar .npy files holding every frame of every
+run, stored contiguously per run and sorted by time within each run:
+
+    timestamps.npy  (n_frames,)             Unix time of each frame
+    coords.npy      (n_frames, 2*n_spots)   spot positions [x1, y1, ..., xn, yn]
+    zernikes.npy    (n_frames, n_modes)     reconstructed coefficients
+    rc.npy          (n_frames,)             return codes
+    runs.json       per-run metadata: name, source file, row range, TSTART/TSTOP
+
+The arrays are opened with mmap_mode='r', so queries return views into the
+page cache and nothing is parsed again once the archive is built.
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from astropy.io import fits
+from config import *
+from batchrecon import reconstruct_log, run_name
+from slopes2fits import expand_inputs, format_stamp
+from spots2zern import ZernikeReconstructor, reconstruct_batch
+
+COLUMNS = ("timestamps", "coords", "zernikes", "rc")
+
+Frames = collections.namedtuple("Frames", COLUMNS)
+
+def read_run(fname, recon, chunk_size=65536):
+    """Reads one run from a felixdata log, a FITS file written by slopes2fits.py
+    or a segment written by framelog.py. Zernikes are reconstructed unless the
+    file already holds them.
+
+    Returns
+    -------
+    frames: Frames
+        The run sorted by time.
+    header: dict
+        TSTART and TSTOP from the FITS header, if present.
+    """
+    header = {}
+    if not fname.endswith(".fits"):
+        timestamps, coords, rc, a_z = reconstruct_log(recon, fname, chunk_size)
+    else:
+        with fits.open(fname) as hdul:
+            header = {key: hdul[0].header[key] for key in ("TSTART", "TSTOP")
+                      if key in hdul[0].header}
+            if "FRAMES" in hdul:
+                data = hdul["FRAMES"].data
+                timestamps, coords = data["TIME"], data["COORDS"]
+                rc, a_z = data["RC"], data["ZERNIKES"]
+            else:
+                coords, timestamps = hdul[0].data, hdul[1].data
+                rc, a_z = reconstruct_batch(recon, coords)
+            timestamps, coords, rc, a_z = (np.array(x) for x in (timestamps, coords, rc, a_z))
+
+    order = np.argsort(timestamps, kind="stable")
+    frames = Frames(timestamps[order].astype(float), coords[order].astype(float),
+                    a_z[order].astype(float), rc[order].astype(np.int16))
+    return frames, header
+
+def _write_npy(fname, raw, dtype, shape):
+    """Writes a .npy file from the raw bytes spooled in the file object raw.
+    """
+    with open(fname, "wb") as f:
+        np.lib.format.write_array_header_1_0(f, {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": shape,
+        })
+        raw.seek(0)
+        shutil.copyfileobj(raw, f)
+
+def build_archive(path, fnames, recon=None):
+    """Builds an archive from the given runs, one run in memory at a time.
+
+    Parameters
+    ----------
+    path: str
+        Archive directory, created if needed. Existing files are replaced.
+    fnames: list of str
+        Felixdata logs, slopes2fits FITS files or framelog segments.
+    recon: ZernikeReconstructor, optional
+        Reconstructor for runs without Zernikes.
+    """
+    if recon is None:
+        recon = ZernikeReconstructor()
+    os.makedirs(path, exist_ok=True)
+
+    spools = {col: tempfile.TemporaryFile() for col in COLUMNS}
+    meta = []
+    n_rows = 0
+    try:
+        for fname in fnames:
+            frames, header = read_run(fname, recon)
+            if not len(frames.timestamps):
+                print(f"Skipped {fname}: no frames")
+                continue
+            if meta:
+                # Every run shares the columns, so their widths must match
+                first = meta[0]
+                for key, n in (("n_coords", frames.coords.shape[1]),
+                               ("n_modes", frames.zernikes.shape[1])):
+                    if n != first[key]:
+                        raise ValueError(f"{fname}: run {run_name(fname)} has {key}={n}, but "
+                                         f"run {first['name']} has {key}={first[key]}")
+            for col in COLUMNS:
+                getattr(frames, col).tofile(spools[col])
+            n = len(frames.timestamps)
+            name = run_name(fname)
+            names = {run["name"] for run in meta}
+            if name in names:
+                name = next(f"{name}_{k}" for k in range(2, len(meta) + 2)
+                            if f"{name}_{k}" not in names)
+            meta.append({
+                "name": name,
+                "source": os.path.abspath(fname),
+                "start": n_rows,
+                "stop": n_rows + n,
+                "tstart": float(frames.timestamps[0]),
+                "tstop": float(frames.timestamps[-1]),
+                "TSTART": header.get("TSTART", format_stamp(frames.timestamps[0])),
+                "TSTOP": header.get("TSTOP", format_stamp(frames.timestamps[-1])),
+                "n_coords": frames.coords.shape[1],
+                "n_modes": frames.zernikes.shape[1],
+            })
+            n_rows += n
+
+        n_coords = meta[0]["n_coords"] if meta else 2 * recon.n_spots
+        n_modes = meta[0]["n_modes"] if meta else recon.n_modes
+        shapes = {"timestamps": (n_rows,), "coords": (n_rows, n_coords),
+                  "zernikes": (n_rows, n_modes), "rc": (n_rows,)}
+        dtypes = {"timestamps": float, "coords": float, "zernikes": float, "rc": np.int16}
+        for col in COLUMNS:
+            _write_npy(os.path.join(path, col + ".npy"), spools[col], dtypes[col], shapes[col])
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+    # Runs are listed by start time, which SlopeArchive.query relies on
+    meta.sort(key=lambda run: run["tstart"])
+    with open(os.path.join(path, "runs.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+    print(f"Archived {n_rows} frames from {len(meta)} runs to {path}")
+
+class SlopeArchive:
+    """Read-only view of an archive built by build_archive.
+    """
+
+    def __init__(self, path):
+        """Opens the archive. The arrays are memory-mapped, not read.
+        """
+        self.path = path
+        with open(os.path.join(path, "runs.json")) as f:
+            self.runs = json.load(f)
+        self._columns = Frames(*(np.load(os.path.join(path, col + ".npy"), mmap_mode="r")
+                                 for col in COLUMNS))
+        self._by_name = {run["name"]: run for run in self.runs}
+        self._tstart = np.array([run["tstart"] for run in self.runs])
+
+    @property
+    def run_names(self):
+        return [run["name"] for run in self.runs]
+
+    def _slice(self, start, stop):
+        return Frames(*(col[start:stop] for col in self._columns))
+
+    def run(self, name):
+        """Returns every frame of a run as views.
+        """
+        run = self._by_name[name]
+        return self._slice(run["start"], run["stop"])
+
+    def query(self, t0=None, t1=None, runs=None):
+        """Returns the frames with t0 <= timestamp < t1 as views, per run.
+
+        Parameters
+        ----------
+        t0, t1: float, optional
+            Unix time window. Open-ended if not given.
+        runs: list of str, optional
+            Only search these runs.
+
+        Returns
+        -------
+        out: dict
+            Run name to Frames of views, for every run with frames in the window.
+        """
+        t0 = -np.inf if t0 is None else t0
+        t1 = np.inf if t1 is None else t1
+        # Runs are sorted by start time, so only runs starting before t1 can match
+        candidates = self.runs[:np.searchsorted(self._tstart, t1, side="left")]
+        out = {}
+        for run in candidates:
+            if run["tstop"] < t0 or (runs is not None and run["name"] not in runs):
+                continue
+            ts = self._columns.timestamps[run["start"]:run["stop"]]
+            lo = run["start"] + np.searchsorted(ts, t0, side="left")
+            hi = run["start"] + np.searchsorted(ts, t1, side="left")
+            if hi > lo:
+                out[run["name"]] = self._slice(lo, hi)
+        return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a memory-mapped archive of slope runs")
+    parser.add_argument("fn_in", type=str, nargs='*', default=["slope_logs/felixdata_*.log"],
+                        help="Logs, slopes2fits FITS files or framelog segments "
+                             "(default: slope_logs/felixdata_*.log)")
+    parser.add_argument("-o", "--output", type=str, default="slope_archive", help="Archive directory")
+    parser.add_argument("--imat", type=str, default=None, help="Override IMAT_FNAME")
+    args = parser.parse_args()
+
+    build_archive(args.output, expand_inputs(args.fn_in), ZernikeReconstructor(args.imat))
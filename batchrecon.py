@@ -0,0 +1,162 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from config import *
+from protocol import FELIXDATA_TAG, iter_felixdata_chunks
+from slopes2fits import expand_inputs, format_stamp
+from screening import make_screen
+from spots2zern import ZernikeReconstructor, reconstruct_batch
+
+# Reconstructor and screening thresholds of the current worker process, see
+# _init_worker
+_recon = None
+_screen_args = (None, None)
+
+def _init_worker(imat_fname, screen_args=(None, None)):
+    """Builds the reconstructor of a worker process. The s2z matrix is
+    memory-mapped from the cache, so all workers share one copy.
+    """
+    global _recon, _screen_args
+    _recon = ZernikeReconstructor(imat_fname)
+    _screen_args = screen_args
+
+def run_name(fname):
+    """Returns the run name of a log, e.g. "spicadonut-3" for
+    slope_logs/felixdata_spicadonut-3.log.
+    """
+    stem = os.path.splitext(os.path.basename(fname))[0]
+    prefix = FELIXDATA_TAG + "_"
+    return stem[len(prefix):] if stem.startswith(prefix) else stem
+
+def reconstruct_log(recon, fn_in, chunk_size=65536, screen=None):
+    """Reconstructs the Zernike time series of a felixdata log, screening the
+    frames with screen if given.
+
+    Returns
+    -------
+    timestamps: nd_array of shape (n_frames)
+    coords: nd_array of shape (n_frames, 2*n_spots)
+    rc: nd_array of shape (n_frames)
+        Return code of each frame, see spots2zern.print_return_code.
+    a_z: nd_array of shape (n_frames, n_modes)
+    """
+    chunks = [(ts, coords) + reconstruct_batch(recon, coords, screen)
+              for ts, coords in iter_felixdata_chunks(fn_in, chunk_size)]
+    if not chunks:
+        return (np.zeros(0), np.zeros((0, 2*recon.n_spots)), np.zeros(0, dtype=int),
+                np.zeros((0, recon.n_modes)))
+    return tuple(np.concatenate(arrs) for arrs in zip(*chunks))
+
+def write_run(fn_out, timestamps, coords, rc, a_z):
+    """Writes a reconstructed run to an NPZ or FITS file depending on the
+    extension of fn_out. The file is written under a temporary name and
+    renamed once complete, so a failed run never leaves a truncated file.
+    """
+    if not len(timestamps):
+        raise ValueError(f"{fn_out}: no frames to write")
+    tmp = f"{fn_out}.{os.getpid()}.tmp"
+    try:
+        _write_run(tmp, fn_out.endswith(".npz"), timestamps, coords, rc, a_z)
+        os.replace(tmp, fn_out)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def _write_run(fn_out, npz, timestamps, coords, rc, a_z):
+    """Writes the file of write_run to fn_out.
+    """
+    if npz:
+        with open(fn_out, "wb") as f:
+            np.savez(f, timestamps=timestamps, coords=coords, rc=rc, zernikes=a_z)
+        return
+
+    hdu1 = fits.PrimaryHDU(a_z)
+    hdu1.header['TSTART'] = (format_stamp(timestamps[0]), 'Start time of the data')
+    hdu1.header['TSTOP'] = (format_stamp(timestamps[-1]), 'End time of the data')
+    hdu_list = fits.HDUList([hdu1,
+                             fits.ImageHDU(timestamps, name="TIMESTAMPS"),
+                             fits.ImageHDU(coords, name="COORDS"),
+                             fits.ImageHDU(rc.astype(np.int16), name="RC")])
+    hdu_list.writeto(fn_out, overwrite=True, output_verify="exception")
+
+def process_log(fn_in, outdir, fmt="npz", chunk_size=65536):
+    """Reconstructs one log in a worker process and writes it to outdir.
+
+    Returns
+    -------
+    out: dict
+        Summary row of the run.
+    """
+    screen = make_screen(_recon, *_screen_args)
+    timestamps, coords, rc, a_z = reconstruct_log(_recon, fn_in, chunk_size, screen)
+    name = run_name(fn_in)
+    if len(timestamps):
+        write_run(os.path.join(outdir, f"{name}.{fmt}"), timestamps, coords, rc, a_z)
+
+    good = a_z[rc == 0]
+    return {
+        "run": name,
+        "n_frames": len(timestamps),
+        "n_bad": int(np.count_nonzero(rc)),
+        "tstart": format_stamp(timestamps[0]) if len(timestamps) else "",
+        "tstop": format_stamp(timestamps[-1]) if len(timestamps) else "",
+        "zmean": good.mean(axis=0) if len(good) else np.full(a_z.shape[1], np.nan),
+        "zstd": good.std(axis=0) if len(good) else np.full(a_z.shape[1], np.nan),
+    }
+
+def main(fnames, outdir, fmt="npz", n_workers=None, imat_fname=None, chunk_size=65536,
+         max_residual=None, max_jump=None):
+    """Reconstructs every log in fnames across a process pool and writes one
+    file per run plus outdir/summary.ecsv. Frames are screened for outliers if
+    max_residual or max_jump is given, see screening.FrameScreen.
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    # Build the s2z cache once before starting the workers
+    ZernikeReconstructor(imat_fname)
+
+    t0 = time.perf_counter()
+    rows = []
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker,
+                             initargs=(imat_fname, (max_residual, max_jump))) as pool:
+        futures = {pool.submit(process_log, fn, outdir, fmt, chunk_size): fn for fn in fnames}
+        for future in as_completed(futures):
+            try:
+                rows.append(future.result())
+            except (OSError, ValueError) as e:
+                print(f"Skipped {futures[future]}: {e}")
+
+    if not rows:
+        print("No runs were reconstructed")
+        return
+    rows.sort(key=lambda row: row["tstart"])
+    summary = Table(rows=rows, names=list(rows[0]))
+    summary.write(os.path.join(outdir, "summary.ecsv"), overwrite=True)
+    n_frames = sum(row["n_frames"] for row in rows)
+    print(f"Reconstructed {n_frames} frames from {len(rows)} runs in "
+          f"{time.perf_counter() - t0:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruct Zernike time series from felixdata logs")
+    parser.add_argument("fn_in", type=str, nargs='*', default=["slope_logs/felixdata_*.log"],
+                        help="Input logs or glob patterns (default: slope_logs/felixdata_*.log)")
+    parser.add_argument("-o", "--outdir", type=str, default="zernike_runs", help="Output directory")
+    parser.add_argument("--format", type=str, default="npz", choices=["npz", "fits"],
+                        help="Output format of each run")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--imat", type=str, default=None, help="Override IMAT_FNAME")
+    parser.add_argument("--max-residual", type=float, default=SCREEN_RESIDUAL,
+                        help="Reject frames whose RMS slope residual exceeds this many pixels")
+    parser.add_argument("--max-jump", type=float, default=SCREEN_JUMP,
+                        help="Reject frames whose spots moved more than this many pixels "
+                             "from their recent median position")
+    args = parser.parse_args()
+
+    main(expand_inputs(args.fn_in), args.outdir, args.format, args.workers, args.imat,
+         max_residual=args.max_residual, max_jump=args.max_jump)
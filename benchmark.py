@@ -0,0 +1,327 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from config import *
+import fastcli
+import reconstruction
+from protocol import (REPLY_HEADER, format_felixdata, iter_felixdata_chunks, pack_frame,
+                      unpack_reply_header)
+from server import ReconstructionServer
+from slopes2fits import expand_inputs
+from spots2zern import (ZernikeReconstructor, format_coeffs, format_return_code, reconstruct,
+                        reconstruct_batch, subtract_mean)
+
+def summarize(times_ns, frames_per_call=1):
+    """Returns latency percentiles in microseconds and the throughput of a list
+    of per-call durations in nanoseconds.
+    """
+    t = np.asarray(times_ns, dtype=float) / 1e3
+    return {
+        "n": len(t),
+        "p50_us": float(np.percentile(t, 50)),
+        "p99_us": float(np.percentile(t, 99)),
+        "mean_us": float(t.mean()),
+        "max_us": float(t.max()),
+        "fps": float(frames_per_call * 1e6 / t.mean()),
+    }
+
+def time_calls(func, args_list):
+    """Times func(*args) for every entry of args_list.
+    """
+    times = np.empty(len(args_list), dtype=np.int64)
+    for i, args in enumerate(args_list):
+        t0 = time.perf_counter_ns()
+        func(*args)
+        times[i] = time.perf_counter_ns() - t0
+    return times
+
+def load_frames(patterns):
+    """Loads every recorded frame from the given logs.
+    """
+    chunks = [chunk for fname in expand_inputs(patterns)
+              for chunk in iter_felixdata_chunks(fname)]
+    timestamps = np.concatenate([ts for ts, _ in chunks])
+    coords = np.concatenate([c for _, c in chunks])
+    return timestamps, coords
+
+def bench_in_process(recon, coords, repeat):
+    """Times each stage of the single-frame path and the batched path.
+    """
+    frames = [(c,) for c in np.tile(coords, (repeat, 1))]
+    results = {
+        "subtract_mean": summarize(time_calls(subtract_mean, frames)),
+        "reconstruct": summarize(time_calls(lambda c: reconstruct(recon, c), frames)),
+    }
+    out = np.empty(recon.n_modes, dtype=recon.dtype)
+    frames_typed = [(np.ascontiguousarray(c, dtype=recon.dtype),) for (c,) in frames]
+    results["reconstruct_out"] = summarize(time_calls(
+        lambda c: reconstruct(recon, c, out=out), frames_typed))
+    a_z = [(reconstruct(recon, c)[1],) for (c,) in frames]
+    results["format_reply"] = summarize(time_calls(
+        lambda z: format_return_code(0) + "\n" + format_coeffs(z), a_z))
+
+    batch = np.tile(coords, (repeat, 1))
+    results["reconstruct_batch"] = summarize(
+        time_calls(lambda c: reconstruct_batch(recon, c), [(batch,)] * 20), len(batch))
+    return results
+
+def _start_server(recon):
+    """Starts a ReconstructionServer on an ephemeral loopback port in a
+    background thread. Returns the port.
+    """
+    started = threading.Event()
+    port = []
+
+    def run():
+        async def serve():
+            server = await asyncio.start_server(
+                ReconstructionServer(recon).handle_client, "127.0.0.1", 0)
+            port.append(server.sockets[0].getsockname()[1])
+            started.set()
+            await server.serve_forever()
+        asyncio.run(serve())
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return port[0]
+
+def _recv_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ConnectionError("server closed the connection")
+    return data
+
+def bench_socket(recon, timestamps, coords, repeat):
+    """Times round trips through a loopback server for the text and binary
+    protocols, plus pipelined binary throughput.
+    """
+    port = _start_server(recon)
+    n_lines = 2 + recon.n_modes
+    results = {}
+
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        f = sock.makefile("rb")
+        msgs = [(format_felixdata(ts, c) + "\n").encode()
+                for ts, c in zip(np.tile(timestamps, repeat), np.tile(coords, (repeat, 1)))]
+
+        def text_round_trip(msg):
+            sock.sendall(msg)
+            for _ in range(n_lines):
+                f.readline()
+        results["socket_text"] = summarize(time_calls(text_round_trip, [(m,) for m in msgs]))
+
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        f = sock.makefile("rb")
+        frames = [pack_frame(ts, c) for ts, c in
+                  zip(np.tile(timestamps, repeat), np.tile(coords, (repeat, 1)))]
+
+        def read_reply():
+            _, n_modes, _ = unpack_reply_header(_recv_exactly(f, REPLY_HEADER.size))
+            _recv_exactly(f, 8 * n_modes)
+
+        def binary_round_trip(frame):
+            sock.sendall(frame)
+            read_reply()
+        results["socket_binary"] = summarize(time_calls(binary_round_trip, [(fr,) for fr in frames]))
+
+        def binary_pipelined(frames):
+            sender = threading.Thread(target=sock.sendall, args=(b"".join(frames),))
+            sender.start()
+            for _ in frames:
+                read_reply()
+            sender.join()
+        results["socket_binary_pipelined"] = summarize(
+            time_calls(binary_pipelined, [(frames,)] * 5), len(frames))
+    return results
+
+def bench_cli(coords, repeat):
+    """Times full invocations of spots2zern.py, including interpreter startup:
+    cold starts without the resident helper (cli), and calls answered by a
+    helper on a private socket that is stopped afterwards (cli_helper).
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spots2zern.py")
+    args_list = [([sys.executable, script] + [str(x) for x in c],)
+                 for c in coords[:repeat]]
+
+    def time_runs(env):
+        try:
+            return summarize(time_calls(
+                lambda cmd: subprocess.run(cmd, check=True, capture_output=True, env=env),
+                args_list))
+        except subprocess.CalledProcessError as e:
+            return {"error": e.stderr.decode(errors="replace").strip().splitlines()[-1]}
+
+    env = {k: v for k, v in os.environ.items() if not k.startswith("SPOTS2ZERN_")}
+    results = {"cli": time_runs(dict(env, SPOTS2ZERN_NO_HELPER="1"))}
+
+    sock_dir = tempfile.mkdtemp(prefix="spots2zern-bench-")
+    sock_path = os.path.join(sock_dir, "helper.sock")
+    helper = subprocess.Popen([sys.executable, fastcli.__file__, "--serve", sock_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if _wait_for_helper(sock_path, [str(x) for x in coords[0]]):
+            results["cli_helper"] = time_runs(dict(env, SPOTS2ZERN_SOCKET=sock_path))
+        else:
+            results["cli_helper"] = {"error": "helper did not start"}
+    finally:
+        helper.terminate()
+        helper.wait()
+        shutil.rmtree(sock_dir, ignore_errors=True)
+    return results
+
+def _wait_for_helper(path, args, timeout=30.0):
+    """Waits until the helper on path answers a call.
+    """
+    t_end = time.monotonic() + timeout
+    while time.monotonic() < t_end:
+        if fastcli.forward(args, path) is not None:
+            return True
+        time.sleep(0.05)
+    return False
+
+def bench_generation(sizes):
+    """Times gamma matrix, basis and imat generation in reconstruction.py for
+    each (Npts, Nmodes). Caches are cleared first so every step is computed
+    from scratch.
+    """
+    results = {}
+    for Npts, Nmodes in sizes:
+        points = reconstruction.make_southwell_points(Npts)
+        reconstruction._pupil_bases.clear()
+
+        t0 = time.perf_counter_ns()
+        gammax, gammay = reconstruction._compute_gamma_matrices(Nmodes + 1)
+        t1 = time.perf_counter_ns()
+        basis = reconstruction.PupilBasis(points, Nmodes + 1)
+        t2 = time.perf_counter_ns()
+        basis.derivatives(gammax, gammay)
+        t3 = time.perf_counter_ns()
+
+        results[f"{Npts}x{Npts}_{Nmodes}"] = {
+            "gamma_ms": (t1 - t0) / 1e6,
+            "basis_ms": (t2 - t1) / 1e6,
+            "derivatives_ms": (t3 - t2) / 1e6,
+            "total_ms": (t3 - t0) / 1e6,
+        }
+    return results
+
+def print_results(results):
+    """Prints the latency results as a table.
+    """
+    for group, stages in results.items():
+        if group == "meta":
+            continue
+        print(f"# {group}")
+        for name, stats in stages.items():
+            if "error" in stats:
+                print(f"{name:28s} error: {stats['error']}")
+            elif "p50_us" in stats:
+                print(f"{name:28s} p50 {stats['p50_us']:10.2f} us  p99 {stats['p99_us']:10.2f} us"
+                      f"  {stats['fps']:12.0f} frames/s")
+            else:
+                print(f"{name:28s} " + "  ".join(f"{k} {v:.2f}" for k, v in stats.items()))
+
+# Statistics compared by compare_results, and whether larger is better
+COMPARED_STATS = {"p50_us": False, "p99_us": False, "fps": True, "total_ms": False}
+
+def compare_results(prev, results, threshold=0.2):
+    """Compares two benchmark results, e.g. from before and after a change.
+
+    Parameters
+    ----------
+    prev, results: dict
+        Benchmark results as returned by main or loaded from its JSON output.
+    threshold: float, optional
+        Relative change of a statistic in COMPARED_STATS that counts as a
+        regression.
+
+    Returns
+    -------
+    regressions: list of str
+        One line per statistic that got worse by more than threshold.
+    """
+    regressions = []
+    for group, stages in results.items():
+        if group == "meta" or group not in prev:
+            continue
+        for name, stats in stages.items():
+            old = prev[group].get(name, {})
+            for key, higher_is_better in COMPARED_STATS.items():
+                if key not in stats or not old.get(key):
+                    continue
+                change = stats[key] / old[key] - 1
+                if (-change if higher_is_better else change) > threshold:
+                    regressions.append(f"{group}/{name} {key}: {old[key]:.2f} -> "
+                                       f"{stats[key]:.2f} ({change:+.0%})")
+    return regressions
+
+def main(patterns, fn_out, repeat=10, cli_runs=10, sizes=((12, 36), (32, 66), (64, 120)),
+         imat_fname=None):
+    timestamps, coords = load_frames(patterns)
+    recon = ZernikeReconstructor(imat_fname)
+    results = {
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "n_frames": len(coords),
+            "repeat": repeat,
+        },
+        "in_process": bench_in_process(recon, coords, repeat),
+        "socket": bench_socket(recon, timestamps, coords, repeat),
+        "generation": bench_generation(sizes),
+    }
+    if cli_runs:
+        results["cli"] = bench_cli(coords, cli_runs)
+
+    print_results(results)
+    with open(fn_out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to: {fn_out}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmark of the reconstruction path")
+    parser.add_argument("fn_in", type=str, nargs='*', default=["slope_logs/felixdata_*.log"],
+                        help="Logs to replay (default: slope_logs/felixdata_*.log)")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="Output JSON file")
+    parser.add_argument("--repeat", type=int, default=10, help="Times to replay the frames")
+    parser.add_argument("--cli-runs", type=int, default=10,
+                        help="Number of spots2zern.py invocations to time (0 to skip)")
+    parser.add_argument("--sizes", type=str, nargs='*', default=["12x36", "32x66", "64x120"],
+                        help="Npts x Nmodes sizes for the generation benchmark")
+    parser.add_argument("--imat", type=str, default=None, help="Override IMAT_FNAME")
+    parser.add_argument("--compare", type=str, default=None, metavar="PREV.json",
+                        help="Compare with an earlier run and exit with status 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative change of p50/p99/fps that counts as a regression")
+    args = parser.parse_args()
+
+    prev = None
+    if args.compare:
+        with open(args.compare) as f:
+            prev = json.load(f)
+    sizes = [tuple(int(x) for x in size.split("x")) for size in args.sizes]
+    results = main(args.fn_in, args.output, args.repeat, args.cli_runs, sizes, args.imat)
+
+    if prev is not None:
+        regressions = compare_results(prev, results, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        print(f"{len(regressions)} regressions against {args.compare} "
+              f"(threshold {args.threshold:.0%})")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,235 @@
+import argparse
+import threading
+import numpy as np
+from config import *
+from s2zcache import compute_s2z
+from spots2zern import subtract_mean
+
+class RunningReference:
+    """Running mean and variance of reference spot positions, updated with
+    Welford's algorithm so no history is stored.
+    """
+
+    def __init__(self, n_coords):
+        """Initializes an empty reference.
+
+        Parameters
+        ----------
+        n_coords: int
+            Number of coordinates per frame, 2*N_SPOTS.
+        """
+        self.n = 0
+        self.mean = np.zeros(n_coords)
+        self._m2 = np.zeros(n_coords)
+
+    def update(self, coords):
+        """Adds one frame formatted as [x1, y1, ..., xn, yn].
+        """
+        self.n += 1
+        delta = coords - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (coords - self.mean)
+
+    def update_batch(self, coords):
+        """Adds a stack of frames, combining their statistics with Chan's
+        parallel update.
+        """
+        coords = np.atleast_2d(coords)
+        n_b = len(coords)
+        if n_b == 0:
+            return
+        mean_b = coords.mean(axis=0)
+        m2_b = ((coords - mean_b)**2).sum(axis=0)
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self._m2 += m2_b + delta**2 * self.n * n_b / n
+        self.n = n
+
+    @property
+    def variance(self):
+        return self._m2 / (self.n - 1) if self.n > 1 else np.full_like(self._m2, np.nan)
+
+    def cal_slopes(self):
+        """Returns the reference in the format of CAL_SLOPES in config.py.
+        """
+        return [round(float(x), 2) for x in self.mean]
+
+class InteractionMatrixRLS:
+    """Recursive least-squares estimate of the Zernike to slopes matrix A from
+    frames with a known Zernike perturbation, e.g. poke or sawtooth runs.
+
+    Each update costs O(n_modes * n_slopes + n_modes**2) and changes A by a
+    rank-one term, so no history is stored. Since the measured slopes have their
+    mean removed (see subtract_mean), the estimate converges to A with the mean
+    x and y slope removed from every column.
+    """
+
+    def __init__(self, A, confidence=1e3, forgetting=1.0):
+        """Initializes the estimate.
+
+        Parameters
+        ----------
+        A: nd_array of shape (2*n_spots, n_modes)
+            Initial estimate, usually the theoretical imat.
+        confidence: float, optional
+            Initial inverse covariance scale. Larger values trust A less.
+        forgetting: float, optional
+            Forgetting factor in (0, 1]. Values below 1 track slow drifts.
+        """
+        self.A = np.array(A, dtype=float)
+        self.P = np.eye(self.A.shape[1]) * confidence
+        self.forgetting = forgetting
+        self.n = 0
+
+    def update(self, a_z, slopes):
+        """Adds one frame.
+
+        Parameters
+        ----------
+        a_z: nd_array of shape (n_modes)
+            Zernike perturbation applied during the frame.
+        slopes: nd_array of shape (2*n_spots)
+            Measured slopes formatted as [x1, ..., xn, y1, ..., yn], with the
+            reference already subtracted.
+        """
+        Pz = np.dot(self.P, a_z)
+        gain = Pz / (self.forgetting + np.dot(a_z, Pz))
+        err = slopes - np.dot(self.A, a_z)
+        self.A += np.outer(err, gain)
+        self.P -= np.outer(gain, Pz)
+        self.P /= self.forgetting
+        self.n += 1
+
+class OnlineCalibrator:
+    """Keeps running calibration statistics for a live ZernikeReconstructor and
+    hot-swaps the updated calibration into it.
+
+    Reference frames update the reference spot positions (CAL_SLOPES) and poke
+    frames update the interaction matrix. Nothing changes in the reconstructor
+    until commit() is called.
+    """
+
+    def __init__(self, recon, confidence=1e3, forgetting=1.0):
+        """Initializes the calibrator from the current state of recon.
+        """
+        self.recon = recon
+        self.reference = RunningReference(2 * recon.n_spots)
+        self.imat = InteractionMatrixRLS(recon.A, confidence, forgetting)
+        self._lock = threading.Lock()
+
+    def add_reference(self, coords):
+        """Adds frames taken with a flat wavefront, formatted as
+        [x1, y1, ..., xn, yn]. coords may be a single frame or a stack.
+        """
+        with self._lock:
+            if np.ndim(coords) == 1:
+                self.reference.update(np.asarray(coords, dtype=float))
+            else:
+                self.reference.update_batch(np.asarray(coords, dtype=float))
+
+    def add_poke(self, a_z, coords):
+        """Adds a frame taken with the known Zernike perturbation a_z. The
+        slopes are measured against the running reference if it has any frames,
+        otherwise against the calibration of the reconstructor.
+        """
+        with self._lock:
+            if self.reference.n:
+                cal = subtract_mean(self.reference.mean)
+            else:
+                _, _, cal = self.recon.calibration
+            self.imat.update(np.asarray(a_z, dtype=float), subtract_mean(coords) - cal)
+
+    def commit(self, reference=True, imat=True):
+        """Swaps the updated calibration into the reconstructor.
+
+        Parameters
+        ----------
+        reference: bool, optional
+            Use the running reference, if it has any frames.
+        imat: bool, optional
+            Use the running interaction matrix, if it has any frames. The slopes
+            to Zernike matrix is recomputed from it with the reconstructor's
+            pseudo-inverse options.
+        """
+        with self._lock:
+            cal = A = s2z = None
+            if reference and self.reference.n:
+                cal = subtract_mean(self.reference.mean)
+            if imat and self.imat.n:
+                A = self.imat.A.copy()
+        # Frames can still be added while s2z is computed
+        if A is not None:
+            s2z = compute_s2z(A, self.recon.s2z_rcond, self.recon.s2z_reg,
+                              self.recon.s2z_ntrunc, self.recon.s2z_method,
+                              self.recon.spot_positions, self.recon.scale,
+                              self.recon.flip)
+        self.recon.swap_calibration(A=A, s2z=s2z, cal=cal)
+
+
+if __name__ == "__main__":
+    from protocol import iter_felixdata_chunks
+    from slopes2fits import expand_inputs
+    from spots2zern import ZernikeReconstructor
+
+    parser = argparse.ArgumentParser(description="Estimate CAL_SLOPES and the imat from "
+                                                 "reference and poke runs")
+    parser.add_argument("fn_in", type=str, nargs='*', help="Logs taken with a flat wavefront")
+    parser.add_argument("--poke", type=str, nargs='+', default=[],
+                        help="Logs taken with the known perturbations of --perturbation")
+    parser.add_argument("--perturbation", type=str, default=None,
+                        help="npy file of shape (n_frames, N_MODES) with the Zernike "
+                             "perturbation of every frame of the --poke logs, in order")
+    parser.add_argument("--imat", type=str, default=None,
+                        help="Initial imat estimate (default: IMAT_FNAME)")
+    parser.add_argument("--confidence", type=float, default=1e3,
+                        help="Initial inverse covariance scale of the imat estimate")
+    parser.add_argument("--save-cal", type=str, default=None,
+                        help="Save the reference spot positions to this npy file, see CAL_FNAME")
+    parser.add_argument("--save-imat", type=str, default=None,
+                        help="Save the estimated imat to this npy file")
+    args = parser.parse_args()
+    if args.poke and args.perturbation is None:
+        parser.error("--poke needs --perturbation")
+    if not args.fn_in and not args.poke:
+        parser.error("give reference logs, --poke logs or both")
+
+    recon = ZernikeReconstructor(args.imat)
+    calibrator = OnlineCalibrator(recon, args.confidence)
+    for fname in expand_inputs(args.fn_in):
+        for _, coords in iter_felixdata_chunks(fname):
+            calibrator.add_reference(coords[np.isfinite(coords).all(axis=1)])
+    reference = calibrator.reference
+    if reference.n:
+        print(f"Reference frames: {reference.n}")
+        print(f"CAL_SLOPES = {reference.cal_slopes()}")
+        print(f"Standard deviation: {[round(float(x), 2) for x in np.sqrt(reference.variance)]}")
+
+    if args.poke:
+        perturbation = np.load(args.perturbation)
+        k = 0
+        for fname in expand_inputs(args.poke):
+            for _, coords in iter_felixdata_chunks(fname):
+                a_z = perturbation[k:k + len(coords)]
+                if len(a_z) != len(coords) or a_z.shape[1] != recon.n_modes:
+                    parser.error(f"--perturbation has shape {perturbation.shape}, expected one "
+                                 f"row of {recon.n_modes} coefficients per poke frame")
+                for frame, a in zip(coords, a_z):
+                    if np.isfinite(frame).all():
+                        calibrator.add_poke(a, frame)
+                k += len(coords)
+        if k != len(perturbation):
+            parser.error(f"--perturbation has {len(perturbation)} rows for {k} poke frames")
+        print(f"Poke frames: {calibrator.imat.n}")
+        print(f"RMS change of the imat: {np.sqrt(np.mean((calibrator.imat.A - recon.A)**2)):.4g}")
+
+    if args.save_cal:
+        if not reference.n:
+            parser.error("--save-cal needs reference logs")
+        np.save(args.save_cal, reference.mean)
+        print(f"Saved reference spot positions to: {args.save_cal}")
+    if args.save_imat:
+        if not calibrator.imat.n:
+            parser.error("--save-imat needs --poke logs")
+        np.save(args.save_imat, calibrator.imat.A)
+        print(f"Saved imat to: {args.save_imat}")
@@ -1,3 +1,5 @@
+import os
+
 # Wavefront reconstruction parameters
 N_SPOTS = 4         # Number of spots not including the center spot
 N_MODES = 7         # Number of Zernike polynomials not including piston
@@ -6,8 +8,24 @@ SCALE = 1           # Scale factor
 FLIP = 1            # Set to -1 to flip sign of Zernike
 IMAT_FNAME = "/home/felix/src/spots2zern/data/imat.npy"  # File name for the imat matrix
 
+# Slopes to Zernike matrix. The pseudo-inverse of the imat is cached next to it
+# and only recomputed when the imat or the parameters above change. Old entries
+# are not removed automatically; "python s2zcache.py --prune" removes them.
+S2Z_RCOND = None    # Discard singular values below S2Z_RCOND * largest (None = pinv default)
+S2Z_REG = 0         # Tikhonov regularization parameter (0 = none)
+S2Z_NTRUNC = None   # Keep only this many singular values (None = all)
+S2Z_METHOD = "svd"  # "svd", "qr", "cholesky" or "zonal", see s2zcache.compute_s2z
+RECON_DTYPE = "float64"  # Type of the reconstruction kernel, "float32" halves its size
+
+# Directory where reconstruction.py caches the sparse gamma matrices, next to
+# the imat and its s2z cache
+GAMMA_CACHE_DIR = os.path.join(os.path.dirname(IMAT_FNAME), "gamma")
+
 # rough calibration points... can be changed later
 CAL_SLOPES = [130.73, 138.72, 126.03, 132.68, 135.50, 129.99, 127.62, 121.91]
+# Reference spot positions saved by calibration.py --save-cal. If set, they are
+# used instead of CAL_SLOPES, so recalibrating does not need an edit here.
+CAL_FNAME = None
 
 # (x, y) coordinates of spot positions mapped on the pupil (slope sampling points).
 # Radius of pupil is 1.
@@ -44,3 +62,42 @@ SPOT_POSITIONS = _make_spot_positions(ROTATION_ANGLE)
 # Server setup
 HOST = '0.0.0.0'      # Listen on all available interfaces
 DEFAULT_PORT = 10488  # Port number
+
+# Sensors served by server.py besides the default one described above, see
+# registry.py. Each maps a name to a numeric sensor ID (1-65535, sent in binary
+# frames) and overrides of the parameters above, e.g.
+#   SENSORS = {"felix8": {"sensor_id": 1, "n_spots": 8, "n_modes": 9,
+#                         "imat_fname": "/home/felix/src/spots2zern/data/imat8.npy",
+#                         "cal_slopes": [...]}}
+# Reconstructors not used for REGISTRY_IDLE_SECONDS are dropped from memory.
+DEFAULT_SENSOR = "felix"
+SENSORS = {}
+REGISTRY_IDLE_SECONDS = 600
+
+# Metrics endpoint of server.py (metrics.py). Stage timings are recorded for one
+# frame in METRICS_SAMPLE_EVERY to keep the overhead low.
+METRICS_PORT = 10489
+METRICS_SAMPLE_EVERY = 8
+
+# Temporal filter applied to the Zernike stream, see zfilter.make_filter. For
+# example "ema:0.3", "kalman:1e-4,1e-2" or "predict:4,0.99". None = no filter.
+ZFILTER = None
+
+# Outlier screening before reconstruction (screening.py). Thresholds are in
+# pixels; None disables a check.
+SCREEN_RESIDUAL = None   # Maximum RMS slope residual outside the Zernike model
+SCREEN_JUMP = None       # Maximum distance of a spot from its recent median position
+SCREEN_HISTORY = 8       # Number of previous frames the median position is taken over
+SCREEN_REPAIR = True     # Try to repair failed frames by reordering the spots
+SCREEN_MAX_PERMUTE = 6   # Only try reordering for up to this many spots
+
+# Shared-memory rings between the spot finder and the reconstructor (shmring.py)
+SHM_INPUT_NAME = "felix_spots"      # Spot positions written by the spot finder
+SHM_OUTPUT_NAME = "felix_zernikes"  # Zernike coefficients written by the reconstructor
+SHM_SLOTS = 1024                    # Number of frames each ring can hold
+
+# Frame logging in the server (framelog.py)
+FRAMELOG_BUFFER = 4096              # Frames buffered in memory before a write
+FRAMELOG_FLUSH_SECONDS = 1.0        # Maximum time a frame waits before it is written
+FRAMELOG_SEGMENT_FRAMES = 1000000   # Start a new segment after this many frames
+FRAMELOG_SEGMENT_SECONDS = 3600     # Start a new segment after this many seconds
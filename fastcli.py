@@ -0,0 +1,295 @@
+"""Fast path of the spots2zern.py command line.
+
+Starting Python with NumPy, loading the imat and the s2z matrix takes far
+longer than reconstructing one frame. spots2zern.py therefore first hands its
+coordinates to a resident helper over a Unix socket, using only the
+standard library. The helper prints exactly what spots2zern.py would print.
+
+If no helper is running, spots2zern.py answers the call itself as before and
+starts a helper in the background for the next calls. The helper exits after
+SPOTS2ZERN_IDLE_SECONDS without calls, or as soon as config.py, the imat, the
+calibration or any module it loaded changes, in which case the call is answered
+the slow way and a fresh helper is started.
+
+The socket lives in $XDG_RUNTIME_DIR, or else in a directory /tmp/spots2zern-<uid>
+created with mode 0700. A socket is only used if it is owned by the current
+user and sits in a directory nobody else can write to; otherwise the call is
+answered the slow way and no helper is started.
+
+A helper holds an flock on <socket>.lock from before it is started until it
+exits, so a burst of cold calls starts a single helper and only the lock
+holder ever replaces the socket.
+
+Environment variables:
+
+    SPOTS2ZERN_SOCKET        socket path (default $XDG_RUNTIME_DIR/spots2zern.sock
+                             or /tmp/spots2zern-<uid>/spots2zern.sock)
+    SPOTS2ZERN_IDLE_SECONDS  idle time before the helper exits (default 600)
+    SPOTS2ZERN_NO_HELPER     set to disable the helper
+
+This module must not import NumPy or config.py at module level.
+"""
+import os
+import stat
+import sys
+
+# The C socket module; importing socket would pull in enum and selectors,
+# which costs more than the rest of the fast path
+import _socket
+
+def _default_socket():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        runtime_dir = f"/tmp/spots2zern-{os.getuid()}"
+    return os.path.join(runtime_dir, "spots2zern.sock")
+
+SOCKET_PATH = os.environ.get("SPOTS2ZERN_SOCKET") or _default_socket()
+IDLE_SECONDS = float(os.environ.get("SPOTS2ZERN_IDLE_SECONDS", 600))
+STALE = b"STALE\n"
+
+def forward(args, path=SOCKET_PATH, timeout=5.0):
+    """Returns the output of the resident helper for the given command line
+    arguments, or None if no up-to-date helper is running or the socket
+    cannot be trusted, see _trusted.
+    """
+    if not _trusted(path):
+        return None
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    chunks = []
+    try:
+        sock.connect(path)
+        sock.sendall((" ".join(args) + "\n").encode())
+        sock.shutdown(_socket.SHUT_WR)
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    reply = b"".join(chunks)
+    if not reply or reply == STALE:
+        return None
+    return reply.decode()
+
+def start_helper(path=SOCKET_PATH, lock_fd=None):
+    """Starts a helper in the background, detached from this process. lock_fd
+    holds the lock of path, see _lock; the helper inherits it and keeps it.
+    """
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, "fastcli.py"), "--serve", path]
+    if lock_fd is not None:
+        cmd += ["--lock-fd", str(lock_fd)]
+    subprocess.Popen(cmd, cwd=here, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True,
+                     pass_fds=() if lock_fd is None else (lock_fd,))
+
+def run(argv):
+    """Answers a spots2zern.py call through the helper and exits. Returns if
+    the full command line has to handle the call instead.
+    """
+    if os.environ.get("SPOTS2ZERN_NO_HELPER") or not argv:
+        return
+    try:
+        [float(x) for x in argv]
+    except ValueError:
+        return  # argparse reports the error
+    reply = forward(argv)
+    if reply is None:
+        # Start a helper unless one is already running or starting
+        lock_fd = _lock(SOCKET_PATH) if _make_dir(SOCKET_PATH) else None
+        if lock_fd is not None:
+            start_helper(SOCKET_PATH, lock_fd)
+            os.close(lock_fd)
+        return
+    sys.stdout.write(reply)
+    sys.exit(0)
+
+def _private_dir(path):
+    """Returns True if path is a directory owned by the current user that
+    nobody else can write to.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+            and not st.st_mode & 0o022)
+
+def _trusted(path):
+    """Returns True if path is a socket owned by the current user in a private
+    directory, so no other user can stand in for the helper.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return (stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+            and _private_dir(os.path.dirname(path) or "."))
+
+def _make_dir(path):
+    """Creates the directory of the socket with mode 0700 if needed. Returns
+    False if it is not private.
+    """
+    sock_dir = os.path.dirname(path) or "."
+    try:
+        os.mkdir(sock_dir, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    return _private_dir(sock_dir)
+
+def _lock(path, fd=None):
+    """Takes the lock of the helper on path without waiting. Returns the file
+    descriptor holding it, or None if another helper holds it.
+
+    Parameters
+    ----------
+    path: str
+        Socket path; the lock file is path + ".lock".
+    fd: int, optional
+        Descriptor of the lock file inherited from the process that started
+        this helper, which already holds the lock.
+    """
+    import fcntl
+    if fd is None:
+        try:
+            fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+def _local_modules():
+    """Returns the source files of the modules of this directory that are
+    loaded, plus those only loaded on a cache miss or by the server.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    fnames = {os.path.join(here, name + ".py") for name in ("zonal", "screening")}
+    for module in list(sys.modules.values()):
+        fname = getattr(module, "__file__", None)
+        if fname and os.path.dirname(os.path.abspath(fname)) == here:
+            fnames.add(os.path.abspath(fname))
+    return sorted(fnames)
+
+def _mtimes(fnames):
+    stamps = []
+    for fname in fnames:
+        try:
+            stamps.append(os.stat(fname).st_mtime_ns)
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+def _claim(path):
+    """Binds the socket, replacing a stale socket file. Only called with the
+    lock of path held, so no other helper is binding at the same time.
+    """
+    import socket
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+    except OSError:
+        sock.close()
+        raise
+    os.chmod(path, 0o600)
+    sock.listen(16)
+    return sock
+
+def serve(path=SOCKET_PATH, idle_seconds=IDLE_SECONDS, lock_fd=None):
+    """Runs the helper until it has been idle for idle_seconds or its inputs
+    change. Returns at once if another helper holds the lock of path.
+    """
+    if not _make_dir(path):
+        print(f"Not serving on {path}: its directory must be private to this user",
+              file=sys.stderr)
+        return
+    lock_fd = _lock(path, lock_fd)
+    if lock_fd is None:
+        return
+    try:
+        _serve(path, idle_seconds)
+    finally:
+        os.close(lock_fd)
+
+def _serve(path, idle_seconds):
+    import signal
+    import socket
+    import numpy as np
+    from spots2zern import (ZernikeReconstructor, format_coeffs, format_return_code,
+                            reconstruct)
+
+    recon = ZernikeReconstructor()
+    # Answer one frame first so everything the reconstruction imports is loaded
+    reconstruct(recon, np.zeros(2 * recon.n_spots))
+    watched = _local_modules() + [recon.imat_fname]
+    if recon.cal_fname is not None:
+        watched.append(recon.cal_fname)
+    stamps = _mtimes(watched)
+
+    sock = _claim(path)
+    # Exit through the finally block below so the socket is removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    sock.settimeout(idle_seconds)
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                break
+            with conn:
+                conn.settimeout(5.0)
+                data = b""
+                try:
+                    while True:
+                        chunk = conn.recv(4096)
+                        if not chunk:
+                            break
+                        data += chunk
+                    if _mtimes(watched) != stamps:
+                        conn.sendall(STALE)
+                        break
+                    args = data.split()
+                    if not args:
+                        continue  # liveness probe
+                    coords = [float(x) for x in args]
+                    if len(coords) != 2 * recon.n_spots:
+                        rc, a_z = 2, np.zeros(recon.n_modes)  # as in spots2zern.py
+                    else:
+                        rc, a_z = reconstruct(recon, coords)
+                    conn.sendall((format_return_code(rc) + "\n" + format_coeffs(a_z) + "\n").encode())
+                except (OSError, ValueError):
+                    continue
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Resident helper of the spots2zern.py command line")
+    parser.add_argument("--serve", type=str, default=SOCKET_PATH, metavar="SOCKET",
+                        help="Socket to listen on")
+    parser.add_argument("--idle-seconds", type=float, default=IDLE_SECONDS,
+                        help="Exit after this long without calls")
+    parser.add_argument("--lock-fd", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    serve(args.serve, args.idle_seconds, args.lock_fd)
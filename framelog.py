@@ -0,0 +1,311 @@
+import argparse
+import os
+import queue
+import threading
+import time
+import numpy as np
+from astropy.io import fits
+from config import *
+from protocol import format_felixdata
+
+FITS_BLOCK = 2880
+
+def frame_dtype(n_coords, n_modes):
+    """Returns the big-endian record layout of one logged frame, matching the
+    FITS binary table columns.
+    """
+    return np.dtype([("TIME", ">f8"), ("RC", ">i2"), ("COORDS", ">f8", (n_coords,)),
+                     ("ZERNIKES", ">f8", (n_modes,))])
+
+class SegmentWriter:
+    """Appends frames to a FITS binary table. The table header is rewritten
+    after every append, so the file is valid FITS whenever no append is in
+    progress.
+    """
+
+    def __init__(self, fname, n_coords, n_modes):
+        self.fname = fname
+        self.n_rows = 0
+        self.t_first = None
+        self.columns = fits.ColDefs([
+            fits.Column(name="TIME", format="D", unit="s"),
+            fits.Column(name="RC", format="I"),
+            fits.Column(name="COORDS", format=f"{n_coords}D"),
+            fits.Column(name="ZERNIKES", format=f"{n_modes}D"),
+        ])
+        self.f = open(fname, "wb")
+        self.f.write(fits.PrimaryHDU().header.tostring().encode("ascii"))
+        self.header_offset = self.f.tell()
+        self.f.write(self._header().tostring().encode("ascii"))
+        self.data_end = self.f.tell()
+
+    def _header(self):
+        header = fits.BinTableHDU.from_columns(self.columns, nrows=0, name="FRAMES").header
+        header["NAXIS2"] = self.n_rows
+        return header
+
+    def append(self, records):
+        """Appends a structured array of frame_dtype records.
+        """
+        if not len(records):
+            return
+        if self.t_first is None:
+            self.t_first = records["TIME"][0]
+        self.f.seek(self.data_end)
+        records.tofile(self.f)
+        self.data_end = self.f.tell()
+        remainder = self.data_end % FITS_BLOCK
+        if remainder:
+            self.f.write(b"\0" * (FITS_BLOCK - remainder))
+        self.n_rows += len(records)
+        self.f.seek(self.header_offset)
+        self.f.write(self._header().tostring().encode("ascii"))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class FrameLogger:
+    """Logs timestamps, spot positions, return codes and Zernike coefficients
+    of reconstructed frames to rotating FITS binary table segments.
+
+    Frames are copied into a preallocated buffer. Full buffers, or buffers whose
+    first frame is older than flush_seconds, are handed to a background thread
+    that appends them to the current segment, so no disk I/O happens on the
+    per-frame path. The thread also writes a stale buffer itself when no new
+    frames arrive. A new segment is started every segment_frames frames or
+    segment_seconds seconds.
+
+    A failed write (disk full, log directory removed) is reported and its
+    frames are lost, but logging goes on with a new segment. n_failed counts
+    the lost frames and error holds the last exception.
+    """
+
+    def __init__(self, log_dir, tag, n_coords, n_modes, buffer_size=FRAMELOG_BUFFER,
+                 flush_seconds=FRAMELOG_FLUSH_SECONDS, segment_frames=FRAMELOG_SEGMENT_FRAMES,
+                 segment_seconds=FRAMELOG_SEGMENT_SECONDS):
+        """Initializes the logger and starts its writer thread.
+
+        Parameters
+        ----------
+        log_dir: str
+            Directory for the segments, created if needed.
+        tag: str
+            Segments are named felixdata_<tag>_<YYYYMMDDTHHMMSS>.fits.
+        n_coords: int
+            Number of coordinates per frame, 2*N_SPOTS.
+        n_modes: int
+            Number of Zernike coefficients per frame.
+        buffer_size: int, optional
+            Number of frames per buffer.
+        flush_seconds: float, optional
+            Maximum time a frame waits in a buffer before it is written.
+        segment_frames: int, optional
+            Maximum number of frames per segment.
+        segment_seconds: float, optional
+            Maximum time span of a segment.
+        """
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_dir = log_dir
+        self.tag = tag
+        self.n_coords = n_coords
+        self.n_modes = n_modes
+        self.buffer_size = buffer_size
+        self.flush_seconds = flush_seconds
+        self.segment_frames = segment_frames
+        self.segment_seconds = segment_seconds
+        self.dtype = frame_dtype(n_coords, n_modes)
+
+        # Double buffering: the writer thread returns buffers to the free queue
+        self._free = queue.Queue()
+        self._free.put(self._new_buffer())
+        self._full = queue.Queue()
+        self._buffer = self._new_buffer()
+        self._n = 0
+        self._t_buffer = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.segments = []
+        self._segment = None
+        self.n_failed = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _new_buffer(self):
+        """Returns preallocated (timestamps, rc, coords, zernikes) columns.
+        """
+        return (np.zeros(self.buffer_size), np.zeros(self.buffer_size, dtype=np.int16),
+                np.zeros((self.buffer_size, self.n_coords)),
+                np.zeros((self.buffer_size, self.n_modes)))
+
+    def log(self, timestamp, coords, rc, a_z):
+        """Logs one frame.
+        """
+        with self._lock:
+            n = self._n
+            if n == 0:
+                self._t_buffer = time.monotonic()
+            timestamps, rcs, coords_buf, zernikes = self._buffer
+            timestamps[n] = timestamp
+            rcs[n] = rc
+            coords_buf[n] = coords
+            zernikes[n] = a_z
+            self._n = n + 1
+            if self._n == self.buffer_size or \
+               time.monotonic() - self._t_buffer > self.flush_seconds:
+                self._swap()
+
+    def log_batch(self, timestamps, coords, rc, a_z):
+        """Logs a stack of frames.
+        """
+        with self._lock:
+            start = 0
+            while start < len(timestamps):
+                if self._n == 0:
+                    self._t_buffer = time.monotonic()
+                n = min(self.buffer_size - self._n, len(timestamps) - start)
+                rows = slice(self._n, self._n + n)
+                for buf, values in zip(self._buffer, (timestamps, rc, coords, a_z)):
+                    buf[rows] = values[start:start + n]
+                self._n += n
+                start += n
+                if self._n == self.buffer_size:
+                    self._swap()
+            if self._n and time.monotonic() - self._t_buffer > self.flush_seconds:
+                self._swap()
+
+    def flush(self):
+        """Hands the current buffer to the writer thread and waits until every
+        frame logged so far is on disk.
+        """
+        with self._lock:
+            if self._n:
+                self._swap()
+        self._full.join()
+
+    def _swap(self):
+        """Queues the current buffer for writing and takes a free one. Must be
+        called with the lock held.
+        """
+        self._full.put((self._buffer, self._n))
+        try:
+            self._buffer = self._free.get_nowait()
+        except queue.Empty:
+            # The writer is behind; grow the pool rather than block
+            self._buffer = self._new_buffer()
+        self._n = 0
+        self._t_buffer = time.monotonic()
+
+    def _flush_stale(self):
+        """Queues the current buffer if its first frame is older than
+        flush_seconds. Returns the time until the next check.
+        """
+        with self._lock:
+            age = time.monotonic() - self._t_buffer
+            if not self._n:
+                return self.flush_seconds
+            if age < self.flush_seconds:
+                return self.flush_seconds - age
+            self._swap()
+            return self.flush_seconds
+
+    def _run(self):
+        """Writer thread.
+        """
+        timeout = self.flush_seconds
+        while True:
+            try:
+                item = self._full.get(timeout=timeout)
+            except queue.Empty:
+                timeout = self._flush_stale()
+                continue
+            try:
+                if item is None:
+                    break
+                buffer, n = item
+                try:
+                    records = np.empty(n, dtype=self.dtype)
+                    for name, column in zip(("TIME", "RC", "COORDS", "ZERNIKES"), buffer):
+                        records[name] = column[:n]
+                    self._write(records)
+                except Exception as e:
+                    self._write_failed(e, n)
+                finally:
+                    self._free.put(buffer)
+            finally:
+                self._full.task_done()
+            timeout = self._flush_stale()
+        if self._segment is not None:
+            self._segment.close()
+
+    def _write_failed(self, e, n):
+        """Reports a failed write and drops the current segment, so the next
+        write starts a new one.
+        """
+        if self.error is None or str(e) != str(self.error):
+            print(f"Could not log {n} frames to {self.log_dir}: {e}")
+        self.error = e
+        self.n_failed += n
+        if self._segment is not None:
+            try:
+                self._segment.close()
+            except OSError:
+                pass
+            self._segment = None
+
+    def _write(self, records):
+        segment = self._segment
+        if segment is not None and (
+                segment.n_rows + len(records) > self.segment_frames or
+                records["TIME"][-1] - segment.t_first > self.segment_seconds):
+            segment.close()
+            segment = None
+        if segment is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(records["TIME"][0]))
+            fname = os.path.join(self.log_dir, f"felixdata_{self.tag}_{stamp}.fits")
+            if fname in self.segments:
+                fname = fname[:-len(".fits")] + f"_{len(self.segments)}.fits"
+            segment = self._segment = SegmentWriter(fname, self.n_coords, self.n_modes)
+            self.segments.append(fname)
+        segment.append(records)
+
+    def close(self):
+        """Writes every buffered frame and stops the writer thread.
+        """
+        self.flush()
+        self._full.put(None)
+        self._thread.join()
+
+def load_segments(fnames):
+    """Loads logged frames from segment files, in the order given.
+
+    Returns
+    -------
+    out: nd_array of frame_dtype records
+        Fields TIME, RC, COORDS and ZERNIKES.
+    """
+    tables = [fits.getdata(fname, "FRAMES") for fname in fnames]
+    return np.concatenate([np.asarray(t) for t in tables]) if tables else np.zeros(0)
+
+def export_text(fnames, fn_out):
+    """Writes logged frames as felixdata lines, the format of the logs written
+    by sendfelixdata-save.sh.
+    """
+    with open(fn_out, "w") as f:
+        for fname in fnames:
+            data = fits.getdata(fname, "FRAMES")
+            for timestamp, coords in zip(data["TIME"], data["COORDS"]):
+                f.write(format_felixdata(timestamp, coords) + "\n")
+
+
+if __name__ == "__main__":
+    from slopes2fits import expand_inputs
+
+    parser = argparse.ArgumentParser(description="Export logged frames as felixdata text")
+    parser.add_argument("fn_in", type=str, nargs='+', help="Segment files or glob patterns")
+    parser.add_argument("fn_out", type=str, help="Output text log")
+    args = parser.parse_args()
+
+    export_text(expand_inputs(args.fn_in), args.fn_out)
@@ -0,0 +1,264 @@
+"""Low-overhead metrics for the reconstruction path.
+
+Stages are timed with time.perf_counter_ns and the durations are appended to a
+list; they are only sorted into the fixed histogram buckets when the list grows
+long or the metrics are read, so an observation costs one clock read and one
+list append. Stage timings are sampled on one frame in METRICS_SAMPLE_EVERY,
+and nothing is recorded while METRICS.enabled is False.
+
+serve_metrics exposes the metrics in the Prometheus text format:
+
+    GET /metrics          counters and histograms
+    GET /profile/start    start the sampling profiler
+    GET /profile/stop     stop it
+    GET /profile          hottest functions seen by the profiler
+"""
+import collections
+import sys
+import threading
+import time
+import traceback
+import numpy as np
+from config import *
+
+# Upper bounds of the latency buckets in nanoseconds
+LATENCY_BUCKETS_NS = (250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000,
+                      500000, 1000000, 2500000, 10000000, 100000000)
+
+# Upper bounds of the batch size buckets
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Counter:
+    """Monotonic counters, one per combination of label values.
+    """
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = collections.defaultdict(int)
+
+    def inc(self, *label_values, n=1):
+        self.values[label_values] += n
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, count in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(zip(self.label_names, values))} {count}")
+        return lines
+
+class Histogram:
+    """Fixed-bucket histograms, one per combination of label values.
+    """
+    fold_size = 4096  # Pending observations sorted into buckets at once
+
+    def __init__(self, name, help, buckets, label_names=(), scale=1.0):
+        """Initializes the histogram.
+
+        Parameters
+        ----------
+        name, help: str
+        buckets: tuple
+            Upper bounds of the buckets, in the units of the observations.
+        label_names: tuple of str, optional
+        scale: float, optional
+            Factor from observation units to exposed units, e.g. 1e-9 to
+            expose nanosecond timings in seconds.
+        """
+        self.name = name
+        self.help = help
+        self.bounds = np.array(buckets, dtype=float)
+        self.label_names = tuple(label_names)
+        self.scale = scale
+        self._pending = collections.defaultdict(list)
+        self._counts = {}
+        self._sums = collections.defaultdict(float)
+
+    def observe(self, value, *label_values):
+        pending = self._pending[label_values]
+        pending.append(value)
+        if len(pending) >= self.fold_size:
+            self._fold(label_values)
+
+    def _fold(self, label_values):
+        values = np.array(self._pending.pop(label_values, ()), dtype=float)
+        counts = self._counts.setdefault(label_values, np.zeros(len(self.bounds) + 1, dtype=np.int64))
+        counts += np.bincount(np.searchsorted(self.bounds, values, side="left"),
+                              minlength=len(counts))
+        self._sums[label_values] += values.sum()
+
+    def render(self):
+        for label_values in list(self._pending):
+            self._fold(label_values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, counts in sorted(self._counts.items()):
+            labels = list(zip(self.label_names, label_values))
+            cumulative = np.cumsum(counts)
+            for bound, n in zip(self.bounds, cumulative):
+                le = [("le", f"{bound * self.scale:.9g}")]
+                lines.append(f"{self.name}_bucket{_format_labels(labels + le)} {n}")
+            lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", "+Inf")])} {cumulative[-1]}')
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {self._sums[label_values] * self.scale:.9g}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative[-1]}")
+        return lines
+
+class Metrics:
+    """The metrics of one process, see METRICS.
+    """
+
+    def __init__(self, sample_every=METRICS_SAMPLE_EVERY):
+        self.enabled = False
+        self.sample_every = sample_every
+        self._n = collections.defaultdict(int)
+        self.frames = Counter("felix_frames_total", "Frames received", ("sensor",))
+        self.return_codes = Counter("felix_return_codes_total", "Frames answered per return code",
+                                    ("rc",))
+        self.connections = Counter("felix_connections_total", "Connections accepted", ("protocol",))
+        self.dropped = Counter("felix_dropped_connections_total",
+                               "Connections closed in the middle of a frame or reset")
+        self.stages = Histogram("felix_stage_seconds", "Time spent in each stage of the "
+                                "reconstruction path, per frame or per batch",
+                                LATENCY_BUCKETS_NS, ("stage", "path"), scale=1e-9)
+        self.batch_size = Histogram("felix_batch_frames", "Frames per reconstruct_batch call",
+                                    BATCH_BUCKETS)
+        self.profiler = SamplingProfiler()
+
+    def sample(self, site):
+        """Returns self if the stages of the current frame should be timed at
+        a call site, otherwise None. Each site keeps its own count so sites
+        called the same number of times per frame are all sampled.
+        """
+        if not self.enabled:
+            return None
+        n = self._n[site] = self._n[site] + 1
+        return self if n % self.sample_every == 0 else None
+
+    def lap(self, stage, path, t0):
+        """Records the time since t0 for a stage and returns the current time,
+        so consecutive stages can be chained.
+        """
+        t1 = time.perf_counter_ns()
+        # Histogram.observe inlined, this is the hot path
+        pending = self.stages._pending[stage, path]
+        pending.append(t1 - t0)
+        if len(pending) >= Histogram.fold_size:
+            self.stages._fold((stage, path))
+        return t1
+
+    def render(self):
+        """Returns every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in (self.frames, self.return_codes, self.connections, self.dropped,
+                       self.stages, self.batch_size):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+class SamplingProfiler:
+    """Samples the stack of a thread at a fixed interval from a background
+    thread, so the profiled code is not slowed down by tracing.
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.n_samples = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        """Starts sampling the given thread, by default the calling one.
+        """
+        if self._thread is not None:
+            return
+        target = threading.get_ident() if thread_id is None else thread_id
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(target,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, target):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                continue
+            # Count each function once per sample, wherever it is on the stack
+            seen = {f"{fs.name} ({fs.filename}:{fs.lineno})" if i == 0 else
+                    f"{fs.name} ({fs.filename})"
+                    for i, fs in enumerate(reversed(traceback.extract_stack(frame)))}
+            self.counts.update(seen)
+            self.n_samples += 1
+
+    def report(self, n=30):
+        """Returns the functions found in the most samples, innermost lines
+        marked with their line number.
+        """
+        lines = [f"{self.n_samples} samples, running={self.running}"]
+        for name, count in self.counts.most_common(n):
+            lines.append(f"{100 * count / max(self.n_samples, 1):6.1f}% {name}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        self.counts.clear()
+        self.n_samples = 0
+
+# Metrics of this process
+METRICS = Metrics()
+
+async def _handle_http(reader, writer):
+    """Answers one HTTP GET request, see the module docstring.
+    """
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # skip the headers
+        parts = request.decode(errors="replace").split()
+        path = parts[1] if len(parts) > 1 else ""
+        status = "200 OK"
+        if path == "/metrics":
+            body = METRICS.render()
+        elif path == "/profile/start":
+            METRICS.profiler.reset()
+            METRICS.profiler.start()
+            body = "profiler started\n"
+        elif path == "/profile/stop":
+            METRICS.profiler.stop()
+            body = METRICS.profiler.report()
+        elif path == "/profile":
+            body = METRICS.profiler.report()
+        else:
+            status, body = "404 Not Found", "not found\n"
+        body = body.encode()
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve_metrics(host="127.0.0.1", port=METRICS_PORT):
+    """Enables the metrics and serves them over HTTP until cancelled. The
+    profiler samples the thread running the event loop.
+    """
+    import asyncio  # not at module level, spots2zern.py imports this module
+    METRICS.enabled = True
+    server = await asyncio.start_server(_handle_http, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
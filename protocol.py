@@ -0,0 +1,234 @@
+"""Wire formats for the FELIX reconstruction server.
+
+The text format is the one written by sendfelixdata.sh, one frame per line:
+
+    felixdata <timestamp> x1, y1, x2, y2, ..., xn, yn
+
+A frame for a sensor other than the default one names the sensor, or its
+numeric ID, after the tag:
+
+    felixdata:<sensor> <timestamp> x1, y1, x2, y2, ..., xn, yn
+
+The binary format sends fixed-size frames instead, so that clients can pipeline
+many frames per connection without any string formatting. All fields are
+little-endian. A frame is a 16 byte header followed by the coordinates:
+
+    magic     2s   b"FZ"
+    version   B    BINARY_VERSION
+    dtype     c    b"f" for float32 or b"d" for float64 coordinates
+    n_spots   H    number of spots; 2*n_spots coordinates follow the header
+    sensor    H    sensor ID, 0 for the default sensor
+    timestamp d    Unix time of the frame
+
+and the reply is a 16 byte header followed by n_modes float64 coefficients:
+
+    magic     2s   b"FZ"
+    version   B    BINARY_VERSION
+    rc        B    return code, see spots2zern.print_return_code
+    n_modes   H    number of coefficients that follow
+    sensor    H    sensor ID of the frame being answered
+    timestamp d    timestamp of the frame being answered
+
+A connection is in binary mode if its first two bytes are the magic.
+"""
+import struct
+import numpy as np
+
+FELIXDATA_TAG = "felixdata"
+
+BINARY_MAGIC = b"FZ"
+BINARY_VERSION = 1
+FRAME_HEADER = struct.Struct("<2sBcHHd")
+REPLY_HEADER = struct.Struct("<2sBBHHd")
+BINARY_DTYPES = {b"f": np.dtype("<f4"), b"d": np.dtype("<f8")}
+
+def parse_felixdata(line):
+    """Parses one felixdata line.
+
+    Parameters
+    ----------
+    line: str
+        A line formatted as "felixdata <timestamp> x1, y1, ..., xn, yn".
+
+    Returns
+    -------
+    timestamp: float
+        Unix time of the frame.
+    coords: nd_array
+        Spot positions formatted as [x1, y1, x2, y2, ..., xn, yn].
+
+    Raises
+    ------
+    ValueError
+        If the line is not a felixdata message or contains non-numeric values.
+    """
+    _, timestamp, coords = parse_felixdata_sensor(line)
+    return timestamp, coords
+
+def parse_felixdata_sensor(line):
+    """Parses one felixdata line that may name a sensor, see the module
+    docstring.
+
+    Returns
+    -------
+    sensor: str or None
+        Sensor name or ID as sent, None for the default sensor.
+    timestamp: float
+    coords: nd_array
+
+    Raises
+    ------
+    ValueError
+        If the line is not a felixdata message or contains non-numeric values.
+    """
+    args = line.replace(",", " ").split()
+    tag, _, sensor = args[0].partition(":") if args else ("", "", "")
+    if len(args) < 2 or tag != FELIXDATA_TAG:
+        raise ValueError(f"not a {FELIXDATA_TAG} message: {line!r}")
+    timestamp = float(args[1])
+    coords = np.array([float(x) for x in args[2:]])
+    return sensor or None, timestamp, coords
+
+def format_felixdata(timestamp, coords):
+    """Formats a frame as a felixdata line, without the trailing newline.
+    """
+    return f"{FELIXDATA_TAG} {timestamp} " + ", ".join(str(x) for x in coords)
+
+def parse_felixdata_lines(lines):
+    """Parses many felixdata lines at once.
+
+    All lines are expected to hold the same number of coordinates, which is
+    taken from the first line. The bulk parse is done by np.loadtxt; if it
+    fails, the lines are parsed one by one and malformed lines are skipped.
+
+    Parameters
+    ----------
+    lines: list of str
+        Lines formatted as "felixdata <timestamp> x1, y1, ..., xn, yn".
+
+    Returns
+    -------
+    timestamps: nd_array of shape (n_frames)
+        Unix time of each frame.
+    coords: nd_array of shape (n_frames, 2*n_spots)
+        Spot positions formatted as [x1, y1, x2, y2, ..., xn, yn] for each frame.
+    """
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return np.zeros(0), np.zeros((0, 0))
+
+    n_cols = len(lines[0].replace(",", " ").split())
+    try:
+        if not all(line.startswith(FELIXDATA_TAG) for line in lines):
+            raise ValueError(f"not all lines are {FELIXDATA_TAG} messages")
+        data = np.loadtxt([line[len(FELIXDATA_TAG):].replace(",", " ") for line in lines],
+                          ndmin=2)
+        if data.shape[1] != n_cols - 1:
+            raise ValueError("unexpected number of columns")
+    except ValueError:
+        rows = []
+        for line in lines:
+            try:
+                timestamp, coords = parse_felixdata(line)
+            except ValueError:
+                continue
+            if len(coords) == n_cols - 2:
+                rows.append(np.concatenate(([timestamp], coords)))
+        data = np.array(rows).reshape(-1, n_cols - 1)
+    return data[:, 0], data[:, 1:]
+
+def iter_felixdata_chunks(fname, chunk_size=65536):
+    """Reads a felixdata log in chunks so memory use does not depend on the
+    length of the log.
+
+    Parameters
+    ----------
+    fname: str
+        Name of the log file.
+    chunk_size: int, optional
+        Number of lines to parse at once.
+
+    Yields
+    ------
+    timestamps: nd_array of shape (n_frames)
+    coords: nd_array of shape (n_frames, 2*n_spots)
+    """
+    with open(fname, "r") as f:
+        while True:
+            lines = [line for _, line in zip(range(chunk_size), f)]
+            if not lines:
+                break
+            timestamps, coords = parse_felixdata_lines(lines)
+            if len(timestamps):
+                yield timestamps, coords
+
+def pack_frame(timestamp, coords, dtype="<f4", sensor_id=0):
+    """Packs a frame in the binary format.
+
+    Parameters
+    ----------
+    timestamp: float
+        Unix time of the frame.
+    coords: array_like
+        Spot positions formatted as [x1, y1, x2, y2, ..., xn, yn].
+    dtype: str or np.dtype, optional
+        float32 or float64.
+    sensor_id: int, optional
+        ID of the sensor the frame comes from.
+
+    Returns
+    -------
+    out: bytes
+    """
+    coords = np.asarray(coords, dtype=np.dtype(dtype).newbyteorder("<"))
+    code = b"f" if coords.dtype.itemsize == 4 else b"d"
+    header = FRAME_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, code, len(coords)//2, sensor_id,
+                              timestamp)
+    return header + coords.tobytes()
+
+def unpack_frame_header(header):
+    """Unpacks the header of a binary frame.
+
+    Returns
+    -------
+    dtype: np.dtype
+        Data type of the coordinates.
+    n_spots: int
+        Number of spots. 2*n_spots coordinates follow the header.
+    timestamp: float
+        Unix time of the frame.
+    sensor_id: int
+        ID of the sensor the frame comes from.
+
+    Raises
+    ------
+    ValueError
+        If the magic, version or dtype are invalid.
+    """
+    magic, version, code, n_spots, sensor_id, timestamp = FRAME_HEADER.unpack(header)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION or code not in BINARY_DTYPES:
+        raise ValueError(f"invalid frame header: {header!r}")
+    return BINARY_DTYPES[code], n_spots, timestamp, sensor_id
+
+def pack_reply(rc, timestamp, a_z, sensor_id=0):
+    """Packs the reply to a binary frame.
+    """
+    header = REPLY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, rc, len(a_z), sensor_id, timestamp)
+    return header + np.asarray(a_z, dtype="<f8").tobytes()
+
+def unpack_reply_header(header):
+    """Unpacks the header of a binary reply.
+
+    Returns
+    -------
+    rc: int
+        Return code.
+    n_modes: int
+        Number of float64 coefficients that follow the header.
+    timestamp: float
+        Timestamp of the frame being answered.
+    """
+    magic, version, rc, n_modes, _, timestamp = REPLY_HEADER.unpack(header)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"invalid reply header: {header!r}")
+    return rc, n_modes, timestamp
@@ -1,10 +1,134 @@
 import argparse
+import collections
+import functools
+import hashlib
+import math
+import os
+import tempfile
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from scipy.special import factorial
+from scipy import sparse
 from astropy.io import fits
 from config import *
 
+@functools.lru_cache(maxsize=None)
+def radial_coefficients(n_max):
+    """Returns the integer coefficients of every radial polynomial up to radial
+    degree n_max.
+
+    Reference: Noll (1976).
+
+    Parameters
+    ----------
+    n_max: int
+        The maximum radial degree.
+
+    Returns
+    -------
+    out: nd_array of shape (n_max+1, n_max+1, n_max//2+1)
+        out[n, m, s] is the coefficient of rho**(n-2s) in R_n^m(rho). Entries for
+        invalid (n, m) pairs are zero. The array is read-only since it is cached.
+    """
+    coeffs = np.zeros((n_max+1, n_max+1, n_max//2+1))
+    for n in range(n_max+1):
+        for m in range(n%2, n+1, 2):
+            for s in range((n-m)//2 + 1):
+                coeffs[n, m, s] = (-1)**s * math.factorial(n-s) \
+                                  // ( math.factorial(s) * math.factorial((n+m)//2-s) \
+                                      * math.factorial((n-m)//2-s) )
+    coeffs.flags.writeable = False
+    return coeffs
+
+@functools.lru_cache(maxsize=None)
+def noll_indices(n_modes):
+    """Returns the azimuthal and radial degrees of Noll indices 1 to n_modes.
+
+    Returns
+    -------
+    m: nd_array of shape (n_modes)
+        The azimuthal degrees.
+    n: nd_array of shape (n_modes)
+        The radial degrees.
+    """
+    mn = np.array([noll_zernike_index(j) for j in range(1, n_modes+1)]).reshape(-1, 2)
+    m, n = mn[:, 0].copy(), mn[:, 1].copy()
+    m.flags.writeable = False
+    n.flags.writeable = False
+    return m, n
+
+def trig_harmonics(m_max, theta):
+    """Returns cos(m*theta) and sin(m*theta) for m = 0 to m_max using the angle
+    addition recurrence, so only one cos and sin of theta are evaluated.
+
+    Returns
+    -------
+    cos_m: nd_array of shape (m_max+1,) + theta.shape
+    sin_m: nd_array of shape (m_max+1,) + theta.shape
+    """
+    cos_m = np.empty((m_max+1,) + theta.shape)
+    sin_m = np.empty((m_max+1,) + theta.shape)
+    cos_m[0] = 1
+    sin_m[0] = 0
+    if m_max > 0:
+        cos_m[1] = np.cos(theta)
+        sin_m[1] = np.sin(theta)
+    for m in range(2, m_max+1):
+        cos_m[m] = cos_m[m-1] * cos_m[1] - sin_m[m-1] * sin_m[1]
+        sin_m[m] = sin_m[m-1] * cos_m[1] + cos_m[m-1] * sin_m[1]
+    return cos_m, sin_m
+
+def zernike_basis(n_modes, rho, theta):
+    """Evaluates Zernike modes j = 1 to n_modes in one pass.
+
+    Every radial polynomial is evaluated at once with Horner's scheme in rho**2,
+    and the angular harmonics are computed once and shared between modes.
+
+    Parameters
+    ----------
+    n_modes: int
+        Number of modes, starting from piston.
+    rho: nd_array
+        Normalized radius rho in polar coordinates.
+    theta: nd_array of shape rho.shape
+        Angle theta in polar coordinates, in radians.
+
+    Returns
+    -------
+    out: nd_array of shape (n_modes,) + rho.shape
+        out[j-1] is the Zernike polynomial with Noll index j.
+    """
+    m, n = noll_indices(n_modes)
+    mabs = np.abs(m)
+    n_max = int(n.max())
+
+    # R_n^m(rho) = rho**|m| * sum_s c[s] * (rho**2)**((n-|m|)/2 - s)
+    coeffs = radial_coefficients(n_max)[n, mabs]
+    rho2 = rho**2
+    basis = np.zeros((n_modes,) + rho.shape)
+    for k in range(n_max//2, -1, -1):
+        # Modes with fewer terms start their Horner sum later; the leading zero
+        # coefficients keep them at zero until then.
+        idx = (n - mabs)//2 - k
+        c = np.where(idx >= 0, coeffs[np.arange(n_modes), np.maximum(idx, 0)], 0)
+        basis *= rho2
+        basis += c.reshape((-1,) + (1,)*rho.ndim)
+
+    rho_m = np.ones_like(rho)
+    cos_m, sin_m = trig_harmonics(int(mabs.max()), theta)
+    for mm in range(int(mabs.max())+1):
+        sel = mabs == mm
+        basis[sel] *= rho_m
+        rho_m = rho_m * rho
+
+    # Angular part and normalization
+    basis[m == 0] *= np.sqrt(n[m == 0] + 1).reshape((-1,) + (1,)*rho.ndim)
+    for sign, harmonics in ((1, cos_m), (-1, sin_m)):
+        sel = np.sign(m) == sign
+        norm = np.sqrt(2 * (n[sel] + 1)).reshape((-1,) + (1,)*rho.ndim)
+        basis[sel] *= norm * harmonics[mabs[sel]]
+    return basis
+
 def poly_radial(m, n, rho):
     """Returns the radial part of the Zernike polynomial.
     
@@ -25,25 +149,13 @@ def poly_radial(m, n, rho):
         The polynomial evaluated for each value of rho. 
     """
     m = np.abs(m)
-    s = np.arange(0, (n-m)/2 + 1, 1)
-    # Argument of the sum for one value of s and rho
-    arg = lambda s1, rho1: (-1)**s1 * factorial(n-s1) * rho1**(n-2*s1) \
-                        / ( factorial(s1) * factorial((n+m)/2-s1)      \
-                           * factorial((n-m)/2-s1) )
-    # Compute the argument over every s and rho first, then collapse along the appropriate
-    # dimension to get the sum. This is significantly faster than iterating over the array and
-    # computing the sum for each value of rho.
-    if len(rho.shape)==1:
-        # 1D array of rho
-        res = arg(s[None, :], rho[:, None])
-        return np.sum(res, axis=1)
-    else:
-        # 2D array of rho
-        sarr = np.ones(rho.shape + (len(s),))
-        sarr[:,:] = s
-        # force sarr and rho to have the same shape
-        res = arg(sarr, rho[:,:,None])
-        return np.sum(res, axis=-1)
+    coeffs = radial_coefficients(n)[n, m]
+    # Horner's scheme in rho**2, starting from the lowest power rho**m
+    rho2 = rho**2
+    res = np.zeros_like(rho, dtype=float)
+    for s in range((n-m)//2 + 1):
+        res = res * rho2 + coeffs[s]
+    return res * rho**m
 
 def poly_angular(m, n, theta):
     """Returns the angular part of the Zernike polynomial. If m = 0, this function returns an
@@ -180,12 +292,8 @@ def generate_zernike_wavefront(a_j, points):
     out: nd_array of size (rho.size, theta.size)
         The wavefront error evaluated over the given values of rho and theta.
     """
-    wfe = np.zeros(points.shape[0])
     rho, theta = points.T
-    for j in range(1, len(a_j)+1):
-        # Noll index j starts at 1 but array indexing in Python starts at 0...
-        wfe += a_j[j-1] * noll_zernike_j(j, rho, theta)
-    return wfe
+    return np.dot(a_j, zernike_basis(len(a_j), rho, theta))
 
 def generate_zernike_wavefront_cartesian(a_j, pts):
     """Returns the wavefront error over the pupil. Pupil radius is set to 1.
@@ -202,80 +310,237 @@ def generate_zernike_wavefront_cartesian(a_j, pts):
     out: nd_array of size (x.size, y.size)
         The wavefront error in units of a_j.
     """
-    # generate a grid of rho and theta from given x and y
-    xx = pts.T[0]
-    yy = pts.T[1]
+    return get_pupil_basis(pts, len(a_j)).wavefront(a_j)
 
-    rho = np.sqrt(xx**2 + yy**2)
-    # arctan2 instead of arctan to convert the angle depending on the quadrant
-    theta = np.arctan2(yy, xx)
+class PupilBasis:
+    """Zernike basis bound to a fixed set of cartesian points on the pupil, e.g.
+    SPOT_POSITIONS or make_southwell_points(Npts).
 
-    points_polar = np.column_stack([rho, theta])
-    wfe = generate_zernike_wavefront(a_j, points_polar)
+    The polar coordinates, aperture mask and basis matrix are computed once, so
+    synthesizing a wavefront is a single matrix-vector product. Use
+    get_pupil_basis to share instances between callers.
+    """
+
+    def __init__(self, points, n_modes):
+        """Initializes the basis.
+
+        Parameters
+        ----------
+        points: nd_array of shape (n_pts, 2)
+            [x, y] coordinates to evaluate. Pupil radius is set to 1.
+        n_modes: int
+            Number of modes, starting from piston.
+        """
+        self.points = np.array(points, dtype=float)
+        self.points.flags.writeable = False
+        xx, yy = self.points.T
+        self.rho = np.sqrt(xx**2 + yy**2)
+        # arctan2 instead of arctan to convert the angle depending on the quadrant
+        self.theta = np.arctan2(yy, xx)
+        self.mask = xx**2 + yy**2 <= 1.1
+        self.basis = None
+        self.extend(n_modes)
+
+    @property
+    def n_modes(self):
+        return self.basis.shape[0]
+
+    def extend(self, n_modes):
+        """Makes sure the basis holds at least n_modes modes.
+        """
+        if self.basis is not None and self.n_modes >= n_modes:
+            return
+        basis = zernike_basis(n_modes, self.rho, self.theta)
+        # mask out everything outside of the aperture
+        basis[:, ~self.mask] = 0
+        basis.flags.writeable = False
+        self.basis = basis
+
+    def wavefront(self, a_j):
+        """Returns the wavefront error for coefficients [a_1, a_2, ..., a_j].
+        """
+        self.extend(len(a_j))
+        return np.dot(a_j, self.basis[:len(a_j)])
+
+    def derivatives(self, gammax, gammay):
+        """Returns the x and y derivatives of every mode covered by the gamma
+        matrices, see derivative_basis.
+        """
+        n_modes = gammax.shape[1]
+        self.extend(n_modes)
+        return gammax @ self.basis[:n_modes], gammay @ self.basis[:n_modes]
+
+# Most recently used PupilBasis objects, keyed by a hash of their points
+PUPIL_BASIS_CACHE_SIZE = 8
+_pupil_bases = collections.OrderedDict()
+
+def get_pupil_basis(points, n_modes):
+    """Returns a PupilBasis for the given points with at least n_modes modes.
+    Bases are cached for the PUPIL_BASIS_CACHE_SIZE most recently used point
+    sets.
+    """
+    points = np.ascontiguousarray(points, dtype=float)
+    key = (points.shape, hashlib.sha1(points.tobytes()).digest())
+    basis = _pupil_bases.get(key)
+    if basis is None:
+        basis = PupilBasis(points, n_modes)
+        _pupil_bases[key] = basis
+        if len(_pupil_bases) > PUPIL_BASIS_CACHE_SIZE:
+            _pupil_bases.popitem(last=False)
+    else:
+        _pupil_bases.move_to_end(key)
+        basis.extend(n_modes)
+    return basis
+
+def _gamma_element(j, j1, m, n, m1, n1):
+    """Returns the (j, j1) elements of gammax and gammay. Requires m, m1 >= 0
+    and abs(m1 - m) == 1; every other pair is zero.
 
-    # mask out everything outside of the aperture
-    wfe = np.where(xx**2 + yy**2 > 1.1, 0, wfe)
-    return wfe
+    References: Noll (1975)
+    """
+    # magnitudes - same for x and y
+    if (m==0 or m1==0):
+        mag = np.sqrt(2*(n+1)*(n1+1))
+    else:
+        mag = np.sqrt((n+1)*(n1+1))
+
+    gx = 0
+    gy = 0
+
+    # x conditions - non-zero elements are for j and j' either both even
+    # or both odd. Except for m or m' == 0, in which case only even j or
+    # j' give a non-zero result. All elements are positive.
+    if (j%2 == j1%2) and (m!=0 and m1!=0):
+        gx = mag
+
+    # This is supposed to be the second half of rule b in Noll's paper,
+    # but there is either an error in the paper or it is worded very
+    # poorly. Modified conditions here to match Tables II and III.
+    elif (m==0 and j1%2==0):
+        gx = mag
+    elif (m1==0 and j%2==0):
+        gx = mag
+
+    # y conditions - non-zero elemetns are for j and j' either even/odd
+    # or odd/even. Except for m or m' == 0, in which case only odd j or
+    # j' give a non-zero result.
+    if (j%2 != j1%2) and (m!=0 and m1!=0):
+        gy = mag
+
+    elif (m==0 and j1%2==1):
+        gy = mag
+    elif (m1==0 and j%2==1):
+        gy = mag
+
+    # Negative sign for m' = m + 1 and odd j, or m' = m - 1 and even j.
+    if ((m1 == m+1) and (j%2==1)) or ((m1 == m-1) and (j%2==0)):
+        gy *= -1
+
+    return gx, gy
+
+def _compute_gamma_matrices(n_modes):
+    """Builds the sparse gamma matrices by enumerating only the non-zero pairs.
+
+    For a particular m, only m' = m +/- 1 gives non-zero elements, and since
+    n - |m| and n' - |m'| are even, those have n' < n with n - n' odd.
+    """
+    m_all, n_all = noll_indices(n_modes)
+    m_all = np.abs(m_all)
+
+    # Noll indices of every (n, |m|) pair
+    modes = collections.defaultdict(list)
+    for j in range(1, n_modes+1):
+        modes[(n_all[j-1], m_all[j-1])].append(j)
+
+    rows, cols, valx, valy = [], [], [], []
+    for j in range(1, n_modes+1):
+        m, n = m_all[j-1], n_all[j-1]
+        for m1 in (m-1, m+1):
+            if m1 < 0:
+                continue
+            for n1 in range(m1, n, 2):
+                for j1 in modes.get((n1, m1), ()):
+                    gx, gy = _gamma_element(j, j1, m, n, m1, n1)
+                    rows.append(j-1)
+                    cols.append(j1-1)
+                    valx.append(gx)
+                    valy.append(gy)
+
+    shape = (n_modes, n_modes)
+    gammax = sparse.csr_matrix((valx, (rows, cols)), shape=shape)
+    gammay = sparse.csr_matrix((valy, (rows, cols)), shape=shape)
+    gammax.eliminate_zeros()
+    gammay.eliminate_zeros()
+    return gammax, gammay
+
+@functools.lru_cache(maxsize=None)
+def _cached_gamma_matrices(n_modes):
+    """Loads the gamma matrices from GAMMA_CACHE_DIR, computing and saving them
+    if they are not there yet.
+    """
+    fnames = [os.path.join(GAMMA_CACHE_DIR, f"gamma{axis}_{n_modes}.npz") for axis in "xy"]
+    try:
+        gammas = tuple(sparse.load_npz(fname).tocsr() for fname in fnames)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # Corrupt, e.g. truncated by an older version; recomputed and replaced
+        warnings.warn(f"Ignoring cached gamma matrices that cannot be loaded: {e}")
+    else:
+        if all(gamma.shape == (n_modes, n_modes) for gamma in gammas):
+            return gammas
+        warnings.warn(f"Ignoring cached gamma matrices with wrong shape in {GAMMA_CACHE_DIR}")
+
+    gammas = _compute_gamma_matrices(n_modes)
+    try:
+        os.makedirs(GAMMA_CACHE_DIR, exist_ok=True)
+        for fname, gamma in zip(fnames, gammas):
+            _save_gamma(fname, gamma)
+    except OSError as e:
+        warnings.warn(f"Could not cache gamma matrices to {GAMMA_CACHE_DIR}: {e}")
+    return gammas
+
+def _save_gamma(fname, gamma):
+    """Writes a gamma matrix to fname atomically, as s2zcache.save_s2z does, so
+    an interrupted or concurrent run never leaves a partial file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            sparse.save_npz(f, gamma)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 def make_gamma_matrices(n_modes):
     """ The derivative of a Zernike polynomial can be expressed as a linear
     combination of Zernikes. Use the matrices gammax and gammay to store the
     coefficients of the linear combination.
 
+    The matrices are sparse and cached in memory and in GAMMA_CACHE_DIR, so
+    they are only built once for each n_modes.
+
     References: Noll (1975)
+
+    Returns
+    -------
+    gammax: scipy.sparse.csr_matrix of shape (n_modes, n_modes)
+    gammay: scipy.sparse.csr_matrix of shape (n_modes, n_modes)
     """
-    gammax = np.zeros((n_modes, n_modes))
-    gammay = np.zeros((n_modes, n_modes))
+    gammax, gammay = _cached_gamma_matrices(n_modes)
+    return gammax.copy(), gammay.copy()
+
+def _dense_row(gamma, i):
+    """Returns row i of a dense or sparse gamma matrix as a 1D array.
+    """
+    if sparse.issparse(gamma):
+        return gamma.getrow(i).toarray().ravel()
+    return gamma[i]
 
-    for j in range(1, n_modes+1):
-        for j1 in range(1, j+1):
-            m, n = noll_zernike_index(j)
-            m1, n1 = noll_zernike_index(j1)
-
-            # Noll remaps the indices so m is always positive
-            m = abs(m)
-            m1 = abs(m1)
-
-            # magnitudes - same for x and y
-            mag = 0
-            if (m==0 or m1==0):
-                mag = np.sqrt(2*(n+1)*(n1+1))
-            elif (m!=0 and m1!=0):
-                mag = np.sqrt((n+1)*(n1+1))
-
-            # For a particular m, only m' = m +/- 1 gives non-zero elements.
-            if (abs(m1-m) == 1):
-                # x conditions - non-zero elements are for j and j' either both even
-                # or both odd. Except for m or m' == 0, in which case only even j or
-                # j' give a non-zero result. All elements are positive.
-                if (j%2 == j1%2) and (m!=0 and m1!=0):
-                    gammax[j-1, j1-1] = mag
-
-                # This is supposed to be the second half of rule b in Noll's paper,
-                # but there is either an error in the paper or it is worded very
-                # poorly. Modified conditions here to match Tables II and III.
-                elif (m==0 and j1%2==0):
-                    gammax[j-1, j1-1] = mag
-                elif (m1==0 and j%2==0):
-                    gammax[j-1, j1-1] = mag
-
-                # y conditions - non-zero elemetns are for j and j' either even/odd
-                # or odd/even. Except for m or m' == 0, in which case only odd j or
-                # j' give a non-zero result.
-                if (j%2 != j1%2) and (m!=0 and m1!=0):
-                    gammay[j-1, j1-1] = mag
-
-                elif (m==0 and j1%2==1):
-                    gammay[j-1, j1-1] = mag
-                elif (m1==0 and j%2==1):
-                    gammay[j-1, j1-1] = mag
-
-                # Negative sign for m' = m + 1 and odd j, or m' = m - 1 and even j.
-                if ((m1 == m+1) and (j%2==1)) or ((m1 == m-1) and (j%2==0)):
-                    gammay[j-1, j1-1] *= -1
-                
-    return gammax, gammay
-            
 def zernike_derv(j, gammax, gammay, points):
     """Computes the derivative of the kth order Zernike polynomial as a linear
     combination of Zernikes up to the nth order.
@@ -284,9 +549,9 @@ def zernike_derv(j, gammax, gammay, points):
     ----------
     j: int
         The Noll Zernike index of the mode to differentiate.
-    gammax: nd_array
+    gammax: nd_array or scipy.sparse matrix
         Gamma matrix for x as defined by Noll (1975).
-    gammay: nd_array
+    gammay: nd_array or scipy.sparse matrix
         Gamma matrix for y as defined by Noll (1975).
     points: nd_array of shape (2, n_spots)
         Points to evaluate.
@@ -299,14 +564,36 @@ def zernike_derv(j, gammax, gammay, points):
         Derivative of the Zernike polynomial along y.
     """
     # A row of gammax essentially serves as Zernike coefficients
-    xcoeffs = gammax[j-1]
+    xcoeffs = _dense_row(gammax, j-1)
     dervx = generate_zernike_wavefront_cartesian(xcoeffs, points)
 
     # Repeat for gammay
-    ycoeffs = gammay[j-1]
+    ycoeffs = _dense_row(gammay, j-1)
     dervy = generate_zernike_wavefront_cartesian(ycoeffs, points)
     return dervx, dervy
 
+def derivative_basis(gammax, gammay, points):
+    """Computes the x and y derivatives of every Zernike mode covered by the gamma
+    matrices from a single evaluation of the basis.
+
+    Parameters
+    ----------
+    gammax: nd_array or scipy.sparse matrix of shape (n_modes, n_modes)
+        Gamma matrix for x as defined by Noll (1975).
+    gammay: nd_array or scipy.sparse matrix of shape (n_modes, n_modes)
+        Gamma matrix for y as defined by Noll (1975).
+    points: nd_array of shape (n_pts, 2)
+        Points to evaluate.
+
+    Returns
+    -------
+    dervx: nd_array of shape (n_modes, n_pts)
+        dervx[j-1] is the derivative along x of the mode with Noll index j.
+    dervy: nd_array of shape (n_modes, n_pts)
+        dervy[j-1] is the derivative along y of the mode with Noll index j.
+    """
+    return get_pupil_basis(points, gammax.shape[1]).derivatives(gammax, gammay)
+
 def make_southwell_points(Npts):
     """Creates an array of points that sample the pupil evenly according to the
     sampling geometry shown in Southwell (1980) Fig 1A. Radius of pupil is 1.
@@ -327,8 +614,9 @@ def make_southwell_points(Npts):
     x, y = np.meshgrid(xpts, ypts, indexing="xy")
     return np.column_stack([x.ravel(), y.ravel()])
 
-def make_theoretical_imat(points, n_spots, n_modes, scale, flip, fname="imat.npy"):
-    """Creates Zernike to slopes matrix without piston.
+def zernike_norm(n_modes, scale, flip):
+    """Returns the normalization of the columns of the imat, i.e. of modes 2
+    to n_modes+1.
     """
     # Create normalization coefficients
     norm = np.ones(n_modes)
@@ -339,19 +627,21 @@ def make_theoretical_imat(points, n_spots, n_modes, scale, flip, fname="imat.npy
         m, n = noll_zernike_index(k + 2)
         if m < 0:
             norm[k] *= flip
+    return norm
+
+def make_theoretical_imat(points, n_spots, n_modes, scale, flip, fname="imat.npy"):
+    """Creates Zernike to slopes matrix without piston.
+    """
+    norm = zernike_norm(n_modes, scale, flip)
 
     # Derivative matrices, plus 1 to skip piston
     gammax, gammay = make_gamma_matrices(n_modes + 1)
 
-    A = np.zeros((2*n_spots, n_modes))
     print(points)
 
-    for k in range(n_modes):
-        # Noll index would usually be k + 1... Skip piston, so k + 2.
-        dervx, dervy = zernike_derv(k+2, gammax, gammay, points)
-        for i in range(n_spots):
-            A[i,k] = norm[k] * dervx[i]
-            A[i+n_spots,k] = norm[k] * dervy[i]
+    # Row 0 of the derivatives is piston, so skip it
+    dervx, dervy = derivative_basis(gammax, gammay, points)
+    A = np.vstack((dervx[1:, :n_spots].T, dervy[1:, :n_spots].T)) * norm
     
     with open(f"{fname}", "wb") as f:
         np.save(f, A)
@@ -359,37 +649,173 @@ def make_theoretical_imat(points, n_spots, n_modes, scale, flip, fname="imat.npy
     print(f"Saved imat to: {fname}")
     return A
 
-def make_slope_offsets(Npts, Nmodes):
+def slope_offsets(gammax, gammay, Npts, Nmodes=None):
+    """Returns the x and y slopes of each Zernike mode over an Npts x Npts
+    Southwell grid. Piston is not included.
+
+    The gamma matrices may cover more modes than needed: the derivatives of a
+    mode only involve lower modes, so the leading block of the matrices gives
+    the same result as matrices built for Nmodes.
+
+    Returns
+    -------
+    out: nd_array of shape (Nmodes, 2*Npts, Npts)
+        out[k, :Npts] are the x slopes and out[k, Npts:] the y slopes of the
+        mode with Noll index k+2.
+    """
+    n = gammax.shape[0] if Nmodes is None else Nmodes + 1
+    points = make_southwell_points(Npts)
+
+    # Compute derivatives for each subaperture, skipping piston
+    dervx, dervy = derivative_basis(gammax[:n, :n], gammay[:n, :n], points)
+    out = np.empty((n - 1, 2 * Npts, Npts))
+    out[:, :Npts] = dervx[1:].reshape(n - 1, Npts, Npts)
+    out[:, Npts:] = dervy[1:].reshape(n - 1, Npts, Npts)
+    return out
+
+def make_slope_offsets(Npts, Nmodes, fname="data/slopesXandY.fits"):
     """Saves a FITS file with the x and y slopes for each Zernike mode. Piston
     is not included.
     """
     gammax, gammay = make_gamma_matrices(Nmodes + 1) # skip piston
-    points = make_southwell_points(Npts)
+    hdu = fits.PrimaryHDU(slope_offsets(gammax, gammay, Npts))
+    hdu.writeto(fname, overwrite=True)
 
-    # Compute derivatives for each subaperture
-    slopesx = np.zeros((Nmodes, Npts, Npts))
-    slopesy = np.zeros((Nmodes, Npts, Npts))
-    for i in range(Nmodes):
-        dervx, dervy = zernike_derv(i+2, gammax, gammay, points)
-        #dervy *= -1
-        slopesx[i] = np.reshape(dervx, (Npts, Npts))
-        slopesy[i] = np.reshape(dervy, (Npts, Npts))
-    
-    hdu = fits.PrimaryHDU(np.concatenate((slopesx, slopesy), axis=1))
-    hdu.writeto("data/slopesXandY.fits", overwrite=True)
+# Gamma matrices of the worker processes of make_slope_offset_products
+_worker_gammas = None
+
+def _init_offsets_worker(gammax, gammay):
+    global _worker_gammas
+    _worker_gammas = (gammax, gammay)
+
+def _offsets_worker(Npts, Nmodes):
+    return slope_offsets(*_worker_gammas, Npts, Nmodes)
+
+def _stream_image(fname, data, cards):
+    """Appends data as an image extension to fname one plane at a time.
+    """
+    header = fits.ImageHDU(np.zeros((1,) * data.ndim, dtype=data.dtype)).header
+    for axis, size in enumerate(data.shape[::-1]):
+        header[f"NAXIS{axis + 1}"] = size
+    header.update(cards)
+    hdu = fits.StreamingHDU(fname, header)
+    for plane in data:
+        hdu.write(plane)
+    hdu.close()
+
+def make_slope_offset_products(products, fname="data/slopesXandY_products.fits", n_workers=None):
+    """Saves the slope offsets of several grids to one multi-extension FITS
+    file, with one image extension per product as written by
+    make_slope_offsets, named N<Npts>_M<Nmodes>.
+
+    The gamma matrices are computed once for the highest Nmodes, and the
+    derivatives once per Npts for the highest Nmodes requested with it; lower
+    orders are slices. The grids are computed in parallel, at most n_workers
+    ahead of the one being written, and each extension is streamed to the file
+    in order, so memory holds about n_workers grids however many are requested.
+    A grid used by several products stays in memory until its last one.
 
+    Parameters
+    ----------
+    products: list of (int, int)
+        (Npts, Nmodes) of each extension, in file order.
+    fname: str, optional
+    n_workers: int, optional
+        Size of the process pool. 1 to compute each grid in this process just
+        before it is written.
+    """
+    products = [(int(Npts), int(Nmodes)) for Npts, Nmodes in products]
+    max_modes = {}
+    last_use = {}
+    for k, (Npts, Nmodes) in enumerate(products):
+        max_modes[Npts] = max(max_modes.get(Npts, 0), Nmodes)
+        last_use[Npts] = k
+    gammax, gammay = make_gamma_matrices(max(max_modes.values()) + 1)
+
+    fits.PrimaryHDU().writeto(fname, overwrite=True)
+    if n_workers == 1:
+        _init_offsets_worker(gammax, gammay)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(n_workers, initializer=_init_offsets_worker,
+                                   initargs=(gammax, gammay))
+        n_ahead = n_workers or os.cpu_count()
+    # Grids in order of first use, each computed once and dropped after its
+    # last use
+    pending = iter(dict.fromkeys(Npts for Npts, _ in products))
+    results = {}
+
+    def compute_next():
+        Npts = next(pending)
+        if pool is None:
+            results[Npts] = _offsets_worker(Npts, max_modes[Npts])
+        else:
+            results[Npts] = pool.submit(_offsets_worker, Npts, max_modes[Npts])
+
+    def submit_ahead():
+        # Keep the workers busy without holding more than n_ahead grids
+        try:
+            while pool is not None and len(results) < n_ahead:
+                compute_next()
+        except StopIteration:
+            pass
+
+    try:
+        submit_ahead()
+        for k, (Npts, Nmodes) in enumerate(products):
+            if Npts not in results:
+                compute_next()  # first use of Npts, so it is the next pending grid
+            offsets = results[Npts] if pool is None else results[Npts].result()
+            _stream_image(fname, offsets[:Nmodes], {"EXTNAME": f"N{Npts}_M{Nmodes}",
+                                                    "NPTS": Npts, "NMODES": Nmodes})
+            del offsets
+            if last_use[Npts] == k:
+                del results[Npts]
+                submit_ahead()
+            print(f"Saved {Npts}x{Npts} slopes of {Nmodes} modes to: {fname}[N{Npts}_M{Nmodes}]")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
 
 if __name__=='__main__':
 
     parser = argparse.ArgumentParser(description="Zernike slope offset generation")
     parser.add_argument("--mode", type=str, default="slopes", choices=["imat", "slopes"],
                         help="Mode of operation: 'imat' to generate theoretical imat, 'slopes' to generate slope offsets")
-    parser.add_argument('--Npts', type=int, default=12, help="Number of points to sample along one axis")
+    parser.add_argument('--Npts', type=str, nargs='+', default=["12"],
+                        help="Number of points to sample along one axis. Several values, "
+                             "optionally as Npts:Nmodes, write one FITS extension each")
     parser.add_argument('--Nmodes', type=int, default=36, help="Number of Zernike modes")
+    parser.add_argument("--southwell", action="store_true",
+                        help="With --mode imat, make the imat of an Npts x Npts Southwell grid "
+                             "instead of SPOT_POSITIONS")
+    parser.add_argument("--out", type=str, default=None,
+                        help="Output file (default: IMAT_FNAME, data/slopesXandY.fits or "
+                             "data/slopesXandY_products.fits)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes used for several Npts (default: one per CPU)")
 
     args = parser.parse_args()
 
-    if args.mode == "imat":
-        make_theoretical_imat(np.array(SPOT_POSITIONS), N_SPOTS, N_MODES, SCALE, FLIP, fname=IMAT_FNAME)
+    products = []
+    for spec in args.Npts:
+        Npts, _, Nmodes = spec.partition(":")
+        products.append((int(Npts), int(Nmodes) if Nmodes else args.Nmodes))
+
+    if args.mode == "imat" and args.southwell:
+        args.out = args.out or IMAT_FNAME
+        # Only the subapertures inside the pupil see spots
+        points = make_southwell_points(products[0][0])
+        points = points[get_pupil_basis(points, 1).mask]
+        make_theoretical_imat(points, len(points), N_MODES, SCALE, FLIP, fname=args.out)
+        fn_points = os.path.splitext(args.out)[0] + "_points.npy"
+        np.save(fn_points, points)
+        print(f"Saved {len(points)} spot positions (N_SPOTS, SPOT_POSITIONS) to: {fn_points}")
+    elif args.mode == "imat":
+        make_theoretical_imat(np.array(SPOT_POSITIONS), N_SPOTS, N_MODES, SCALE, FLIP,
+                              fname=args.out or IMAT_FNAME)
+    elif args.mode == "slopes" and len(products) == 1:
+        make_slope_offsets(*products[0], fname=args.out or "data/slopesXandY.fits")
     elif args.mode == "slopes":
-        make_slope_offsets(args.Npts, args.Nmodes)
\ No newline at end of file
+        make_slope_offset_products(products, args.out or "data/slopesXandY_products.fits",
+                                   args.workers)
\ No newline at end of file
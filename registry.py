@@ -0,0 +1,197 @@
+"""Registry of named reconstructor configurations.
+
+One process can serve several sensors (instruments or pyramid-facet layouts),
+each with its own spot positions, imat, cached s2z matrix and CAL_SLOPES. The
+default sensor is described by the constants in config.py; further sensors are
+listed in SENSORS in config.py or in a JSON file of the same form:
+
+    {"felix8": {"sensor_id": 1, "n_spots": 8, "n_modes": 9,
+                "imat_fname": "data/imat8.npy", "cal_slopes": [...]}}
+
+Reconstructors are built on first use and dropped after idle_seconds without
+frames. Since the s2z matrix is memory-mapped from its cache, rebuilding an
+evicted reconstructor only costs loading its imat.
+"""
+import json
+import threading
+import time
+from config import *
+from spots2zern import ZernikeReconstructor
+
+# Keyword arguments of ZernikeReconstructor that a configuration may set
+CONFIG_KEYS = ("imat_fname", "n_spots", "n_modes", "rotation_angle", "scale", "flip",
+               "spot_positions", "cal_slopes", "s2z_method",
+               "dtype", "cal_fname")
+
+def load_sensors(fname):
+    """Loads sensor configurations from a JSON file, see the module docstring.
+    """
+    with open(fname) as f:
+        return json.load(f)
+
+class ReconstructorRegistry:
+    """Named reconstructor configurations, addressed by name or sensor ID.
+    """
+
+    def __init__(self, sensors=SENSORS, default=None, default_name=DEFAULT_SENSOR,
+                 idle_seconds=REGISTRY_IDLE_SECONDS):
+        """Initializes the registry. No reconstructor is built yet except the
+        default one.
+
+        Parameters
+        ----------
+        sensors: dict, optional
+            Sensor name to configuration, see the module docstring.
+        default: ZernikeReconstructor, optional
+            Reconstructor of the default sensor, ID 0. Built from config.py if
+            not given. It is never evicted.
+        default_name: str, optional
+            Name of the default sensor.
+        idle_seconds: float, optional
+            Evict reconstructors that have not been used for this long. None
+            to keep them.
+
+        Raises
+        ------
+        ValueError
+            If a configuration has an unknown key, or IDs or names clash.
+        """
+        self.configs = {}
+        self.ids = {0: default_name}
+        for name, config in sensors.items():
+            config = dict(config)
+            sensor_id = int(config.pop("sensor_id"))
+            unknown = set(config) - set(CONFIG_KEYS)
+            if unknown:
+                raise ValueError(f"sensor {name!r}: unknown keys {sorted(unknown)}")
+            if name == default_name or not 0 < sensor_id < 2**16 or sensor_id in self.ids:
+                raise ValueError(f"sensor {name!r}: name or sensor_id {sensor_id} is taken "
+                                 "or out of range")
+            self.configs[name] = config
+            self.ids[sensor_id] = name
+        self.names = {name: sensor_id for sensor_id, name in self.ids.items()}
+        self.default_name = default_name
+        self.idle_seconds = idle_seconds
+
+        if default is None:
+            default = ZernikeReconstructor()
+        self._recons = {default_name: default}
+        self._last_used = {}
+        # Sensors that are never evicted, e.g. after a live recalibration
+        self.pinned = {default_name}
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    def resolve(self, sensor):
+        """Returns the name of a sensor given as a name, an ID or None for the
+        default sensor.
+
+        Raises
+        ------
+        KeyError
+            If there is no such sensor.
+        """
+        if sensor is None:
+            return self.default_name
+        if isinstance(sensor, str) and sensor in self.names:
+            return sensor
+        try:
+            return self.ids[int(sensor)]
+        except (ValueError, KeyError):
+            raise KeyError(f"unknown sensor {sensor!r}")
+
+    def get(self, sensor=None):
+        """Returns the reconstructor of a sensor, building it if needed.
+
+        Raises
+        ------
+        KeyError
+            If there is no such sensor.
+        ValueError
+            If the imat of the sensor does not match its n_spots and n_modes.
+        OSError
+            If the imat or another file of the sensor cannot be read.
+        """
+        name = self.resolve(sensor)
+        recon = self.cached(name)
+        if recon is not None:
+            return recon
+        with self._lock:
+            build_lock = self._build_locks.setdefault(name, threading.Lock())
+        # Build outside the registry lock, so the loaded sensors stay available
+        with build_lock:
+            recon = self.cached(name)
+            if recon is None:
+                recon = ZernikeReconstructor(**self.configs[name])
+                if recon.A.shape != (2 * recon.n_spots, recon.n_modes):
+                    raise ValueError(f"sensor {name!r}: imat of shape {recon.A.shape} does not "
+                                     f"match {recon.n_spots} spots and {recon.n_modes} modes")
+                with self._lock:
+                    self._recons[name] = recon
+                    self._last_used[name] = time.monotonic()
+        return recon
+
+    def cached(self, sensor=None):
+        """Returns the reconstructor of a sensor if it is loaded, else None.
+        Never builds one, so it is safe to call from the event loop.
+
+        Raises
+        ------
+        KeyError
+            If there is no such sensor.
+        """
+        name = self.resolve(sensor)
+        with self._lock:
+            recon = self._recons.get(name)
+            if recon is not None:
+                self._last_used[name] = time.monotonic()
+        return recon
+
+    def check(self):
+        """Builds the reconstructor of every sensor, so that a broken
+        configuration is found at startup rather than on its first frame.
+
+        Returns
+        -------
+        errors: dict
+            Sensor name to the exception raised while building it.
+        """
+        errors = {}
+        for name in self.configs:
+            try:
+                self.get(name)
+            except (OSError, ValueError) as e:
+                errors[name] = e
+        return errors
+
+    def sensor_id(self, sensor=None):
+        """Returns the numeric ID of a sensor.
+        """
+        return self.names[self.resolve(sensor)]
+
+    def pin(self, sensor=None):
+        """Keeps the reconstructor of a sensor in memory from now on, so a
+        calibration swapped into it is not lost to eviction.
+        """
+        self.pinned.add(self.resolve(sensor))
+
+    @property
+    def loaded(self):
+        """Names of the sensors whose reconstructor is in memory.
+        """
+        return list(self._recons)
+
+    def evict_idle(self, now=None):
+        """Drops the reconstructors that have not been used for idle_seconds.
+        Returns the names of the evicted sensors.
+        """
+        if self.idle_seconds is None:
+            return []
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            idle = [name for name, t in self._last_used.items()
+                    if name not in self.pinned and now - t > self.idle_seconds]
+            for name in idle:
+                del self._recons[name]
+                del self._last_used[name]
+        return idle
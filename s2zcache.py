@@ -0,0 +1,249 @@
+import argparse
+import glob
+import hashlib
+import os
+import tempfile
+import time
+import warnings
+import numpy as np
+from config import *
+
+# Ways to compute the slopes to Zernike matrix, see compute_s2z
+S2Z_METHODS = ("svd", "qr", "cholesky", "zonal")
+
+def compute_s2z(A, rcond=None, reg=0.0, n_trunc=None, method="svd", points=None,
+                scale=SCALE, flip=FLIP):
+    """Computes the slopes to Zernike matrix from a Zernike to slopes matrix.
+
+    Parameters
+    ----------
+    A: nd_array of shape (2*n_spots, n_modes)
+        Zernike to slopes matrix.
+    rcond: float, optional
+        Singular values smaller than rcond times the largest one are discarded.
+        Only for method "svd".
+    reg: float, optional
+        Tikhonov regularization parameter. Singular values s are inverted as
+        s / (s**2 + reg) instead of 1 / s, i.e. (A^T A + reg I)^-1 A^T.
+    n_trunc: int, optional
+        Keep only the n_trunc largest singular values. Only for method "svd".
+    method: str, optional
+        "svd"       pseudo-inverse from the SVD of A
+        "qr"        least squares from the QR factorization of A, cheaper and
+                    as stable as the SVD for a well-conditioned A
+        "cholesky"  normal equations A^T A, cheapest, squares the condition
+                    number of A
+        "zonal"     Southwell zonal reconstruction projected onto the Zernike
+                    modes, see zonal.py. Ignores A except for its shape.
+    points: nd_array of shape (n_spots, 2), optional
+        Spot positions, required by method "zonal".
+    scale, flip: optional
+        Normalization of the modes of A, used by method "zonal".
+
+    Returns
+    -------
+    s2z: nd_array of shape (n_modes, 2*n_spots)
+        The (regularized) pseudo-inverse of A.
+
+    Raises
+    ------
+    ValueError
+        If the method is unknown or does not support the options.
+    """
+    if method not in S2Z_METHODS:
+        raise ValueError(f"unknown s2z method {method!r}, expected one of {', '.join(S2Z_METHODS)}")
+    if method != "svd" and (rcond is not None or n_trunc is not None):
+        raise ValueError(f"rcond and n_trunc need the svd method, not {method!r}")
+
+    n_modes = A.shape[1]
+    if method in ("qr", "cholesky") and len(A) < n_modes and not reg:
+        raise ValueError(f"the {method} method needs at least as many slopes as modes "
+                         "or a regularization")
+    if method == "qr":
+        # Tikhonov regularization as least squares on [A; sqrt(reg) I]
+        A_reg = np.vstack((A, np.sqrt(reg) * np.eye(n_modes))) if reg else A
+        Q, R = np.linalg.qr(A_reg)
+        return np.linalg.solve(R, Q[:len(A)].T)
+    if method == "cholesky":
+        L = np.linalg.cholesky(np.dot(A.T, A) + reg * np.eye(n_modes))
+        return np.linalg.solve(L.T, np.linalg.solve(L, A.T))
+    if method == "zonal":
+        if points is None or len(points) != len(A) // 2:
+            raise ValueError("the zonal method needs the positions of the spots")
+        from zonal import ZonalReconstructor  # needs scipy, only on a cache miss
+        return ZonalReconstructor(points, n_modes, scale, flip, reg).s2z_matrix()
+
+    if rcond is None and not reg and n_trunc is None:
+        return np.linalg.pinv(A)
+
+    U, sv, Vt = np.linalg.svd(A, full_matrices=False)
+    keep = sv > (rcond if rcond is not None else 1e-15) * sv[0]
+    if n_trunc is not None:
+        keep[n_trunc:] = False
+    inv = np.zeros_like(sv)
+    inv[keep] = sv[keep] / (sv[keep]**2 + reg)
+    return np.dot(Vt.T * inv, U.T)
+
+def cache_key(A, n_modes, scale, flip, rot, rcond=None, reg=0.0, n_trunc=None,
+              method="svd", points=None):
+    """Returns a hash of the imat contents and every parameter that the cached
+    matrix depends on.
+    """
+    h = hashlib.sha256()
+    A = np.ascontiguousarray(A, dtype=float)
+    h.update(repr(A.shape).encode())
+    h.update(A.tobytes())
+    params = (n_modes, float(scale), float(flip), float(rot), rcond, float(reg), n_trunc)
+    if method != "svd":
+        # Keys of svd matrices cached before the method option are unchanged
+        params += (method,)
+    h.update(repr(params).encode())
+    if method == "zonal":
+        h.update(np.ascontiguousarray(points, dtype=float).tobytes())
+    return h.hexdigest()
+
+def validate_imat(A, n_modes):
+    """Checks that A is a finite Zernike to slopes matrix with n_modes columns.
+    """
+    if A.ndim != 2 or A.shape[1] != n_modes:
+        raise ValueError(f"imat has shape {A.shape}, expected (2*n_spots, {n_modes})")
+    if not np.all(np.isfinite(A)):
+        raise ValueError("imat contains non-finite values")
+
+def cache_path(imat_fname, key, cache_dir=None):
+    """Returns the file name of the cached s2z matrix for the given key. By
+    default it is stored next to the imat.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(imat_fname))
+    return os.path.join(cache_dir, f"s2z_{key[:16]}.npy")
+
+def save_s2z(fname, s2z):
+    """Writes s2z to fname atomically so concurrent readers never see a
+    partial file. The file gets the usual permissions for the umask, so
+    processes of other accounts can read it.
+    """
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".npy.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, s2z)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load_s2z(A, imat_fname, n_modes=N_MODES, scale=SCALE, flip=FLIP,
+             rot=np.radians(ROTATION_ANGLE), rcond=None, reg=0.0, n_trunc=None,
+             cache_dir=None, method="svd", points=None):
+    """Returns the slopes to Zernike matrix for A, computing it only if no
+    cached copy exists for the same inputs.
+
+    The cached matrix is memory-mapped read-only, so every process that loads
+    it shares the same page-cached copy.
+
+    Parameters
+    ----------
+    A: nd_array of shape (2*n_spots, n_modes)
+        Zernike to slopes matrix loaded from imat_fname.
+    imat_fname: str
+        File name of the imat. The cache is written next to it unless
+        cache_dir is given.
+    n_modes, scale, flip, rot:
+        Reconstructor parameters, see config.py. rot is in radians.
+    rcond, reg, n_trunc:
+        Passed to compute_s2z.
+    cache_dir: str, optional
+        Directory for the cached matrix.
+    method, points: optional
+        Passed to compute_s2z.
+
+    Returns
+    -------
+    s2z: nd_array of shape (n_modes, 2*n_spots)
+        The slopes to Zernike matrix.
+    """
+    validate_imat(A, n_modes)
+    key = cache_key(A, n_modes, scale, flip, rot, rcond, reg, n_trunc, method, points)
+    fname = cache_path(imat_fname, key, cache_dir)
+
+    try:
+        s2z = np.load(fname, mmap_mode="r")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        # Unreadable or corrupt, e.g. written by another account
+        warnings.warn(f"Ignoring cached s2z that cannot be loaded: {fname}: {e}")
+    else:
+        if s2z.shape == (n_modes, A.shape[0]):
+            return s2z
+        warnings.warn(f"Ignoring cached s2z with wrong shape {s2z.shape}: {fname}")
+
+    s2z = compute_s2z(A, rcond, reg, n_trunc, method, points, scale, flip)
+    try:
+        save_s2z(fname, s2z)
+    except OSError as e:
+        warnings.warn(f"Could not cache s2z to {fname}: {e}")
+        return s2z
+    return np.load(fname, mmap_mode="r")
+
+def prune_cache(cache_dir, keep=(), max_age_days=0.0):
+    """Removes cached s2z matrices, and temporary files of interrupted writes,
+    from cache_dir. Every imat or reconstructor configuration leaves its own
+    file behind, so the cache grows until it is pruned.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cached matrices, usually that of the imat.
+    keep: sequence of str, optional
+        File names that are not removed, e.g. the cache_path of the current
+        configuration.
+    max_age_days: float, optional
+        Only remove files not modified for this many days.
+
+    Returns
+    -------
+    removed: list of str
+        File names of the removed files.
+    """
+    keep = {os.path.abspath(fname) for fname in keep}
+    cutoff = time.time() - max_age_days * 86400
+    removed = []
+    for fname in glob.glob(os.path.join(cache_dir, "s2z_*.npy")) + \
+            glob.glob(os.path.join(cache_dir, "*.npy.tmp")):
+        if os.path.abspath(fname) in keep:
+            continue
+        try:
+            if os.path.getmtime(fname) <= cutoff:
+                os.unlink(fname)
+                removed.append(fname)
+        except OSError as e:
+            warnings.warn(f"Could not remove {fname}: {e}")
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the cached s2z matrix")
+    parser.add_argument("--imat", type=str, default=IMAT_FNAME, help="Path to the imat")
+    parser.add_argument("--prune", action="store_true",
+                        help="Remove the other cached s2z matrices next to the imat")
+    parser.add_argument("--max-age", type=float, default=0.0,
+                        help="With --prune, only remove files older than this many days")
+    args = parser.parse_args()
+
+    with open(args.imat, "rb") as f:
+        A = np.load(f)
+    points = np.array(SPOT_POSITIONS)
+    load_s2z(A, args.imat, rcond=S2Z_RCOND, reg=S2Z_REG, n_trunc=S2Z_NTRUNC,
+             method=S2Z_METHOD, points=points)
+    key = cache_key(A, N_MODES, SCALE, FLIP, np.radians(ROTATION_ANGLE),
+                    S2Z_RCOND, S2Z_REG, S2Z_NTRUNC, S2Z_METHOD, points)
+    fname = cache_path(args.imat, key)
+    print(f"Cached s2z to: {fname}")
+    if args.prune:
+        for removed in prune_cache(os.path.dirname(fname), [fname], args.max_age):
+            print(f"Removed: {removed}")
@@ -0,0 +1,300 @@
+"""Outlier screening of spot positions before reconstruction.
+
+Two checks are run on every frame, vectorized over a batch:
+
+    residual   RMS of the slopes outside the model subspace of the imat,
+               ||C (s - A s2z s)|| / sqrt(2*n_spots), where C removes the mean x
+               and y slope. Frames that no Zernike wavefront can explain, such
+               as frames with swapped spots, have large residuals.
+    jump       largest distance of a spot from its median position over the
+               previous frames of the stream.
+
+Frames that fail either check are optionally repaired by trying every
+permutation of the spot order and keeping the one closest to the recent
+positions (or, without history, the one with the smallest residual). Frames
+that still fail get return code 6 (residual) or 7 (jump).
+
+Only accepted frames, as repaired, enter the history, so swapped or rejected
+frames do not pull the median toward themselves. If `history` frames in a row
+are rejected only for jumping, the spots are taken to have really moved and
+those frames become the new history.
+
+A batch gives the same result as screening its frames one at a time. The
+windows of a batch are first computed as if every frame were accepted as is;
+the frames up to the first one that is not are final, and the rest of the
+batch is screened again against the history they leave.
+"""
+import itertools
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from config import *
+from spots2zern import subtract_mean
+
+RC_RESIDUAL = 6  # slopes do not fit the Zernike model
+RC_JUMP = 7      # spots jumped from recent frames
+
+# Largest number of coordinates for which the residual projector is kept as a
+# dense (2*n_spots, 2*n_spots) matrix. Larger sensors apply it in factored
+# form, which costs O(n_spots * n_modes) per frame instead of O(n_spots**2).
+DENSE_PROJECTOR_MAX = 64
+
+class FrameScreen:
+    """Screens frames of one stream. Keeps the recent frames of the stream, so
+    use one FrameScreen per connection or log.
+    """
+
+    def __init__(self, recon, max_residual=SCREEN_RESIDUAL, max_jump=SCREEN_JUMP,
+                 history=SCREEN_HISTORY, repair=SCREEN_REPAIR):
+        """Initializes the screen.
+
+        Parameters
+        ----------
+        recon: ZernikeReconstructor
+            Reconstructor whose imat defines the model subspace.
+        max_residual: float, optional
+            Maximum RMS slope residual in pixels. None disables the check.
+        max_jump: float, optional
+            Maximum distance of a spot from its recent median position in
+            pixels. None disables the check.
+        history: int, optional
+            Number of previous frames the median position is taken over.
+        repair: bool, optional
+            Try to repair failed frames by reordering the spots. Only done for
+            up to SCREEN_MAX_PERMUTE spots.
+        """
+        self.recon = recon
+        self.max_residual = max_residual
+        self.max_jump = max_jump
+        self.history = history
+        n_spots = recon.n_spots
+        self.perms = None
+        if repair and n_spots <= SCREEN_MAX_PERMUTE:
+            perms = np.array(list(itertools.permutations(range(n_spots))))
+            # Coordinate indices of every spot permutation, identity first
+            self.perms = np.stack((2 * perms, 2 * perms + 1), axis=-1).reshape(len(perms), -1)
+        self._recent = np.zeros((0, 2 * n_spots))
+        self._moved = np.zeros((0, 2 * n_spots))  # frames rejected since the last accepted one
+        self._calibration = None
+        self._R = self._r0 = self._factors = None
+        self.n_repaired = 0
+
+    def _projector(self):
+        """Returns R and r0 such that R coords - r0 are the slope residuals
+        C (s - A s2z s) of the current calibration, rebuilt when it is swapped.
+        R is None for sensors with more than DENSE_PROJECTOR_MAX coordinates;
+        use _factors instead.
+        """
+        calibration = self.recon.calibration
+        if calibration is not self._calibration:
+            A, s2z, cal = calibration
+            # C A: remove the mean x and y slope from every column of A
+            A_c = np.asarray(A, dtype=float).reshape(2, -1, A.shape[1])
+            A_c = (A_c - A_c.mean(axis=1, keepdims=True)).reshape(A.shape)
+            if len(A) <= DENSE_PROJECTOR_MAX:
+                P = np.eye(len(A)) - np.dot(A_c, s2z)
+                # subtract_mean is linear, so it folds into the projector
+                M = subtract_mean(np.eye(len(A)))
+                self._R = np.dot(P, M.T)
+                self._r0 = np.dot(P, cal)
+            else:
+                self._R = self._r0 = None
+                self._factors = (A_c, np.asarray(s2z), cal)
+            self._calibration = calibration
+        return self._R, self._r0
+
+    def residuals(self, coords):
+        """Returns the RMS slope residual of every frame in pixels.
+
+        Parameters
+        ----------
+        coords: nd_array of shape (..., 2*n_spots)
+            Spot positions formatted as [x1, y1, ..., xn, yn].
+        """
+        R, r0 = self._projector()
+        if R is not None:
+            res = np.dot(coords, R.T) - r0
+        else:
+            # s - C A s2z s, since s is already free of mean slopes
+            A_c, s2z, cal = self._factors
+            res = subtract_mean(coords) - cal
+            res -= np.dot(np.dot(res, s2z.T), A_c.T)
+        return np.sqrt(np.einsum("...i,...i->...", res, res) / res.shape[-1])
+
+    def _references(self, coords):
+        """Returns the median position over the history and the frames of the
+        batch before each frame, NaN where there is no history yet.
+        """
+        n_pad = self.history - len(self._recent)
+        if len(coords) == 1:
+            # Fast path for frames screened one at a time; np.median has a
+            # large fixed overhead
+            k = len(self._recent)
+            if k:
+                srt = np.sort(self._recent, axis=0)
+                ref = 0.5 * (srt[(k - 1) // 2] + srt[k // 2])[None]
+            else:
+                ref = np.full(coords.shape, np.nan)
+        else:
+            recent = np.concatenate((np.full((n_pad, coords.shape[1]), np.nan),
+                                     self._recent, coords))
+            # windows[k] holds the frames before coords[k]
+            windows = sliding_window_view(recent[:-1], self.history, axis=0)
+            # The windows of the first frames of a stream are padded with NaN
+            n_nan = len(coords) if not np.isfinite(coords).all() else min(n_pad, len(coords))
+            ref = np.empty(coords.shape)
+            ref[n_nan:] = np.median(windows[n_nan:], axis=-1)
+            if n_nan:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", RuntimeWarning)  # no history yet
+                    ref[:n_nan] = np.nanmedian(windows[:n_nan], axis=-1)
+        return ref
+
+    def _remember(self, coords, rc):
+        """Adds the accepted frames of a screened batch, as repaired, to the
+        history. Frames rejected only for jumping after the last accepted one
+        are kept aside, and replace the history once there are enough of them.
+        """
+        if len(rc) == 1:
+            # Fast path for frames screened one at a time
+            if rc[0] not in (0, RC_JUMP) or not np.isfinite(coords).all():
+                return
+            if rc[0] == 0:
+                self._recent = np.concatenate((self._recent, coords))[-self.history:]
+                self._moved = self._moved[:0]
+                return
+            self._moved = np.concatenate((self._moved, coords))[-self.history:]
+            if len(self._moved) == self.history:
+                self._recent, self._moved = self._moved, self._moved[:0]
+            return
+
+        finite = np.isfinite(coords).all(axis=1)
+        ok = (rc == 0) & finite
+        moved = (rc == RC_JUMP) & finite
+        accepted = np.flatnonzero(ok)
+        if len(accepted):
+            self._recent = np.concatenate((self._recent, coords[ok]))[-self.history:]
+            moved[:accepted[-1]] = False
+            self._moved = coords[moved][-self.history:]
+        else:
+            self._moved = np.concatenate((self._moved, coords[moved]))[-self.history:]
+        if len(self._moved) == self.history:
+            self._recent, self._moved = self._moved, self._moved[:0]
+
+    @staticmethod
+    def _jumps(coords, ref):
+        d = (coords - ref).reshape(coords.shape[:-1] + (-1, 2))
+        return np.sqrt((d**2).sum(axis=-1)).max(axis=-1)
+
+    def screen(self, coords):
+        """Screens a stack of frames.
+
+        Parameters
+        ----------
+        coords: nd_array of shape (n_frames, 2*n_spots)
+            Spot positions formatted as [x1, y1, ..., xn, yn], in stream order.
+
+        Returns
+        -------
+        rc: nd_array of shape (n_frames)
+            0, RC_RESIDUAL or RC_JUMP.
+        coords: nd_array of shape (n_frames, 2*n_spots)
+            The input with repaired frames reordered.
+        """
+        coords = np.array(coords, dtype=float, ndmin=2)
+        rc = np.zeros(len(coords), dtype=int)
+        check_jump = self.max_jump is not None
+        check_residual = self.max_residual is not None
+        if not (check_jump or check_residual) or not len(coords):
+            return rc, coords
+
+        bad_residual = self.residuals(coords) > self.max_residual if check_residual else None
+        if not check_jump or len(coords) == 1:
+            # Frames do not depend on each other
+            rc, coords, repaired = self._screen_chunk(coords, bad_residual)
+            self.n_repaired += int(np.count_nonzero(repaired))
+            if check_jump:
+                self._remember(coords, rc)
+            return rc, coords
+
+        # The history of each frame depends on the verdicts before it. Screen
+        # as if every frame were accepted as is, keep the frames up to the first
+        # one that is not, and go on from there. After a failure, the next
+        # chunks start small and grow again while frames are accepted.
+        start, size = 0, len(coords)
+        while start < len(coords):
+            stop = min(start + size, len(coords))
+            chunk_rc, chunk, repaired = self._screen_chunk(
+                coords[start:stop], bad_residual[start:stop] if check_residual else None)
+            clean = (chunk_rc == 0) & ~repaired & np.isfinite(chunk).all(axis=1)
+            n = len(chunk) if clean.all() else int(np.argmin(clean)) + 1
+            rc[start:start + n] = chunk_rc[:n]
+            coords[start:start + n] = chunk[:n]
+            self.n_repaired += int(np.count_nonzero(repaired[:n]))
+            self._remember(chunk[:n], chunk_rc[:n])
+            start += n
+            size = 2 * size if n == len(chunk) else max(2 * n, 16)
+        return rc, coords
+
+    def _screen_chunk(self, coords, bad_residual):
+        """Screens frames against the current history without updating it.
+
+        Returns
+        -------
+        rc: nd_array of shape (n_frames)
+        coords: nd_array of shape (n_frames, 2*n_spots)
+            The input, or a copy of it with repaired frames reordered.
+        repaired: nd_array of shape (n_frames)
+            True for the repaired frames.
+        """
+        check_jump = self.max_jump is not None
+        check_residual = self.max_residual is not None
+        rc = np.zeros(len(coords), dtype=int)
+        repaired = np.zeros(len(coords), dtype=bool)
+        ref = self._references(coords) if check_jump else None
+        bad = self._failures(coords, ref, bad_residual)
+        if self.perms is not None and bad.any():
+            idx = np.flatnonzero(bad.any(axis=0))
+            candidates = coords[idx][:, self.perms]  # (n_bad, n_perms, 2*n_spots)
+            has_ref = np.isfinite(ref[idx]).all(axis=1) if check_jump else np.zeros(len(idx), bool)
+            scores = np.where(has_ref[:, None],
+                              self._jumps(candidates, ref[idx][:, None]) if check_jump else 0,
+                              self.residuals(candidates) if check_residual else 0)
+            best = candidates[np.arange(len(idx)), np.argmin(scores, axis=1)]
+            fixed = ~self._failures(best, ref[idx] if check_jump else None).any(axis=0)
+            coords = coords.copy()
+            coords[idx[fixed]] = best[fixed]
+            bad[:, idx[fixed]] = False
+            repaired[idx[fixed]] = True
+
+        rc[bad[1]] = RC_JUMP
+        rc[bad[0]] = RC_RESIDUAL
+        return rc, coords, repaired
+
+    def _failures(self, coords, ref, bad_residual=None):
+        """Returns masks of the frames failing the residual and jump checks,
+        stacked as shape (2, n_frames). bad_residual is the residual mask if
+        already known.
+        """
+        bad = np.zeros((2, len(coords)), dtype=bool)
+        if bad_residual is not None:
+            bad[0] = bad_residual
+        elif self.max_residual is not None:
+            bad[0] = self.residuals(coords) > self.max_residual
+        if ref is not None:
+            with np.errstate(invalid="ignore"):
+                bad[1] = self._jumps(coords, ref) > self.max_jump  # NaN without history
+        return bad
+
+    def screen_frame(self, coords):
+        """Screens a single frame. Returns (rc, coords).
+        """
+        rc, coords = self.screen(np.asarray(coords, dtype=float)[None])
+        return int(rc[0]), coords[0]
+
+def make_screen(recon, max_residual=SCREEN_RESIDUAL, max_jump=SCREEN_JUMP, **kwargs):
+    """Returns a FrameScreen, or None if both checks are disabled.
+    """
+    if max_residual is None and max_jump is None:
+        return None
+    return FrameScreen(recon, max_residual, max_jump, **kwargs)
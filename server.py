@@ -0,0 +1,489 @@
+import argparse
+import asyncio
+import signal
+import sys
+import time
+import numpy as np
+from config import *
+from metrics import METRICS, serve_metrics
+from protocol import (BINARY_MAGIC, FRAME_HEADER, parse_felixdata_sensor, unpack_frame_header,
+                      pack_reply)
+from calibration import OnlineCalibrator
+from registry import ReconstructorRegistry, load_sensors
+from spots2zern import ZernikeReconstructor, reconstruct_batch, format_return_code, format_coeffs
+from screening import make_screen
+from zfilter import make_filter
+
+class StreamState:
+    """State of one connection: the temporal filter and outlier screen of each
+    sensor it sends frames for, and what its frames are used for in
+    calibration (None, "ref" or a (mode, amplitude) poke).
+    """
+
+    def __init__(self, filter_spec, max_residual, max_jump):
+        self.filter_spec = filter_spec
+        self.max_residual = max_residual
+        self.max_jump = max_jump
+        self.cal = None
+        self._streams = {}
+
+    def get(self, name, recon):
+        """Returns (zfilter, screen) of a sensor, either of which may be None.
+        They are rebuilt if the reconstructor of the sensor was replaced.
+        """
+        stream = self._streams.get(name)
+        if stream is None or stream[0] is not recon:
+            stream = self._streams[name] = (
+                recon, make_filter(self.filter_spec, recon.n_modes),
+                make_screen(recon, self.max_residual, self.max_jump))
+        return stream[1:]
+
+    def set_filter(self, spec, n_modes):
+        """Replaces the filter of every sensor of the connection.
+
+        Raises
+        ------
+        ValueError
+            If the spec cannot be parsed.
+        """
+        make_filter(spec, n_modes)
+        self.filter_spec = spec
+        self._streams = {name: (recon, make_filter(spec, recon.n_modes), screen)
+                         for name, (recon, _, screen) in self._streams.items()}
+
+class FrameBatcher:
+    """Collects the frames of one sensor from every connection and
+    reconstructs them with one reconstruct_batch call per event loop
+    iteration.
+    """
+
+    def __init__(self, recon):
+        self.recon = recon
+        self._pending = []
+
+    def submit(self, coords):
+        """Queues a frame of the expected size. Returns a future of (rc, a_z).
+        """
+        loop = asyncio.get_running_loop()
+        if not self._pending:
+            loop.call_soon(self._flush)
+        future = loop.create_future()
+        self._pending.append((coords, future))
+        return future
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        try:
+            rc, a_z = reconstruct_batch(self.recon, np.stack([coords for coords, _ in pending]))
+        except Exception as e:
+            # Fail the frames instead of leaving their clients waiting
+            print(f"Reconstruction of {len(pending)} frames failed: {e!r}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for k, (_, future) in enumerate(pending):
+            if not future.done():
+                future.set_result((int(rc[k]), a_z[k]))
+
+class ReconstructionServer:
+    """Long-lived TCP server that converts felixdata messages to Zernike
+    coefficients.
+
+    Reconstructors are kept in a ReconstructorRegistry (see registry.py) and
+    shared by every connection, so each imat is only loaded once. Frames are
+    routed by their sensor ID, and frames of the same sensor that arrive
+    together from different connections are reconstructed as one batch. Each
+    line received is answered with the same RC/MSG/Z* block printed by
+    spots2zern.py. Clients may instead use the binary format described in
+    protocol.py.
+
+    Every connection gets its own temporal filter (see zfilter.py), built from
+    filter_spec. Text clients can replace it by sending "FILTER <spec>".
+    Every connection also gets its own outlier screen (see screening.py).
+
+    Text clients recalibrate a sensor live (see calibration.py) with
+
+        CAL REF                   following frames are reference frames
+        CAL POKE <mode> <amp> [<sensor>]
+                                  following frames have amplitude amp on the
+                                  mode-th coefficient (1 = tip); RC 5 if the
+                                  sensor has fewer modes
+        CAL OFF                   following frames are not used
+        CAL COMMIT [<sensor>]     swap the new CAL_SLOPES and imat in
+        CAL RESET [<sensor>]      discard the collected frames
+
+    Frames of any connection in REF or POKE mode are collected per sensor, and
+    only those answered with RC 0 are used. Poke frames are measured against
+    the reference frames collected for the sensor, if any.
+    """
+
+    def __init__(self, recon=None, logger=None, filter_spec=ZFILTER,
+                 max_residual=SCREEN_RESIDUAL, max_jump=SCREEN_JUMP, registry=None):
+        """Initializes the server.
+
+        Parameters
+        ----------
+        recon: ZernikeReconstructor, optional
+            Reconstructor of the default sensor. A new one is created from
+            config.py if not given.
+        logger: framelog.FrameLogger, optional
+            Logs every frame of the default sensor with the expected number of
+            coordinates. The logged coefficients are the unfiltered ones.
+        filter_spec: str, optional
+            Default temporal filter of each connection, see zfilter.make_filter.
+        max_residual, max_jump: float, optional
+            Outlier screening thresholds in pixels, see screening.FrameScreen.
+        registry: ReconstructorRegistry, optional
+            Sensors to serve. Built from SENSORS in config.py if not given.
+        """
+        if registry is None:
+            registry = ReconstructorRegistry(default=recon)
+        self.registry = registry
+        self.recon = registry.get()
+        self.logger = logger
+        make_filter(filter_spec, self.recon.n_modes)  # fail at startup on a bad spec
+        self.filter_spec = filter_spec
+        self.max_residual = max_residual
+        self.max_jump = max_jump
+        self._batchers = {}
+        self._calibrators = {}
+        self._sensor_errors = {}
+
+    def _batcher(self, name, recon):
+        batcher = self._batchers.get(name)
+        if batcher is None or batcher.recon is not recon:
+            batcher = self._batchers[name] = FrameBatcher(recon)
+        return batcher
+
+    async def _get_recon(self, sensor):
+        """Returns (name, reconstructor) of a sensor. A reconstructor that is
+        not loaded yet is built in an executor, so its imat and s2z do not stall
+        the other connections.
+
+        Raises
+        ------
+        KeyError
+            If the sensor is unknown or its reconstructor cannot be built, e.g.
+            because its imat is missing. The reason is printed once.
+        """
+        name = self.registry.resolve(sensor)
+        recon = self.registry.cached(name)
+        if recon is not None:
+            return name, recon
+        try:
+            recon = await asyncio.get_running_loop().run_in_executor(None, self.registry.get, name)
+            return name, recon
+        except (OSError, ValueError) as e:
+            if str(e) != self._sensor_errors.get(name):
+                print(f"Cannot load sensor {name}: {e}")
+                self._sensor_errors[name] = str(e)
+            raise KeyError(name)
+
+    def _calibrator(self, name, recon):
+        calibrator = self._calibrators.get(name)
+        if calibrator is None or calibrator.recon is not recon:
+            calibrator = self._calibrators[name] = OnlineCalibrator(recon)
+        return calibrator
+
+    def _add_calibration_frame(self, name, recon, cal, coords):
+        """Adds a frame to the calibrator of a sensor, see StreamState.cal.
+        """
+        calibrator = self._calibrator(name, recon)
+        if cal == "ref":
+            calibrator.add_reference(coords)
+            return
+        mode, amp = cal
+        if mode <= recon.n_modes:
+            a_z = np.zeros(recon.n_modes)
+            a_z[mode - 1] = amp
+            calibrator.add_poke(a_z, coords)
+
+    async def handle_cal(self, args, stream):
+        """Handles the words after "CAL" of a calibration command, see the
+        class docstring. Returns the return code of the reply.
+        """
+        command = args[0].upper() if args else ""
+        if command in ("REF", "OFF") and len(args) == 1:
+            stream.cal = "ref" if command == "REF" else None
+            return 0
+        if command == "POKE" and len(args) in (3, 4):
+            try:
+                mode, amp = int(args[1]), float(args[2])
+            except ValueError:
+                return 5
+            try:
+                _, recon = await self._get_recon(args[3] if len(args) == 4 else None)
+            except KeyError:
+                return 8
+            if not 1 <= mode <= recon.n_modes or not np.isfinite(amp):
+                return 5
+            stream.cal = (mode, amp)
+            return 0
+        if command not in ("COMMIT", "RESET") or len(args) > 2:
+            return 5
+
+        try:
+            name, recon = await self._get_recon(args[1] if len(args) == 2 else None)
+        except KeyError:
+            return 8
+        if command == "RESET":
+            self._calibrators.pop(name, None)
+            return 0
+        calibrator = self._calibrators.get(name)
+        if calibrator is None or calibrator.recon is not recon or \
+           not (calibrator.reference.n or calibrator.imat.n):
+            return 1  # no frames collected
+        # s2z is recomputed from the new imat, which may take a while for
+        # large sensors
+        await asyncio.get_running_loop().run_in_executor(None, calibrator.commit)
+        self.registry.pin(name)
+        print(f"Committed calibration of sensor {name}: {calibrator.reference.n} reference "
+              f"frames, {calibrator.imat.n} poke frames")
+        return 0
+
+    async def handle_coords(self, coords, timestamp=0., sensor=None, stream=None):
+        """Returns the return code and Zernike coefficients for one frame.
+
+        Parameters
+        ----------
+        coords: nd_array
+            Spot positions formatted as [x1, y1, ..., xn, yn].
+        timestamp: float, optional
+        sensor: str or int, optional
+            Sensor name or ID, None for the default sensor.
+        stream: StreamState, optional
+            Connection whose filter and screen are applied.
+        """
+        try:
+            name, recon = await self._get_recon(sensor)
+        except KeyError:
+            return 8, np.zeros(self.recon.n_modes)  # unknown or broken sensor
+        a_z = np.zeros(recon.n_modes)
+        if len(coords) == 0:
+            return 1, a_z
+        if len(coords) != 2 * recon.n_spots:
+            return 3, a_z  # N_SPOTS doesn't match number of points
+
+        if METRICS.enabled:
+            METRICS.frames.inc(name)
+        m = METRICS.sample("handle_coords")
+        if m:
+            t = time.perf_counter_ns()
+
+        zfilter, screen = stream.get(name, recon) if stream is not None else (None, None)
+        rc, screened = (0, coords) if screen is None else screen.screen_frame(coords)
+        if m and screen is not None:
+            t = m.lap("screen", "frame", t)
+        if rc == 0:
+            try:
+                rc, a_z = await self._batcher(name, recon).submit(screened)
+            except Exception:
+                rc = 9  # reported by FrameBatcher._flush
+            if m:
+                t = m.lap("batch_wait", "frame", t)
+        if stream is not None and stream.cal is not None and rc == 0:
+            self._add_calibration_frame(name, recon, stream.cal, screened)
+        if self.logger is not None and name == self.registry.default_name:
+            self.logger.log(timestamp, coords, rc, a_z)
+            if m:
+                t = m.lap("log", "frame", t)
+        if zfilter is not None and rc == 0:
+            a_z = zfilter.update(a_z)
+            if m:
+                m.lap("filter", "frame", t)
+        return rc, a_z
+
+    async def handle_line(self, line, stream=None):
+        """Returns the reply to a single felixdata line.
+        """
+        m = METRICS.sample("handle_line")
+        if m:
+            t = time.perf_counter_ns()
+        try:
+            sensor, timestamp, coords = parse_felixdata_sensor(line)
+        except ValueError:
+            rc, a_z = 5, np.zeros(self.recon.n_modes)
+        else:
+            if m:
+                t = m.lap("parse", "frame", t)
+            rc, a_z = await self.handle_coords(coords, timestamp, sensor, stream)
+            if m:
+                t = time.perf_counter_ns()
+        reply = format_return_code(rc) + "\n" + format_coeffs(a_z) + "\n"
+        if m:
+            m.lap("format", "frame", t)
+        if METRICS.enabled:
+            METRICS.return_codes.inc(rc)
+        return reply
+
+    async def handle_client(self, reader, writer):
+        """Answers every frame sent on a connection until the client closes it.
+        The protocol is chosen from the first two bytes.
+        """
+        stream = StreamState(self.filter_spec, self.max_residual, self.max_jump)
+        try:
+            # A short text message such as a bare newline may end before two
+            # bytes arrive, so only keep reading while the bytes could still be
+            # the binary magic
+            first = await reader.read(len(BINARY_MAGIC))
+            while first and len(first) < len(BINARY_MAGIC) and BINARY_MAGIC.startswith(first):
+                more = await reader.read(len(BINARY_MAGIC) - len(first))
+                if not more:
+                    break
+                first += more
+            if not first:
+                return  # closed before sending anything, e.g. a health check
+            binary = first == BINARY_MAGIC
+            if METRICS.enabled:
+                METRICS.connections.inc("binary" if binary else "text")
+            if binary:
+                await self._serve_binary(reader, writer, first, stream)
+            else:
+                await self._serve_text(reader, writer, first, stream)
+        except asyncio.IncompleteReadError:
+            if METRICS.enabled:
+                METRICS.dropped.inc()
+        except ConnectionError:
+            if METRICS.enabled:
+                METRICS.dropped.inc()
+        finally:
+            writer.close()
+
+    async def _serve_text(self, reader, writer, prefix=b"", stream=None):
+        """Answers felixdata lines. A line "FILTER <spec>" replaces the filter
+        of the connection and lines "CAL ..." are calibration commands; both
+        are answered with a return code only.
+        """
+        while True:
+            # The prefix may already hold a whole line, e.g. a bare newline
+            line = prefix if prefix.endswith(b"\n") else prefix + await reader.readline()
+            prefix = b""
+            if not line:
+                break
+            line = line.decode(errors="replace").strip()
+            if not line:
+                continue
+            if line.upper().startswith("FILTER"):
+                try:
+                    stream.set_filter(line[len("FILTER"):], self.recon.n_modes)
+                    reply = format_return_code(0) + "\n"
+                except ValueError:
+                    reply = format_return_code(5) + "\n"
+                writer.write(reply.encode())
+                await writer.drain()
+                continue
+            words = line.split()
+            if words[0].upper() == "CAL":
+                rc = await self.handle_cal(words[1:], stream)
+                writer.write((format_return_code(rc) + "\n").encode())
+                await writer.drain()
+                continue
+            writer.write((await self.handle_line(line, stream)).encode())
+            await writer.drain()
+
+    async def _serve_binary(self, reader, writer, prefix=b"", stream=None):
+        """Answers binary frames. Replies are written in the order the frames
+        arrive, so clients can pipeline many frames before reading.
+        """
+        while True:
+            try:
+                header = prefix + await reader.readexactly(FRAME_HEADER.size - len(prefix))
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise
+                break
+            prefix = b""
+            try:
+                dtype, n_spots, timestamp, sensor_id = unpack_frame_header(header)
+            except ValueError:
+                # The stream can no longer be framed, so reply and hang up
+                if METRICS.enabled:
+                    METRICS.return_codes.inc(5)
+                writer.write(pack_reply(5, 0., np.zeros(self.recon.n_modes)))
+                await writer.drain()
+                break
+            payload = await reader.readexactly(2 * n_spots * dtype.itemsize)
+            rc, a_z = await self.handle_coords(np.frombuffer(payload, dtype=dtype), timestamp,
+                                               sensor_id, stream)
+            if METRICS.enabled:
+                METRICS.return_codes.inc(rc)
+            writer.write(pack_reply(rc, timestamp, a_z, sensor_id))
+            await writer.drain()
+
+    async def _evict_idle(self):
+        """Periodically drops the reconstructors of idle sensors.
+        """
+        interval = min(self.registry.idle_seconds / 2, 60)
+        while True:
+            await asyncio.sleep(interval)
+            for name in self.registry.evict_idle():
+                self._batchers.pop(name, None)
+                print(f"Evicted idle sensor {name}")
+
+    async def serve(self, host=HOST, port=DEFAULT_PORT, metrics_port=None):
+        """Listens on host:port until cancelled. If metrics_port is given, the
+        metrics are served on localhost:metrics_port, see metrics.py.
+        """
+        server = await asyncio.start_server(self.handle_client, host, port)
+        addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"Serving on {addrs}")
+        tasks = []
+        if self.registry.idle_seconds is not None:
+            tasks.append(asyncio.create_task(self._evict_idle()))
+        if metrics_port is not None:
+            tasks.append(asyncio.create_task(serve_metrics("127.0.0.1", metrics_port)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FELIX slopes to Zernikes server")
+    parser.add_argument("--host", type=str, default=HOST, help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--imat", type=str, default=None, help="Override IMAT_FNAME")
+    parser.add_argument("--log-dir", type=str, default=None,
+                        help="Log every frame to FITS segments in this directory")
+    parser.add_argument("--log-tag", type=str, default="server", help="Tag of the log segment names")
+    parser.add_argument("--filter", type=str, default=ZFILTER,
+                        help="Temporal filter of each connection, e.g. ema:0.3, kalman:1e-4,1e-2 "
+                             "or predict:4,0.99 (default: ZFILTER)")
+    parser.add_argument("--max-residual", type=float, default=SCREEN_RESIDUAL,
+                        help="Reject frames whose RMS slope residual exceeds this many pixels")
+    parser.add_argument("--max-jump", type=float, default=SCREEN_JUMP,
+                        help="Reject frames whose spots moved more than this many pixels "
+                             "from their recent median position")
+    parser.add_argument("--sensors", type=str, default=None,
+                        help="JSON file of sensor configurations (default: SENSORS)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help=f"Serve metrics over HTTP on this port, e.g. {METRICS_PORT}")
+    parser.add_argument("--idle-seconds", type=float, default=REGISTRY_IDLE_SECONDS,
+                        help="Evict reconstructors of sensors idle for this long")
+    args = parser.parse_args()
+
+    recon = ZernikeReconstructor(imat_fname=args.imat)
+    sensors = SENSORS if args.sensors is None else load_sensors(args.sensors)
+    registry = ReconstructorRegistry(sensors, recon, idle_seconds=args.idle_seconds)
+    errors = registry.check()
+    if errors:
+        parser.error("\n".join(f"sensor {name}: {e}" for name, e in errors.items()))
+    logger = None
+    if args.log_dir is not None:
+        from framelog import FrameLogger
+        logger = FrameLogger(args.log_dir, args.log_tag, 2 * recon.n_spots, recon.n_modes)
+
+    server = ReconstructionServer(recon, logger, args.filter, args.max_residual, args.max_jump,
+                                  registry)
+    # Exit through the finally block below so buffered frames are written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.metrics_port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if logger is not None:
+            logger.close()
@@ -0,0 +1,315 @@
+"""Shared-memory ring buffers between the spot finder and the reconstructor.
+
+A ring holds n_slots fixed-size float64 slots laid out as
+
+    [seq, timestamp, v1, ..., v_width]
+
+behind a small int64 header [magic, n_slots, width, write_count]. There is a
+single writer per ring. The writer marks a slot as busy (seq = -1), fills it,
+then publishes it by writing its seq and setting write_count to it. Slot seq
+lives in slot (seq - 1) % n_slots, and is write_count + 1 unless the writer
+skips some.
+Readers keep their own position and detect both overruns (the writer lapped
+them) and torn reads (a slot was rewritten while it was being read) from seq.
+
+The input ring carries [x1, y1, ..., xn, yn] per frame and the output ring
+carries [rc, a_1, ..., a_n_modes], with the same seq and timestamp as the frame
+they answer. The writer of the output ring skips the seq of frames it never
+saw (overruns, torn reads), so a reader of the output ring counts them in
+dropped like any other gap.
+"""
+import argparse
+import signal
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from config import *
+
+RING_MAGIC = 0x46454C4958524E47  # "FELIXRNG"
+HEADER_SIZE = 4
+
+class SlotRing:
+    """Fixed-size slots in a named shared memory block.
+    """
+
+    def __init__(self, shm, owner):
+        """Use SlotRing.create or SlotRing.attach instead.
+        """
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        if self.header[0] != RING_MAGIC:
+            raise ValueError(f"shared memory {shm.name!r} is not a slot ring")
+        self.n_slots = int(self.header[1])
+        self.width = int(self.header[2])
+        self.slots = np.ndarray((self.n_slots, 2 + self.width), dtype=np.float64,
+                                buffer=shm.buf, offset=8 * HEADER_SIZE)
+
+    @classmethod
+    def create(cls, name, n_slots, width):
+        """Creates a new ring. The creator unlinks it on close.
+
+        Parameters
+        ----------
+        name: str
+            Name of the shared memory block, or None for a random name.
+        n_slots: int
+            Number of slots.
+        width: int
+            Number of float64 values per slot, not counting seq and timestamp.
+        """
+        size = 8 * (HEADER_SIZE + n_slots * (2 + width))
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        header[:] = [RING_MAGIC, n_slots, width, 0]
+        np.ndarray((n_slots, 2 + width), dtype=np.float64, buffer=shm.buf,
+                   offset=8 * HEADER_SIZE)[:, 0] = 0
+        del header
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attaches to an existing ring.
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        # Only the creator should unlink the block when it exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def write_count(self):
+        return int(self.header[3])
+
+    def write(self, timestamp, values, seq=None):
+        """Publishes one slot. Returns its sequence number.
+
+        seq defaults to the next one, see write_many.
+        """
+        count = int(self.header[3])
+        if seq is None:
+            seq = count + 1
+        elif seq <= count:
+            raise ValueError(f"seq must increase from write_count {count}")
+        slot = self.slots[(seq - 1) % self.n_slots]
+        slot[0] = -1
+        slot[2:] = values
+        slot[1] = timestamp
+        slot[0] = seq
+        self.header[3] = seq
+        return seq
+
+    def write_many(self, timestamps, values, seq=None):
+        """Publishes one slot per row of values. Returns the sequence numbers.
+
+        Parameters
+        ----------
+        timestamps: nd_array of shape (n)
+        values: nd_array of shape (n, width)
+        seq: nd_array of shape (n), optional
+            Increasing sequence numbers after write_count, e.g. those of the
+            frames answered. The slots of skipped numbers are left alone, so
+            readers see them as dropped. Consecutive from write_count + 1 by
+            default.
+
+        Raises
+        ------
+        ValueError
+            If seq is not increasing or does not come after write_count.
+        """
+        count = int(self.header[3])
+        if seq is None:
+            seq = count + 1 + np.arange(len(timestamps))
+        else:
+            seq = np.asarray(seq, dtype=np.int64)
+            if len(seq) and (seq[0] <= count or np.any(np.diff(seq) <= 0)):
+                raise ValueError(f"seq must increase from write_count {count}")
+        if not len(seq):
+            return seq
+        # Only the last n_slots sequence numbers can still be read
+        keep = seq > seq[-1] - self.n_slots
+        idx = (seq[keep] - 1) % self.n_slots
+        self.slots[idx, 0] = -1
+        self.slots[idx, 2:] = np.asarray(values)[keep]
+        self.slots[idx, 1] = np.asarray(timestamps)[keep]
+        self.slots[idx, 0] = seq[keep]
+        self.header[3] = seq[-1]
+        return seq
+
+    def close(self):
+        """Detaches from the ring, and unlinks it if this process created it.
+        """
+        self.header = self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class RingReader:
+    """Reads the slots published to a SlotRing since the last poll.
+    """
+
+    def __init__(self, ring, from_start=False):
+        """Initializes the reader.
+
+        Parameters
+        ----------
+        ring: SlotRing
+            Ring to read.
+        from_start: bool, optional
+            Start from the oldest slot still in the ring instead of the newest.
+        """
+        self.ring = ring
+        count = ring.write_count
+        self.next = max(count - ring.n_slots, 0) if from_start else count
+        self.dropped = 0
+
+    def poll(self, max_slots=None):
+        """Returns the slots published since the last poll.
+
+        The slots are returned as views into shared memory when they do not wrap
+        around the end of the ring. Pass the returned seq to valid() after using
+        the data to discard slots that were overwritten in the meantime.
+
+        Returns
+        -------
+        seq: nd_array of shape (n)
+            Sequence numbers of the slots.
+        timestamps: nd_array of shape (n)
+        values: nd_array of shape (n, width)
+        """
+        ring = self.ring
+        count = ring.write_count
+        if count - self.next > ring.n_slots:
+            # The writer lapped us
+            self.dropped += count - ring.n_slots - self.next
+            self.next = count - ring.n_slots
+        stop = count if max_slots is None else min(count, self.next + max_slots)
+
+        start_idx = self.next % ring.n_slots
+        n = stop - self.next
+        if start_idx + n <= ring.n_slots:
+            block = ring.slots[start_idx:start_idx + n]
+        else:
+            block = ring.slots[(self.next + np.arange(n)) % ring.n_slots]
+        expected = self.next + 1 + np.arange(n)
+        self.next = stop
+
+        # Slots that were being rewritten while we looked at them
+        ok = block[:, 0] == expected
+        if not ok.all():
+            self.dropped += int(np.count_nonzero(~ok))
+            block = block[ok]
+            expected = expected[ok]
+        return expected, block[:, 1], block[:, 2:]
+
+    def valid(self, seq):
+        """Returns a mask of the slots in seq that still hold the same data.
+        """
+        ring = self.ring
+        return ring.slots[(seq - 1) % ring.n_slots, 0] == seq
+
+def run_reconstructor(recon, in_ring, out_ring, stop=None, poll_interval=0.0001,
+                      max_batch=None, zfilter=None, screen=None):
+    """Reconstructs every frame published to in_ring and publishes
+    [rc, a_1, ..., a_n_modes] to out_ring with the seq and timestamp of the
+    frame.
+
+    Frames that arrive together are reconstructed as one batch.
+
+    Parameters
+    ----------
+    recon: ZernikeReconstructor
+        The resident reconstructor.
+    in_ring: SlotRing
+        Ring of spot positions, width 2*n_spots.
+    out_ring: SlotRing
+        Ring of results, width 1 + n_modes.
+    stop: threading.Event or multiprocessing.Event, optional
+        Loop until this is set. Loop forever if not given.
+    poll_interval: float, optional
+        Seconds to sleep when no new frame is available. 0 to busy-wait.
+    max_batch: int, optional
+        Maximum number of frames reconstructed at once.
+    zfilter: filter object, optional
+        Temporal filter applied to the successful frames, see zfilter.py.
+    screen: screening.FrameScreen, optional
+        Outlier screen applied before reconstruction.
+    """
+    from spots2zern import reconstruct_batch
+    from zfilter import filter_batch
+
+    if in_ring.width != 2 * recon.n_spots or out_ring.width != 1 + recon.n_modes:
+        raise ValueError("ring widths do not match the reconstructor")
+
+    reader = RingReader(in_ring)
+    # Output buffers reused by every batch; a poll returns at most n_slots
+    n_buf = in_ring.n_slots if max_batch is None else max_batch
+    a_z_buf = np.empty((n_buf, recon.n_modes), dtype=recon.dtype)
+    rows = np.empty((n_buf, out_ring.width))
+    while stop is None or not stop.is_set():
+        seq, timestamps, coords = reader.poll(max_batch)
+        if len(seq) == 0:
+            if poll_interval:
+                time.sleep(poll_interval)
+            continue
+
+        n = len(seq)
+        rc, a_z = reconstruct_batch(recon, coords, screen, out=a_z_buf[:n])
+        if zfilter is not None:
+            a_z = filter_batch(zfilter, a_z, rc)
+        rows[:n, 0] = rc
+        rows[:n, 1:] = a_z
+        ok = reader.valid(seq)
+        if ok.all():
+            out_ring.write_many(timestamps, rows[:n], seq)
+        else:
+            reader.dropped += int(np.count_nonzero(~ok))
+            out_ring.write_many(timestamps[ok], rows[:n][ok], seq[ok])
+    return reader.dropped
+
+
+if __name__ == "__main__":
+    from spots2zern import ZernikeReconstructor
+    from screening import make_screen
+    from zfilter import make_filter
+
+    parser = argparse.ArgumentParser(description="Shared-memory FELIX reconstructor")
+    parser.add_argument("--input", type=str, default=SHM_INPUT_NAME, help="Name of the input ring")
+    parser.add_argument("--output", type=str, default=SHM_OUTPUT_NAME, help="Name of the output ring")
+    parser.add_argument("--slots", type=int, default=SHM_SLOTS, help="Number of slots per ring")
+    parser.add_argument("--poll-interval", type=float, default=0.0001,
+                        help="Seconds to sleep when idle, 0 to busy-wait for the lowest latency")
+    parser.add_argument("--imat", type=str, default=None, help="Override IMAT_FNAME")
+    parser.add_argument("--filter", type=str, default=ZFILTER,
+                        help="Temporal filter, e.g. ema:0.3 (default: ZFILTER)")
+    parser.add_argument("--max-residual", type=float, default=SCREEN_RESIDUAL,
+                        help="Reject frames whose RMS slope residual exceeds this many pixels")
+    parser.add_argument("--max-jump", type=float, default=SCREEN_JUMP,
+                        help="Reject frames whose spots moved more than this many pixels "
+                             "from their recent median position")
+    args = parser.parse_args()
+
+    # Exit through the with block below so the rings are unlinked
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    recon = ZernikeReconstructor(args.imat)
+    zfilter = make_filter(args.filter, recon.n_modes)
+    screen = make_screen(recon, args.max_residual, args.max_jump)
+    with SlotRing.create(args.input, args.slots, 2 * recon.n_spots) as in_ring, \
+         SlotRing.create(args.output, args.slots, 1 + recon.n_modes) as out_ring:
+        print(f"Reading frames from {in_ring.name}, writing Zernikes to {out_ring.name}")
+        try:
+            run_reconstructor(recon, in_ring, out_ring, poll_interval=args.poll_interval,
+                              zfilter=zfilter, screen=screen)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,369 @@
+"""Synthetic frames and load generation for the reconstruction server.
+
+Zernike time series are drawn with Kolmogorov variances (Noll 1976) and an
+AR(1) correlation per mode, turned into spot positions through the imat of a
+ZernikeReconstructor, and corrupted with centroid noise, swapped spots and
+dropped spots (NaN). Each of many asyncio clients then sends its own stream to
+a server, together at a fixed total rate and open loop, and the replies are
+checked against the truth:
+
+    python simulate.py --local --clients 16 --rate 20000 --seconds 10
+
+The truth cannot always be recovered exactly: with few spots some modes are
+invisible or alias onto others (with the four FELIX spots, tip and tilt are
+removed with the mean position and coma shows up as tilt). Errors are
+therefore also reported against the expected coefficients E a, where
+E = s2z C A is what a perfect reconstructor returns for the coefficients a.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from config import *
+from protocol import REPLY_HEADER, format_felixdata, pack_frame, unpack_reply_header
+from reconstruction import noll_zernike_index
+from spots2zern import ZernikeReconstructor
+
+def kolmogorov_variances(n_modes):
+    """Returns the variances of Noll modes 2 to n_modes+1 for Kolmogorov
+    turbulence, relative to tip.
+
+    Reference: Noll (1976), <a_j^2> ~ (n+1) Gamma(n-5/6) / Gamma(n+23/6).
+    """
+    n = np.array([noll_zernike_index(j)[1] for j in range(2, n_modes + 2)])
+    log_var = np.log(n + 1) + np.array([math.lgamma(k - 5/6) - math.lgamma(k + 23/6) for k in n])
+    return np.exp(log_var - log_var[0])
+
+def zernike_series(n_frames, n_modes, rms=1.0, tau=50.0, rng=None):
+    """Draws a turbulence-like time series of Zernike coefficients.
+
+    Every mode is an AR(1) process with a Kolmogorov variance. Higher radial
+    orders decorrelate faster, with correlation time 2 tau / (n+1) frames.
+
+    Parameters
+    ----------
+    n_frames, n_modes: int
+    rms: float, optional
+        RMS of tip, in the units of the imat.
+    tau: float, optional
+        Correlation time of tip and tilt in frames. 0 for independent frames.
+    rng: np.random.Generator, optional
+
+    Returns
+    -------
+    a_z: nd_array of shape (n_frames, n_modes)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    sigma = rms * np.sqrt(kolmogorov_variances(n_modes))
+    n = np.array([noll_zernike_index(j)[1] for j in range(2, n_modes + 2)])
+    rho = np.exp(-(n + 1) / (2 * tau)) if tau > 0 else np.zeros(n_modes)
+    innovations = rng.standard_normal((n_frames, n_modes)) * sigma * np.sqrt(1 - rho**2)
+    a_z = np.empty((n_frames, n_modes))
+    a_z[0] = rng.standard_normal(n_modes) * sigma
+    for k in range(1, n_frames):
+        a_z[k] = rho * a_z[k-1] + innovations[k]
+    return a_z
+
+def spots_from_zernikes(recon, a_z):
+    """Returns the spot positions [x1, y1, ..., xn, yn] of each frame, i.e.
+    CAL_SLOPES displaced by the slopes A a_z.
+    """
+    slopes = np.dot(a_z, recon.A.T)  # [x1, ..., xn, y1, ..., yn]
+    coords = np.empty(slopes.shape)
+    coords[:, 0::2] = slopes[:, :recon.n_spots]
+    coords[:, 1::2] = slopes[:, recon.n_spots:]
+    return coords + np.asarray(recon.cal_slopes, dtype=float)
+
+def corrupt(coords, noise=0.0, p_swap=0.0, p_drop=0.0, rng=None):
+    """Adds centroid noise and swaps or drops spots in place.
+
+    Parameters
+    ----------
+    coords: nd_array of shape (n_frames, 2*n_spots)
+    noise: float, optional
+        Standard deviation of the centroid noise in pixels.
+    p_swap: float, optional
+        Probability that two spots of a frame are swapped.
+    p_drop: float, optional
+        Probability that a frame loses a spot, whose position becomes NaN.
+    rng: np.random.Generator, optional
+
+    Returns
+    -------
+    swapped, dropped: nd_array of shape (n_frames) of bool
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n_frames, n_spots = len(coords), coords.shape[1] // 2
+    if noise:
+        coords += rng.normal(scale=noise, size=coords.shape)
+    spots = coords.reshape(n_frames, n_spots, 2)
+
+    swapped = rng.random(n_frames) < p_swap
+    idx = np.flatnonzero(swapped)
+    i = rng.integers(n_spots, size=len(idx))
+    j = (i + rng.integers(1, n_spots, size=len(idx))) % n_spots
+    spots[idx, i], spots[idx, j] = spots[idx, j], spots[idx, i]
+
+    dropped = rng.random(n_frames) < p_drop
+    idx = np.flatnonzero(dropped)
+    spots[idx, rng.integers(n_spots, size=len(idx))] = np.nan
+    return swapped, dropped
+
+def model_matrix(recon):
+    """Returns E = s2z C A, which maps true coefficients to the coefficients a
+    perfect reconstruction returns. C removes the mean x and y slope.
+    """
+    A, s2z, _ = recon.calibration
+    A_c = np.asarray(A, dtype=float).reshape(2, -1, A.shape[1])
+    A_c = (A_c - A_c.mean(axis=1, keepdims=True)).reshape(A.shape)
+    return np.dot(s2z, A_c)
+
+def simulate(recon, n_frames, rms=1.0, tau=50.0, noise=0.0, p_swap=0.0, p_drop=0.0, seed=None,
+             n_streams=1):
+    """Simulates n_frames frames for a reconstructor.
+
+    Parameters
+    ----------
+    n_streams: int, optional
+        Number of independent time series, e.g. one per client. Frame k
+        belongs to stream k % n_streams.
+
+    Returns
+    -------
+    frames: dict
+        truth and expected coefficients (n_frames, n_modes), coords
+        (n_frames, 2*n_spots), and the swapped and dropped masks.
+    """
+    rng = np.random.default_rng(seed)
+    n_per_stream = -(-n_frames // n_streams)
+    series = [zernike_series(n_per_stream, recon.n_modes, rms, tau, rng) for _ in range(n_streams)]
+    truth = np.stack(series, axis=1).reshape(-1, recon.n_modes)[:n_frames]
+    coords = spots_from_zernikes(recon, truth)
+    swapped, dropped = corrupt(coords, noise, p_swap, p_drop, rng)
+    return {"truth": truth, "expected": np.dot(truth, model_matrix(recon).T), "coords": coords,
+            "swapped": swapped, "dropped": dropped}
+
+def accuracy(frames, rc, a_z):
+    """Compares the replies with the simulated frames.
+
+    Returns
+    -------
+    out: dict
+        Return code counts, RMS errors per mode against the expected and the
+        true coefficients over the successful clean frames, and how the
+        corrupted frames were answered.
+    """
+    ok = rc == 0
+    corrupted = frames["swapped"] | frames["dropped"]
+    good = ok & ~corrupted
+    err = a_z[good] - frames["expected"][good]
+    err_truth = a_z[good] - frames["truth"][good]
+    err_corrupted = a_z[ok & corrupted] - frames["expected"][ok & corrupted]
+    codes, counts = np.unique(rc, return_counts=True)
+    return {
+        "return_codes": {int(c): int(n) for c, n in zip(codes, counts)},
+        "rms_error": np.sqrt(np.mean(err**2, axis=0)).tolist() if good.any() else None,
+        "max_error": float(np.abs(err).max()) if good.any() else None,
+        "rms_error_truth": np.sqrt(np.mean(err_truth**2, axis=0)).tolist() if good.any() else None,
+        "clean_rejected": int(np.count_nonzero(~corrupted & ~ok)),
+        "swapped_accepted": int(np.count_nonzero(frames["swapped"] & ok)),
+        "dropped_accepted": int(np.count_nonzero(frames["dropped"] & ok)),
+        "max_error_corrupted": float(np.abs(err_corrupted).max()) if err_corrupted.size else None,
+    }
+
+async def _run_client(host, port, messages, send_at, protocol, n_modes):
+    """Sends messages at the given perf_counter times over one connection and
+    reads the replies. Returns the send and receive times, return codes and
+    coefficients.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    n = len(messages)
+    sent = np.empty(n)
+    received = np.empty(n)
+    rc = np.empty(n, dtype=int)
+    a_z = np.empty((n, n_modes))
+
+    async def send():
+        for k, msg in enumerate(messages):
+            # Yield even when behind schedule so replies keep being read
+            await asyncio.sleep(max(send_at[k] - time.perf_counter(), 0))
+            sent[k] = time.perf_counter()
+            writer.write(msg)
+            if writer.transport.get_write_buffer_size() > 1 << 20:
+                await writer.drain()
+        await writer.drain()
+
+    async def receive():
+        for k in range(n):
+            if protocol == "binary":
+                rc[k], n_reply, _ = unpack_reply_header(await reader.readexactly(REPLY_HEADER.size))
+                a_z[k] = np.frombuffer(await reader.readexactly(8 * n_reply), dtype="<f8")
+            else:
+                rc[k] = int((await reader.readline()).split()[1])
+                await reader.readline()  # MSG
+                for i in range(n_modes):
+                    a_z[k, i] = float((await reader.readline()).split()[1])
+            received[k] = time.perf_counter()
+
+    try:
+        await asyncio.gather(send(), receive())
+    finally:
+        writer.close()
+    return sent, received, rc, a_z
+
+async def drive(host, port, coords, n_clients, rate, protocol="binary", n_modes=N_MODES):
+    """Sends frames from n_clients concurrent connections at a total rate of
+    rate frames per second. Frame k is sent by client k % n_clients (see the
+    n_streams argument of simulate), and all clients share one schedule, so
+    frames leave in order.
+
+    Returns
+    -------
+    latency: nd_array of shape (n_frames)
+        Seconds from sending each frame to receiving its reply.
+    lag: nd_array of shape (n_frames)
+        Seconds each frame was sent after its scheduled time.
+    rc: nd_array of shape (n_frames)
+    a_z: nd_array of shape (n_frames, n_modes)
+    elapsed: float
+        Seconds from the first send to the last reply.
+    """
+    n_frames = len(coords)
+    timestamps = np.arange(n_frames) / rate
+    if protocol == "binary":
+        messages = [pack_frame(ts, c, "<f8") for ts, c in zip(timestamps, coords)]
+    else:
+        messages = [(format_felixdata(ts, c) + "\n").encode() for ts, c in zip(timestamps, coords)]
+
+    t0 = time.perf_counter() + 0.1  # time to connect
+    schedule = t0 + timestamps
+    results = await asyncio.gather(*[
+        _run_client(host, port, messages[i::n_clients], schedule[i::n_clients], protocol, n_modes)
+        for i in range(n_clients)])
+
+    sent = np.empty(n_frames)
+    received = np.empty(n_frames)
+    rc = np.empty(n_frames, dtype=int)
+    a_z = np.empty((n_frames, n_modes))
+    for i, (s, r, c, z) in enumerate(results):
+        sent[i::n_clients], received[i::n_clients], rc[i::n_clients], a_z[i::n_clients] = s, r, c, z
+    return received - sent, sent - schedule, rc, a_z, received.max() - sent.min()
+
+def start_local_server(port, imat_fname=None, extra_args=()):
+    """Starts server.py in a subprocess on 127.0.0.1 and waits until it
+    accepts connections. Returns the process.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, "server.py"), "--host", "127.0.0.1",
+           "--port", str(port), "--filter", "none"]
+    if imat_fname is not None:
+        cmd += ["--imat", imat_fname]
+    proc = subprocess.Popen(cmd + list(extra_args), stdout=subprocess.DEVNULL)
+
+    async def wait():
+        for _ in range(300):
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                return
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError("server.py exited")
+                await asyncio.sleep(0.1)
+        raise RuntimeError("server.py did not start")
+    asyncio.run(wait())
+    return proc
+
+def print_report(report):
+    lat = report["latency_us"]
+    print(f"{report['n_frames']} frames from {report['clients']} clients at "
+          f"{report['target_rate']:.0f} frames/s ({report['protocol']})")
+    print(f"sustained   {report['achieved_rate']:.0f} frames/s, max send lag "
+          f"{report['max_lag_ms']:.2f} ms")
+    print("latency     " + "  ".join(f"{k} {v:.1f} us" for k, v in lat.items()))
+    acc = report["accuracy"]
+    print(f"return codes {acc['return_codes']}")
+    if acc["rms_error"] is not None:
+        print("rms error   " + " ".join(f"{e:.2e}" for e in acc["rms_error"]) + " (vs expected)")
+        print("            " + " ".join(f"{e:.2e}" for e in acc["rms_error_truth"]) + " (vs truth)")
+    print(f"clean frames rejected {acc['clean_rejected']}, swapped accepted "
+          f"{acc['swapped_accepted']}, dropped accepted {acc['dropped_accepted']}")
+    if acc["max_error_corrupted"] is not None:
+        print(f"max error of accepted corrupted frames {acc['max_error_corrupted']:.2e}")
+
+def main(host, port, n_clients, rate, seconds, protocol="binary", rms=1.0, tau=50.0, noise=0.0,
+         p_swap=0.0, p_drop=0.0, seed=0, imat_fname=None, local=False, server_args=(),
+         fn_out=None):
+    recon = ZernikeReconstructor(imat_fname)
+    frames = simulate(recon, int(rate * seconds), rms, tau, noise, p_swap, p_drop, seed,
+                      n_streams=n_clients)
+
+    proc = start_local_server(port, imat_fname, server_args) if local else None
+    try:
+        latency, lag, rc, a_z, elapsed = asyncio.run(
+            drive(host, port, frames["coords"], n_clients, rate, protocol, recon.n_modes))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    us = latency * 1e6
+    report = {
+        "n_frames": len(rc),
+        "clients": n_clients,
+        "protocol": protocol,
+        "target_rate": rate,
+        "achieved_rate": len(rc) / elapsed,
+        "max_lag_ms": float(lag.max() * 1e3),
+        "latency_us": {"p50": float(np.percentile(us, 50)), "p99": float(np.percentile(us, 99)),
+                       "p99.9": float(np.percentile(us, 99.9)), "max": float(us.max())},
+        "accuracy": accuracy(frames, rc, a_z),
+    }
+    print_report(report)
+    if fn_out is not None:
+        with open(fn_out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to: {fn_out}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator and accuracy check for server.py")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Server address")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Server port")
+    parser.add_argument("--local", action="store_true",
+                        help="Start server.py on 127.0.0.1:PORT for the run")
+    parser.add_argument("--max-residual", type=float, default=None,
+                        help="With --local, passed to server.py to screen the frames")
+    parser.add_argument("--max-jump", type=float, default=None,
+                        help="With --local, passed to server.py to screen the frames")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent connections")
+    parser.add_argument("--rate", type=float, default=5000, help="Total frames per second")
+    parser.add_argument("--seconds", type=float, default=5, help="Duration of the run")
+    parser.add_argument("--protocol", type=str, default="binary", choices=["binary", "text"])
+    parser.add_argument("--rms", type=float, default=1.0, help="RMS of tip in imat units")
+    parser.add_argument("--tau", type=float, default=50.0,
+                        help="Correlation time of tip/tilt in frames (0 = independent frames)")
+    parser.add_argument("--noise", type=float, default=0.0, help="Centroid noise in pixels")
+    parser.add_argument("--p-swap", type=float, default=0.0,
+                        help="Probability that a frame has two spots swapped")
+    parser.add_argument("--p-drop", type=float, default=0.0,
+                        help="Probability that a frame loses a spot")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--imat", type=str, default=None, help="Override IMAT_FNAME")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Save the report as JSON")
+    args = parser.parse_args()
+
+    server_args = []
+    if args.max_residual is not None:
+        server_args += ["--max-residual", str(args.max_residual)]
+    if args.max_jump is not None:
+        server_args += ["--max-jump", str(args.max_jump)]
+    main(args.host, args.port, args.clients, args.rate, args.seconds, args.protocol, args.rms,
+         args.tau, args.noise, args.p_swap, args.p_drop, args.seed, args.imat, args.local,
+         server_args, args.output)
@@ -1,49 +1,140 @@
 import numpy as np
 import argparse
+import glob
+import os
+import shutil
+import tempfile
 from astropy.io import fits
 from datetime import datetime, timezone
+from protocol import iter_felixdata_chunks
 
+FITS_BLOCK = 2880
 
-def main(fn_in, fn_out):
 
-    timestamps = []
-    slopes = []
+def format_stamp(t):
+    """Creates UTC timestamps of starting and ending times YYYYMMDDTHH:MM:SS+00:00
+    """
+    utc_time = datetime.now(timezone.utc)
+    return utc_time.fromtimestamp(t).strftime("%Y%m%dT%H:%M:%S+00:00")
 
-    with open(fn_in, 'r') as file:
-        for line in file:
-            line = line.strip()
-            args = line.split(' ')
-            timestamps.append(float(args[1]))
-            slopes.append([float(x[:-1]) for x in args[2:]])
+def _pad_block(f):
+    """Pads the file with zeros to a multiple of the FITS block size.
+    """
+    remainder = f.tell() % FITS_BLOCK
+    if remainder:
+        f.write(b"\0" * (FITS_BLOCK - remainder))
 
-    timestamps = np.array(timestamps)
-    slopes = np.array(slopes)
+def _slopes_header(n_cols, n_rows, t_start, t_end):
+    """Returns the primary header for an (n_rows, n_cols) float64 slopes image.
+    """
+    header = fits.Header()
+    header['SIMPLE'] = (True, 'conforms to FITS standard')
+    header['BITPIX'] = (-64, 'array data type')
+    header['NAXIS'] = (2, 'number of array dimensions')
+    header['NAXIS1'] = n_cols
+    header['NAXIS2'] = n_rows
+    header['EXTEND'] = True
+    header['TSTART'] = (format_stamp(t_start), 'Start time of the data')
+    header['TSTOP'] = (format_stamp(t_end), 'End time of the data')
+    return header
 
-    # Create UTC timestamps of starting and ending times YYYYMMDDTHH:MM:SS+00:00
-    t_start = timestamps[0]
-    t_end = timestamps[-1]
+def _timestamps_header(n_rows):
+    """Returns the extension header for the float64 timestamps image.
+    """
+    header = fits.Header()
+    header['XTENSION'] = ('IMAGE', 'Image extension')
+    header['BITPIX'] = (-64, 'array data type')
+    header['NAXIS'] = (1, 'number of array dimensions')
+    header['NAXIS1'] = n_rows
+    header['PCOUNT'] = 0
+    header['GCOUNT'] = 1
+    return header
 
-    utc_time = datetime.now(timezone.utc)
-    stamp_start = utc_time.fromtimestamp(t_start).strftime("%Y%m%dT%H:%M:%S+00:00")
-    stamp_end = utc_time.fromtimestamp(t_end).strftime("%Y%m%dT%H:%M:%S+00:00")
+def main(fn_in, fn_out, chunk_size=65536):
+    """Converts a felixdata log to a FITS file with the slopes in the primary HDU
+    and the timestamps in the first extension.
 
-    # Create a new FITS file
-    hdu1 = fits.PrimaryHDU(slopes)
-    hdu2 = fits.ImageHDU(timestamps)
-    hdu_list = fits.HDUList([hdu1, hdu2])
+    The log is parsed and written in chunks, so memory use stays flat however
+    long the log is. The primary header is written with placeholder values and
+    fixed up once the number of frames and the stop time are known. Timestamps
+    are spooled to a temporary file and appended at the end. The FITS file is
+    written under a temporary name and only renamed to fn_out once it is
+    complete, so an empty or malformed log never leaves a truncated file.
+    """
+    tmp = f"{fn_out}.{os.getpid()}.tmp"
+    try:
+        _write_fits(fn_in, tmp, chunk_size)
+        os.replace(tmp, fn_out)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    print(f"Created FITS file {fn_out}")
 
-    # Set the header information
-    hdu1.header['TSTART'] = (stamp_start, 'Start time of the data')
-    hdu1.header['TSTOP'] = (stamp_end, 'End time of the data')
+def _write_fits(fn_in, fn_out, chunk_size):
+    """Writes the FITS file of main to fn_out.
+    """
+    n_rows = 0
+    n_cols = None
+    t_start = t_end = 0.
 
-    hdu_list.writeto(fn_out, overwrite=True)
-    print(f"Created FITS file {fn_out}")
+    with open(fn_out, 'wb') as f, tempfile.TemporaryFile() as spool:
+        for timestamps, slopes in iter_felixdata_chunks(fn_in, chunk_size):
+            if n_cols is None:
+                n_cols = slopes.shape[1]
+                t_start = timestamps[0]
+                header = _slopes_header(n_cols, 0, t_start, t_start)
+                f.write(header.tostring().encode('ascii'))
+            elif slopes.shape[1] != n_cols:
+                raise ValueError(f"{fn_in}: number of coordinates changed from "
+                                 f"{n_cols} to {slopes.shape[1]}")
+
+            slopes.astype('>f8').tofile(f)
+            timestamps.astype('>f8').tofile(spool)
+            n_rows += len(timestamps)
+            t_end = timestamps[-1]
+
+        if n_cols is None:
+            raise ValueError(f"{fn_in}: no felixdata frames found")
+        _pad_block(f)
+
+        # Timestamps extension
+        f.write(_timestamps_header(n_rows).tostring().encode('ascii'))
+        spool.seek(0)
+        shutil.copyfileobj(spool, f)
+        _pad_block(f)
+
+        # Fix up the primary header now that the size and stop time are known.
+        # Every card has a fixed width, so the header length does not change.
+        f.seek(0)
+        f.write(_slopes_header(n_cols, n_rows, t_start, t_end).tostring().encode('ascii'))
+
+def expand_inputs(patterns):
+    """Expands glob patterns into a sorted list of unique file names. Patterns
+    that do not match anything are kept as is, so a missing file is reported
+    when it is opened.
+    """
+    fnames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        fnames.extend(matches if matches else [pattern])
+    return list(dict.fromkeys(fnames))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert slopes to FITS file.")
-    parser.add_argument("fn_in", type=str, help="Input file name")
-    parser.add_argument("fn_out", type=str, help="Output file name")
+    parser.add_argument("fn_in", type=str, nargs='+',
+                        help="Input file names or glob patterns, e.g. 'slope_logs/*.log'")
+    parser.add_argument("fn_out", type=str,
+                        help="Output file name, or output directory if there are several inputs")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="Lines to parse at once")
     args = parser.parse_args()
 
-    main(args.fn_in, args.fn_out)
\ No newline at end of file
+    fnames = expand_inputs(args.fn_in)
+    if len(fnames) == 1 and not os.path.isdir(args.fn_out):
+        main(fnames[0], args.fn_out, args.chunk_size)
+    else:
+        os.makedirs(args.fn_out, exist_ok=True)
+        for fn_in in fnames:
+            stem = os.path.splitext(os.path.basename(fn_in))[0]
+            main(fn_in, os.path.join(args.fn_out, stem + ".fits"), args.chunk_size)
@@ -1,6 +1,16 @@
-import argparse
+import sys
+import time
+
+if __name__ == "__main__":
+    # Let a resident helper answer before the slow imports below, see
+    # fastcli.py. Returns if this process has to answer the call itself.
+    import fastcli
+    fastcli.run(sys.argv[1:])
+
 import numpy as np
 from config import *
+from metrics import METRICS
+from s2zcache import load_s2z
 
 class ZernikeReconstructor:
     """Modal wavefront reconstruction for a Shack-Hartmann wavefront sensor with
@@ -14,9 +24,23 @@ class ZernikeReconstructor:
     flip = FLIP           # Set to -1 to flip sign of Zernike
     imat_fname = IMAT_FNAME  # File name for the imat
 
+    # Pseudo-inverse options, see s2zcache.compute_s2z
+    s2z_rcond = S2Z_RCOND
+    s2z_reg = S2Z_REG
+    s2z_ntrunc = S2Z_NTRUNC
+    s2z_method = S2Z_METHOD
+
+    # Data type of the fused reconstruction kernel and its output
+    dtype = np.dtype(RECON_DTYPE)
+
     # Spot positions on the pupil
     spot_positions = np.array(SPOT_POSITIONS)
 
+    # Reference spot positions, formatted as [x1, y1, ..., xn, yn], or the npy
+    # file they are loaded from
+    cal_slopes = CAL_SLOPES
+    cal_fname = CAL_FNAME
+
     @classmethod
     def import_imat(cls, fname):
         """Loads a Zernike to slopes matrix from a npy binary file.
@@ -25,15 +49,130 @@ class ZernikeReconstructor:
             A = np.load(f)
         return A
 
-    def __init__(self):
+    def __init__(self, imat_fname=None, n_spots=None, n_modes=None, rotation_angle=None,
+                 scale=None, flip=None, spot_positions=None, cal_slopes=None, s2z_method=None,
+                 dtype=None, cal_fname=None):
         """Initializes the ZernikeReconstructor object. Define FELIX parameters
-        in config.py.
+        in config.py. The keyword arguments override them for this instance, so
+        one process can hold reconstructors for several sensors, see
+        registry.py.
+
+        Parameters
+        ----------
+        imat_fname: str, optional
+            Overrides IMAT_FNAME from config.py.
+        n_spots, n_modes, rotation_angle, scale, flip: optional
+            Override N_SPOTS, N_MODES, ROTATION_ANGLE (degrees), SCALE and FLIP.
+        spot_positions: array_like of shape (n_spots, 2), optional
+            Overrides SPOT_POSITIONS.
+        cal_slopes: list of float, optional
+            Overrides CAL_SLOPES.
+        s2z_method: str, optional
+            Overrides S2Z_METHOD, see s2zcache.compute_s2z.
+        dtype: str or np.dtype, optional
+            Overrides RECON_DTYPE.
+        cal_fname: str, optional
+            Overrides CAL_FNAME, the npy file of reference spot positions
+            written by calibration.py. Not used if cal_slopes is given.
         """
         self.slopes = None
+        if imat_fname is not None:
+            self.imat_fname = imat_fname
+        overrides = {"n_spots": n_spots, "n_modes": n_modes, "scale": scale, "flip": flip,
+                     "cal_slopes": cal_slopes, "s2z_method": s2z_method}
+        for name, value in overrides.items():
+            if value is not None:
+                setattr(self, name, value)
+        if rotation_angle is not None:
+            self.rot = np.radians(rotation_angle)
+        if spot_positions is not None:
+            self.spot_positions = np.array(spot_positions)
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        if cal_fname is not None:
+            self.cal_fname = cal_fname
+        if cal_slopes is None and self.cal_fname is not None:
+            self.cal_slopes = np.load(self.cal_fname).tolist()
+
+        # Initialize zernike to slopes matrix. The slopes to Zernike matrix is
+        # memory-mapped from the cache next to the imat.
+        A = self.import_imat(self.imat_fname)
+        s2z = load_s2z(A, self.imat_fname, self.n_modes, self.scale, self.flip,
+                       self.rot, self.s2z_rcond, self.s2z_reg, self.s2z_ntrunc,
+                       method=self.s2z_method, points=self.spot_positions)
+
+        # Calibration offset, computed once instead of on every frame
+        cal = subtract_mean(np.array(self.cal_slopes))
+
+        # A, s2z and cal are kept in one tuple with the kernel built from them,
+        # so swap_calibration can replace everything at once while other
+        # threads are reconstructing.
+        self._state = ((A, s2z, cal), self.make_kernel(s2z, cal))
+
+    @property
+    def calibration(self):
+        """The tuple (A, s2z, cal) currently in use.
+        """
+        return self._state[0]
+
+    @property
+    def kernel(self):
+        """The tuple (K, b) of the current calibration, see make_kernel.
+        """
+        return self._state[1]
+
+    @property
+    def A(self):
+        return self.calibration[0]
+
+    @property
+    def s2z(self):
+        return self.calibration[1]
 
-        # Initialize zernike to slopes matrix
-        self.A = self.import_imat(self.imat_fname)
-        self.s2z = np.linalg.pinv(self.A)
+    @property
+    def cal(self):
+        return self.calibration[2]
+
+    def swap_calibration(self, A=None, s2z=None, cal=None):
+        """Atomically replaces the Zernike to slopes matrix, the slopes to
+        Zernike matrix and/or the calibration offset. Arguments that are not
+        given are kept.
+
+        Parameters
+        ----------
+        A: nd_array of shape (2*n_spots, n_modes), optional
+        s2z: nd_array of shape (n_modes, 2*n_spots), optional
+        cal: nd_array of shape (2*n_spots), optional
+            Mean-subtracted reference slopes, see subtract_mean.
+        """
+        old = self.calibration
+        new = tuple(o if n is None else np.asarray(n, dtype=float)
+                    for o, n in zip(old, (A, s2z, cal)))
+        if new[0].shape != old[0].shape or new[1].shape != old[1].shape \
+           or new[2].shape != old[2].shape:
+            raise ValueError("calibration shapes do not match the reconstructor")
+        self._state = (new, self.make_kernel(new[1], new[2]))
+
+    def make_kernel(self, s2z, cal):
+        """Returns the fused reconstruction kernel (K, b) such that
+        K coords - b = s2z (subtract_mean(coords) - cal) for raw spot positions
+        [x1, y1, ..., xn, yn]. subtract_mean is linear, so removing the mean x
+        and y position folds into K, and the calibration offset into b.
+
+        Returns
+        -------
+        K: nd_array of shape (n_modes, 2*n_spots), read-only, of type self.dtype
+        b: nd_array of shape (n_modes), read-only, of type self.dtype
+        """
+        s2z = np.asarray(s2z, dtype=float)
+        n = s2z.shape[1] // 2
+        K = np.empty(s2z.shape, dtype=self.dtype)
+        K[:, 0::2] = s2z[:, :n] - s2z[:, :n].mean(axis=1, keepdims=True)
+        K[:, 1::2] = s2z[:, n:] - s2z[:, n:].mean(axis=1, keepdims=True)
+        b = np.dot(s2z, cal).astype(self.dtype)
+        K.flags.writeable = False
+        b.flags.writeable = False
+        return K, b
 
     def update_slopes(self, slopes):
         """Updates slope data.
@@ -48,89 +187,213 @@ class ZernikeReconstructor:
         
         return np.dot(self.s2z, self.slopes)
 
-def print_coeffs(a_z):
-    """Prints Zernike coefficients.
+    def batch_slopes_to_zernikes(self, slopes):
+        """Converts a stack of slope vectors to Zernike coefficients with a
+        single matrix multiply.
 
-    Since we do not calculate piston, the index is printed starting from 2.
+        Parameters
+        ----------
+        slopes: nd_array of shape (n_frames, 2*n_spots)
+            Slopes formatted as [x1, ..., xn, y1, ..., yn] for each frame.
+
+        Returns
+        -------
+        out: nd_array of shape (n_frames, n_modes)
+            Zernike coefficients for each frame.
+        """
+        return np.dot(slopes, self.s2z.T)
+
+def format_coeffs(a_z):
+    """Returns the lines printed by print_coeffs as a single string.
     """
     coeff_names = ["ZTIP", "ZTILT", "ZFOCUS", "ZASTIG1", "ZASTIG2", "ZCOMA1", "ZCOMA2",
                    "ZTREFOIL1", "ZTREFOIL2", "ZSPHERICAL"]
+    lines = []
     for i,coeff in enumerate(a_z):
         if i >= len(coeff_names):
             name = f"J={i+2}".zfill(2)
         else:
             name = coeff_names[i]
-        print(name + ' ' + '{:.6f}'.format(coeff))
+        lines.append(name + ' ' + '{:.6f}'.format(coeff))
+    return "\n".join(lines)
 
-def print_return_code(n):
-    """Prints return code with an error message if it is not 0.
+def print_coeffs(a_z):
+    """Prints Zernike coefficients.
+
+    Since we do not calculate piston, the index is printed starting from 2.
+    """
+    print(format_coeffs(a_z))
+
+def format_return_code(n):
+    """Returns the lines printed by print_return_code as a single string.
     """
-    print(f"RC {n}")
     messages = {
         0: "MSG success",
         1: "MSG no input provided",
-        2: "MSG input does not contain 8 elements",
+        2: "MSG input does not contain 2*N_SPOTS elements",
         3: "MSG input points do not match N_SPOTS",
         4: "MSG computed zernikes are NaN",
+        5: "MSG could not parse input",
+        6: "MSG slopes do not fit the Zernike model",
+        7: "MSG spots jumped from recent frames",
+        8: "MSG unknown sensor",
+        9: "MSG reconstruction failed",
     }
-    if n in messages:
-        print(messages[n])
-    else:
-        print("MSG unknown error")
+    return f"RC {n}\n" + messages.get(n, "MSG unknown error")
+
+def print_return_code(n):
+    """Prints return code with an error message if it is not 0.
+    """
+    print(format_return_code(n))
 
 def subtract_mean(coords):
     """Subtract mean position from coordinates formatted as:
     [x1, y1, x2, y2, ..., xn, yn]
+
+    The output is reordered to [x1, ..., xn, y1, ..., yn]. A 2D array is
+    treated as a stack of frames, one per row.
+    """
+    coords = np.asarray(coords, dtype=float)
+    pointsx = coords[..., ::2]
+    pointsy = coords[..., 1::2]
+    return np.concatenate((pointsx - pointsx.mean(axis=-1, keepdims=True),
+                           pointsy - pointsy.mean(axis=-1, keepdims=True)), axis=-1)
+
+def reconstruct(recon, coords, screen=None, out=None):
+    """Converts spot positions to Zernike coefficients.
+
+    Parameters
+    ----------
+    recon: ZernikeReconstructor
+        The reconstructor to use.
+    coords: array_like
+        Spot positions formatted as [x1, y1, x2, y2, ..., xn, yn]. Nothing is
+        allocated for an nd_array of type recon.dtype.
+    screen: screening.FrameScreen, optional
+        Rejects or repairs outlier frames before reconstruction.
+    out: nd_array of shape (n_modes), optional
+        Contiguous buffer of type recon.dtype the coefficients are written to.
+
+    Returns
+    -------
+    rc: int
+        Return code, see print_return_code.
+    a_z: nd_array of shape (n_modes)
+        The Zernike coefficients, out if given. All zeros if the input is
+        invalid.
     """
-    xmean = np.mean(coords[::2])
-    ymean = np.mean(coords[1::2])
-    pointsx = np.array(coords[::2]) - xmean
-    pointsy = np.array(coords[1::2]) - ymean
-    points_out = np.array( pointsx.tolist() + pointsy.tolist() ) 
-    return points_out
+    # Use one snapshot of the kernel in case the calibration is swapped
+    K, b = recon.kernel
+    if out is None:
+        out = np.zeros(len(b), dtype=K.dtype)
+    if len(coords) != recon.n_spots * 2:
+        out.fill(0)
+        return 3, out  # N_SPOTS doesn't match number of points
+
+    if screen is not None:
+        rc, coords = screen.screen_frame(coords)
+        if rc != 0:
+            out.fill(0)
+            return rc, out
+
+    # Stage timings, see metrics.py
+    m = METRICS.sample("reconstruct")
+    if m:
+        t = time.perf_counter_ns()
+
+    # Mean removal, calibration and conversion to Zernike coefficients in one
+    # matrix-vector product, see ZernikeReconstructor.make_kernel
+    np.dot(K, np.asarray(coords, dtype=K.dtype), out=out)
+    out -= b
+    if m:
+        t = m.lap("kernel", "frame", t)
+
+    nan = np.isnan(out.sum())
+    if m:
+        m.lap("nan_check", "frame", t)
+    if nan:
+        return 4, out  # one of the coeffs is nan
+    return 0, out
+
+def reconstruct_batch(recon, coords, screen=None, out=None):
+    """Converts a stack of spot positions to Zernike coefficients. This is the
+    vectorized equivalent of calling reconstruct on every row.
+
+    Parameters
+    ----------
+    recon: ZernikeReconstructor
+        The reconstructor to use.
+    coords: array_like of shape (n_frames, 2*n_spots)
+        Spot positions formatted as [x1, y1, x2, y2, ..., xn, yn] for each frame.
+    screen: screening.FrameScreen, optional
+        Rejects or repairs outlier frames before reconstruction. The frames
+        must be in stream order.
+    out: nd_array of shape (n_frames, n_modes), optional
+        Contiguous buffer of type recon.dtype the coefficients are written to.
+
+    Returns
+    -------
+    rc: nd_array of shape (n_frames)
+        Return code of each frame, see print_return_code.
+    a_z: nd_array of shape (n_frames, n_modes)
+        The Zernike coefficients of each frame, out if given.
+    """
+    K, b = recon.kernel
+    coords = np.atleast_2d(np.asarray(coords, dtype=K.dtype))
+    if coords.ndim != 2 or coords.shape[1] != recon.n_spots * 2:
+        raise ValueError(f"expected coords of shape (n_frames, {recon.n_spots * 2}), "
+                         f"got {coords.shape}")
+
+    # Stage timings, see metrics.py. Batches are always timed.
+    m = METRICS if METRICS.enabled else None
+    if m:
+        m.batch_size.observe(len(coords))
+        t = time.perf_counter_ns()
+
+    rc = np.zeros(len(coords), dtype=int)
+    if screen is not None:
+        rc, coords = screen.screen(coords)
+        coords = np.asarray(coords, dtype=K.dtype)
+        if m:
+            t = m.lap("screen", "batch", t)
+
+    a_z = np.dot(coords, K.T, out=out)
+    a_z -= b
+    if m:
+        t = m.lap("kernel", "batch", t)
+
+    a_z[rc != 0] = 0
+    rc[(rc == 0) & np.isnan(a_z).any(axis=1)] = 4  # one of the coeffs is nan
+    if m:
+        m.lap("nan_check", "batch", t)
+    return rc, a_z
 
 def main(coords):
 
     recon = ZernikeReconstructor()
-    a_z = np.zeros(N_MODES)
-
-    # Subtract off the mean
-    slopes = subtract_mean(coords)
-    cal = subtract_mean(np.array(CAL_SLOPES))
-
-    # Reformat from [x1, y1, ... xn, yn] to [x1, ..., xn, y1, ..., yn]
-    slopes -= cal
-    
-    if len(slopes) != N_SPOTS * 2:
-        print_return_code(3)  # N_SPOTS doesn't match number of poitns
-        print_coeffs(a_z)
-        exit()
-    
-    # Convert points to Zernike coefficients
-    recon.update_slopes(slopes)
-    a_z = recon.slopes_to_zernikes()
-
-    if np.isnan(a_z.sum()):
-        print_return_code(4)  # one of the coeffs is nan
-        print_coeffs(a_z)
-        exit()
-    
+    rc, a_z = reconstruct(recon, coords)
+
     # Print Zernike coefficients
-    print_return_code(0)
+    print_return_code(rc)
     print_coeffs(a_z)
+    if rc != 0:
+        exit()
 
 if __name__ == "__main__":
+    import argparse
+
     parser = argparse.ArgumentParser(description="FELIX slopes to Zernikes server")
-    parser.add_argument("coords", type=float, nargs=8, help="Spot positions: x1 y1 x2 y2 x3 y3 x4 y4")
+    parser.add_argument("coords", type=float, nargs="*",
+                        help=f"Spot positions: x1 y1 x2 y2 ... x{N_SPOTS} y{N_SPOTS}")
     args = parser.parse_args()
 
-    if args.coords is None:
+    if not args.coords:
         print_return_code(1)  # no input
         print_coeffs(np.zeros(N_MODES))
         exit()
 
-    if len(args.coords) != 8:
-        print_return_code(2)  # input does not contain 8 elements
+    if len(args.coords) != 2 * N_SPOTS:
+        print_return_code(2)  # input does not contain 2*N_SPOTS elements
         print_coeffs(np.zeros(N_MODES))
         exit()
 
@@ -0,0 +1,228 @@
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from config import *
+from config import _make_spot_positions
+from reconstruction import PupilBasis, make_gamma_matrices, noll_indices
+from protocol import iter_felixdata_chunks
+from slopes2fits import expand_inputs
+from spots2zern import ZernikeReconstructor, subtract_mean
+
+def rotated_points(points, rotations):
+    """Rotates a spot layout by every angle at once.
+
+    Parameters
+    ----------
+    points: nd_array of shape (n_spots, 2)
+        Spot layout before rotation.
+    rotations: nd_array of shape (n_rot)
+        Rotation angles in degrees.
+
+    Returns
+    -------
+    out: nd_array of shape (n_rot, n_spots, 2)
+    """
+    rot = np.radians(rotations)
+    c, s = np.cos(rot), np.sin(rot)
+    rot_matrices = np.stack([np.stack([c, -s], axis=-1),
+                             np.stack([s,  c], axis=-1)], axis=-2)
+    return np.einsum("rij,pj->rpi", rot_matrices, points)
+
+def unit_imats(points, rotations, n_modes):
+    """Returns the Zernike to slopes matrix of every rotation of a layout with
+    scale 1 and no flip, from a single basis evaluation over all rotated points.
+
+    Returns
+    -------
+    out: nd_array of shape (n_rot, 2*n_spots, n_modes)
+        Same layout as make_theoretical_imat.
+    """
+    n_spots = len(points)
+    pts = rotated_points(points, rotations).reshape(-1, 2)
+    gammax, gammay = make_gamma_matrices(n_modes + 1)  # plus 1 to skip piston
+    dervx, dervy = PupilBasis(pts, n_modes + 1).derivatives(gammax, gammay)
+    dx = dervx[1:].reshape(n_modes, len(rotations), n_spots).transpose(1, 2, 0)
+    dy = dervy[1:].reshape(n_modes, len(rotations), n_spots).transpose(1, 2, 0)
+    return np.concatenate((dx, dy), axis=1)
+
+def mode_norms(n_modes, scale, flip):
+    """Returns the column normalization applied by make_theoretical_imat.
+    """
+    m, _ = noll_indices(n_modes + 1)
+    norm = np.full(n_modes, float(scale))
+    norm[m[1:] < 0] *= flip
+    return norm
+
+def load_slopes(patterns, cal_slopes=CAL_SLOPES):
+    """Loads every frame of the given logs as calibrated slopes, dropping frames
+    with no signal.
+    """
+    coords = np.concatenate([c for fname in expand_inputs(patterns)
+                             for _, c in iter_felixdata_chunks(fname)])
+    slopes = subtract_mean(coords) - subtract_mean(np.array(cal_slopes))
+    return slopes[np.any(coords != coords[:, :1], axis=1)]
+
+def score_imats(A, slopes, expect=None):
+    """Scores candidate matrices against recorded slopes.
+
+    The score is the fraction of slope power that the modal model cannot
+    represent, ||S - A s2z S||^2 / ||S||^2. If expect is given, the fraction of
+    reconstructed Zernike power outside the expected modes is added, which
+    rewards rotations that map e.g. a tilt-only run onto tilt alone.
+
+    Scale and flip only rescale columns of A, so they do not change the score.
+
+    Parameters
+    ----------
+    A: nd_array of shape (n_candidates, 2*n_spots, n_modes)
+    slopes: nd_array of shape (n_frames, 2*n_spots)
+    expect: list of int, optional
+        Indices (0 = tip) of the modes the runs are expected to excite.
+
+    Returns
+    -------
+    out: nd_array of shape (n_candidates)
+        Lower is better.
+    """
+    s2z = np.linalg.pinv(A)
+    a_z = np.einsum("rms,fs->rfm", s2z, slopes)
+    fit = np.einsum("rsm,rfm->rfs", A, a_z)
+    score = ((slopes - fit)**2).sum(axis=(1, 2)) / (slopes**2).sum()
+    if expect is not None:
+        other = np.ones(A.shape[2], dtype=bool)
+        other[list(expect)] = False
+        power = (a_z**2).sum(axis=1)
+        score += power[:, other].sum(axis=1) / power.sum(axis=1)
+    return score
+
+def _score_rotations(points, rotations, n_modes, slopes, expect):
+    """Worker: builds and scores the unit matrices of a chunk of rotations.
+    """
+    return score_imats(unit_imats(points, rotations, n_modes), slopes, expect)
+
+def sweep(layouts, rotations, scales, flips, slopes, n_modes=N_MODES, expect=None,
+          n_workers=None, chunk_size=64):
+    """Scores every (layout, rotation, scale, flip) combination.
+
+    Parameters
+    ----------
+    layouts: dict
+        Layout name to spot positions of shape (n_spots, 2) before rotation.
+    rotations, scales, flips: array_like
+        Values to sweep. Rotations are in degrees.
+    slopes: nd_array of shape (n_frames, 2*n_spots)
+        Recorded slopes, see load_slopes.
+    n_modes: int, optional
+        Number of modes not including piston.
+    expect: list of int, optional
+        See score_imats.
+    n_workers: int, optional
+        Size of the process pool. 1 to score in this process.
+    chunk_size: int, optional
+        Rotations per task.
+
+    Returns
+    -------
+    out: nd_array
+        Structured array of every candidate with fields layout, rotation,
+        scale, flip and score, sorted from best to worst.
+    """
+    rotations = np.asarray(rotations, dtype=float)
+    chunks = [rotations[i:i + chunk_size] for i in range(0, len(rotations), chunk_size)]
+    tasks = [(np.asarray(points, dtype=float), chunk) for points in layouts.values()
+             for chunk in chunks]
+
+    if n_workers == 1:
+        scores = [_score_rotations(p, r, n_modes, slopes, expect) for p, r in tasks]
+    else:
+        with ProcessPoolExecutor(n_workers) as pool:
+            futures = [pool.submit(_score_rotations, p, r, n_modes, slopes, expect)
+                       for p, r in tasks]
+            scores = [future.result() for future in futures]
+    scores = np.concatenate(scores).reshape(len(layouts), len(rotations))
+
+    name_len = max(len(name) for name in layouts)
+    rows = [(name, rot, scale, flip, scores[i, k])
+            for (i, name), (k, rot), scale, flip in itertools.product(
+                enumerate(layouts), enumerate(rotations), scales, flips)]
+    results = np.array(rows, dtype=[("layout", f"U{name_len}"), ("rotation", float),
+                                    ("scale", float), ("flip", int), ("score", float)])
+    return results[np.argsort(results["score"], kind="stable")]
+
+def candidate_imat(points, rotation, scale, flip, n_modes=N_MODES):
+    """Returns the Zernike to slopes matrix of one candidate.
+    """
+    return unit_imats(np.asarray(points, dtype=float), [rotation], n_modes)[0] \
+           * mode_norms(n_modes, scale, flip)
+
+def main(patterns, layouts, rotations, scales, flips, fn_out, imat_out, expect=None,
+         n_workers=None, n_keep=10):
+    slopes = load_slopes(patterns)
+    results = sweep(layouts, rotations, scales, flips, slopes, N_MODES, expect, n_workers)
+
+    top = results[:n_keep]
+    imats = np.array([candidate_imat(layouts[r["layout"]], r["rotation"], r["scale"],
+                                     r["flip"]) for r in top])
+    np.savez(fn_out, results=results, imats=imats)
+
+    print("layout     rotation    scale  flip      score")
+    for r in top:
+        print(f"{r['layout']:10s} {r['rotation']:8.2f} {r['scale']:8.3f} {r['flip']:5d} {r['score']:10.6f}")
+
+    # Save the best matrix and prime the s2z cache next to it by building the
+    # reconstructor that config.py will describe, so its cache key matches
+    best = top[0]
+    with open(imat_out, "wb") as f:
+        np.save(f, imats[0])
+    layout = np.asarray(layouts[best["layout"]], dtype=float)
+    rotation, scale, flip = float(best["rotation"]), float(best["scale"]), int(best["flip"])
+    default_layout = layout.shape == (N_SPOTS, 2) and np.allclose(layout, _make_spot_positions(0))
+    if default_layout:
+        points = np.array(_make_spot_positions(rotation))  # as config.py computes them
+    else:
+        points = rotated_points(layout, [rotation])[0]
+    ZernikeReconstructor(imat_out, n_spots=len(layout), rotation_angle=rotation, scale=scale,
+                         flip=flip, spot_positions=points,
+                         cal_slopes=None if len(layout) == N_SPOTS else [0.] * (2 * len(layout)))
+    print(f"Saved ranked results to: {fn_out}")
+    print(f"Saved best imat to: {imat_out}")
+    print("To use it, set in config.py:")
+    print(f"    IMAT_FNAME = {os.path.abspath(imat_out)!r}")
+    print(f"    ROTATION_ANGLE = {rotation!r}")
+    print(f"    SCALE = {scale!r}")
+    print(f"    FLIP = {flip}")
+    if not default_layout:
+        if len(layout) != N_SPOTS:
+            print(f"    N_SPOTS = {len(layout)}")
+        print(f"    SPOT_POSITIONS = {points.tolist()!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep imat rotation, scale and spot layout")
+    parser.add_argument("fn_in", type=str, nargs='*',
+                        default=["slope_logs/felixdata_sawtooth_*.log", "slope_logs/felixdata_tilt*.log"],
+                        help="Logs to score against (default: sawtooth and tilt runs)")
+    parser.add_argument("--rotations", type=float, nargs=3, default=[0, 360, 1],
+                        metavar=("START", "STOP", "STEP"), help="Rotation angles in degrees")
+    parser.add_argument("--scales", type=float, nargs='+', default=[SCALE], help="Scale factors")
+    parser.add_argument("--flips", type=int, nargs='+', default=[FLIP], choices=[-1, 1],
+                        help="Flip signs")
+    parser.add_argument("--layouts", type=str, default=None,
+                        help="NPZ of named (n_spots, 2) layouts before rotation (default: config.py layout)")
+    parser.add_argument("--expect", type=int, nargs='+', default=None,
+                        help="Modes the runs should excite, 0 = tip, 1 = tilt, ...")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("-o", "--output", type=str, default="sweep.npz", help="Ranked results")
+    parser.add_argument("--imat-out", type=str, default="data/imat_sweep.npy", help="Best imat")
+    args = parser.parse_args()
+
+    if args.layouts is None:
+        layouts = {"default": np.array(_make_spot_positions(0))}
+    else:
+        with np.load(args.layouts) as f:
+            layouts = {name: f[name] for name in f.files}
+    rotations = np.arange(*args.rotations)
+    main(args.fn_in, layouts, rotations, args.scales, args.flips, args.output, args.imat_out,
+         args.expect, args.workers)
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+@pytest.fixture
+def recon():
+    """Reconstructor of the imat shipped in data/."""
+    from spots2zern import ZernikeReconstructor
+    return ZernikeReconstructor(os.path.join(REPO_DIR, "data", "imat.npy"))
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+import archive
+
+def fake_runs(monkeypatch, n_modes):
+    """Makes read_run return one frame per run with the given n_modes."""
+    def read_run(fname, recon):
+        k = int(fname[-1])
+        return archive.Frames(np.array([float(k)]), np.zeros((1, 8)),
+                              np.zeros((1, n_modes[k])), np.zeros(1, np.int16)), {}
+    monkeypatch.setattr(archive, "read_run", read_run)
+
+def test_runs_with_different_n_modes_are_rejected(recon, tmp_path, monkeypatch):
+    fake_runs(monkeypatch, [7, 7, 9])
+    with pytest.raises(ValueError, match="run2 has n_modes=9"):
+        archive.build_archive(str(tmp_path), ["run0", "run1", "run2"], recon)
+
+def test_runs_with_the_same_shape_are_archived(recon, tmp_path, monkeypatch):
+    fake_runs(monkeypatch, [7, 7])
+    archive.build_archive(str(tmp_path), ["run0", "run1"], recon)
+    assert np.load(tmp_path / "zernikes.npy").shape == (2, 7)
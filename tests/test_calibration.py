@@ -0,0 +1,37 @@
+import asyncio
+import numpy as np
+from calibration import OnlineCalibrator
+from spots2zern import reconstruct, subtract_mean
+
+def to_coords(slopes):
+    """Interleaves slopes [x1, ..., xn, y1, ..., yn] as [x1, y1, ..., xn, yn]."""
+    n = len(slopes) // 2
+    coords = np.empty(2 * n)
+    coords[::2], coords[1::2] = slopes[:n], slopes[n:]
+    return coords
+
+def test_pokes_use_the_reference_of_the_session(recon):
+    rng = np.random.default_rng(0)
+    reference = np.array(recon.cal_slopes) + rng.normal(0, 2.0, 2 * recon.n_spots)
+    A = subtract_mean(to_coords(recon.A[:, 2]))  # focus column without mean slopes
+    calibrator = OnlineCalibrator(recon)
+    calibrator.add_reference(np.tile(reference, (20, 1)))
+    a_z = np.zeros(recon.n_modes)
+    a_z[2] = 0.5
+    for _ in range(50):
+        calibrator.add_poke(a_z, reference + to_coords(1.5 * 0.5 * A))
+    # Reference and imat are committed together
+    calibrator.commit()
+
+    rc, out = reconstruct(recon, reference + to_coords(1.5 * 0.3 * A))
+    assert rc == 0
+    np.testing.assert_allclose(out[2], 0.3, atol=1e-3)
+
+def test_poke_of_missing_mode_is_rejected(recon):
+    from server import ReconstructionServer, StreamState
+    server = ReconstructionServer(recon)
+    stream = StreamState(None, None, None)
+    assert asyncio.run(server.handle_cal(["POKE", str(recon.n_modes + 1), "0.5"], stream)) == 5
+    assert stream.cal is None
+    assert asyncio.run(server.handle_cal(["POKE", str(recon.n_modes), "0.5"], stream)) == 0
+    assert stream.cal == (recon.n_modes, 0.5)
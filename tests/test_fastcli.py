@@ -0,0 +1,25 @@
+import os
+import fastcli
+
+def test_only_one_helper_holds_the_lock(tmp_path):
+    path = str(tmp_path / "helper.sock")
+    fd = fastcli._lock(path)
+    assert fd is not None
+    try:
+        assert fastcli._lock(path) is None
+    finally:
+        os.close(fd)
+    fd = fastcli._lock(path)
+    assert fd is not None
+    os.close(fd)
+
+def test_socket_in_shared_directory_is_not_trusted(tmp_path):
+    import socket
+    path = str(tmp_path / "helper.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+        os.chmod(tmp_path, 0o700)
+        assert fastcli._trusted(path)
+        os.chmod(tmp_path, 0o777)
+        assert not fastcli._trusted(path)
+        assert fastcli.forward(["1"], path) is None
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import pytest
+import reconstruction
+
+@pytest.fixture
+def gamma_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(reconstruction, "GAMMA_CACHE_DIR", str(tmp_path))
+    reconstruction._cached_gamma_matrices.cache_clear()
+    yield tmp_path
+    reconstruction._cached_gamma_matrices.cache_clear()
+
+def test_gamma_cache_recovers_from_truncated_file(gamma_cache):
+    expected = reconstruction._compute_gamma_matrices(15)
+    reconstruction.make_gamma_matrices(15)
+    fname = gamma_cache / "gammax_15.npz"
+    fname.write_bytes(fname.read_bytes()[:40])
+    reconstruction._cached_gamma_matrices.cache_clear()
+
+    with pytest.warns(UserWarning, match="cannot be loaded"):
+        gammas = reconstruction.make_gamma_matrices(15)
+    for gamma, ref in zip(gammas, expected):
+        assert abs(gamma - ref).max() == 0
+    # The cache was rewritten, and no temporary file is left behind
+    reconstruction._cached_gamma_matrices.cache_clear()
+    assert abs(reconstruction.make_gamma_matrices(15)[0] - expected[0]).max() == 0
+    assert sorted(os.listdir(gamma_cache)) == ["gammax_15.npz", "gammay_15.npz"]
+
+def polar(points):
+    xx, yy = points.T
+    return np.column_stack([np.sqrt(xx**2 + yy**2), np.arctan2(yy, xx)])
+
+def pupil_points(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    r = np.sqrt(rng.uniform(0, 0.9, n))
+    t = rng.uniform(-np.pi, np.pi, n)
+    return np.column_stack([r * np.cos(t), r * np.sin(t)])
+
+def test_basis_matches_single_modes():
+    rho, theta = polar(pupil_points()).T
+    basis = reconstruction.zernike_basis(45, rho, theta)
+    for j in range(1, 46):
+        np.testing.assert_allclose(basis[j - 1], reconstruction.noll_zernike_j(j, rho, theta),
+                                   rtol=1e-10, atol=1e-12)
+
+def test_cartesian_wavefront_matches_sum_of_modes():
+    # Includes points outside the aperture, which are masked
+    pts = np.concatenate([pupil_points(), [[1.2, 0.3], [-0.9, 0.9]]])
+    a_j = np.random.default_rng(1).normal(size=21)
+    rho, theta = polar(pts).T
+    expected = sum(a * reconstruction.noll_zernike_j(j, rho, theta)
+                   for j, a in enumerate(a_j, 1))
+    expected[(pts**2).sum(axis=1) > 1.1] = 0
+    # Twice, the second time from the cached basis
+    for _ in range(2):
+        np.testing.assert_allclose(reconstruction.generate_zernike_wavefront_cartesian(a_j, pts),
+                                   expected, atol=1e-12)
+
+def test_gamma_matrices_match_pairwise_rules():
+    n_modes = 28
+    gammax, gammay = reconstruction.make_gamma_matrices(n_modes)
+    ref = np.zeros((2, n_modes, n_modes))
+    for j in range(1, n_modes + 1):
+        for j1 in range(1, j + 1):
+            m, n = reconstruction.noll_zernike_index(j)
+            m1, n1 = reconstruction.noll_zernike_index(j1)
+            if abs(abs(m1) - abs(m)) == 1:
+                ref[:, j - 1, j1 - 1] = reconstruction._gamma_element(j, j1, abs(m), n,
+                                                                      abs(m1), n1)
+    np.testing.assert_array_equal(gammax.toarray(), ref[0])
+    np.testing.assert_array_equal(gammay.toarray(), ref[1])
+
+def test_derivative_basis_matches_single_modes():
+    pts = pupil_points(30)
+    gammax, gammay = reconstruction.make_gamma_matrices(15)
+    dervx, dervy = reconstruction.derivative_basis(gammax, gammay, pts)
+    for j in range(1, 16):
+        dx, dy = reconstruction.zernike_derv(j, gammax, gammay, pts)
+        np.testing.assert_allclose(dervx[j - 1], dx, atol=1e-12)
+        np.testing.assert_allclose(dervy[j - 1], dy, atol=1e-12)
+
+def test_theoretical_imat_is_unchanged(tmp_path):
+    from config import _make_spot_positions
+    from conftest import REPO_DIR
+    # data/imat.npy was made by the original per-mode implementation
+    A = reconstruction.make_theoretical_imat(np.array(_make_spot_positions(45)), 4, 7, 1, 1,
+                                             fname=str(tmp_path / "imat.npy"))
+    np.testing.assert_allclose(A, np.load(os.path.join(REPO_DIR, "data", "imat.npy")),
+                               atol=1e-12)
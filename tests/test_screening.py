@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from screening import RC_JUMP, FrameScreen
+
+def jump_sequence(recon, n_frames=40):
+    rng = np.random.default_rng(0)
+    coords = np.array(recon.cal_slopes) + rng.normal(0, 0.3, (n_frames, 2 * recon.n_spots))
+    coords[10:20] += 15
+    # A swapped frame and a frame with a missing spot
+    coords[30] = coords[30].reshape(-1, 2)[[1, 0, 2, 3]].ravel()
+    coords[33, 0] = np.nan
+    return coords
+
+def screen_one_by_one(screen, coords):
+    frames = [screen.screen_frame(c) for c in coords]
+    return np.array([rc for rc, _ in frames]), np.array([c for _, c in frames])
+
+@pytest.mark.parametrize("max_residual", [None, 2.0])
+@pytest.mark.parametrize("split", [None, 5, 13])
+def test_batch_matches_single_frames(recon, max_residual, split):
+    coords = jump_sequence(recon)
+    batch = FrameScreen(recon, max_residual=max_residual, max_jump=3.0)
+    if split is None:
+        rc, out = batch.screen(coords)
+    else:
+        parts = [batch.screen(part) for part in np.array_split(coords, split)]
+        rc = np.concatenate([p[0] for p in parts])
+        out = np.concatenate([p[1] for p in parts])
+
+    single = FrameScreen(recon, max_residual=max_residual, max_jump=3.0)
+    rc_single, out_single = screen_one_by_one(single, coords)
+    np.testing.assert_array_equal(rc, rc_single)
+    np.testing.assert_array_equal(out, out_single)
+    assert batch.n_repaired == single.n_repaired
+
+def test_sustained_move_becomes_history(recon):
+    coords = jump_sequence(recon)
+    rc, _ = FrameScreen(recon, max_jump=3.0).screen(coords)
+    # The first `history` frames after the move are rejected, then accepted
+    assert (rc[10:18] == RC_JUMP).all()
+    assert (rc[18:20] == 0).all()
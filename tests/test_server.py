@@ -0,0 +1,86 @@
+import asyncio
+import numpy as np
+from server import ReconstructionServer, StreamState
+
+def test_failed_batch_answers_every_frame(recon, monkeypatch):
+    import server as server_module
+
+    def fail(*args, **kwargs):
+        raise MemoryError("test")
+    monkeypatch.setattr(server_module, "reconstruct_batch", fail)
+    server = ReconstructionServer(recon)
+    coords = np.array(recon.cal_slopes, dtype=float)
+
+    async def run():
+        return await asyncio.wait_for(
+            asyncio.gather(*(server.handle_coords(coords) for _ in range(3))), 5)
+    for rc, _ in asyncio.run(run()):
+        assert rc == 9
+
+def test_loading_a_sensor_does_not_block_the_others(recon, monkeypatch):
+    import time
+    import registry as registry_module
+    from registry import ReconstructorRegistry
+
+    def slow_build(**config):
+        time.sleep(0.5)
+        return recon
+    monkeypatch.setattr(registry_module, "ZernikeReconstructor", slow_build)
+    server = ReconstructionServer(registry=ReconstructorRegistry({"slow": {"sensor_id": 1}},
+                                                                 default=recon))
+    coords = np.array(recon.cal_slopes, dtype=float)
+    done = []
+
+    async def frame(sensor):
+        rc, _ = await server.handle_coords(coords, sensor=sensor)
+        done.append((sensor, rc))
+
+    async def run():
+        await asyncio.gather(frame("slow"), frame(None))
+    asyncio.run(run())
+    assert done == [(None, 0), ("slow", 0)]
+
+def serve_bytes(server, data):
+    """Sends data on a loopback connection, closes it and returns the reply."""
+    async def run():
+        listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        writer.write_eof()
+        reply = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        listener.close()
+        return reply.decode()
+    return asyncio.run(run())
+
+def test_short_text_messages_are_answered(recon):
+    server = ReconstructionServer(recon)
+    assert serve_bytes(server, b"\n") == ""
+    assert serve_bytes(server, b"x").startswith("RC 5")
+    line = "felixdata 1.0 " + ", ".join(str(x) for x in recon.cal_slopes)
+    reply = serve_bytes(server, b"5\n" + line.encode() + b"\n")
+    assert reply.count("RC ") == 2
+    assert reply.startswith("RC 5")
+    assert "RC 0" in reply
+
+def test_binary_frames_split_after_one_byte(recon):
+    from protocol import REPLY_HEADER, pack_frame, unpack_reply_header
+    server = ReconstructionServer(recon)
+    frame = pack_frame(1.0, np.array(recon.cal_slopes))
+
+    async def run():
+        listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(frame[:1])
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.write(frame[1:])
+        writer.write_eof()
+        reply = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        listener.close()
+        return reply
+    reply = asyncio.run(run())
+    assert unpack_reply_header(reply[:REPLY_HEADER.size])[0] == 0
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pytest
+from conftest import REPO_DIR
+from screening import FrameScreen
+from spots2zern import ZernikeReconstructor, reconstruct, reconstruct_batch, subtract_mean
+
+def frames(recon, n_frames=20):
+    rng = np.random.default_rng(1)
+    coords = np.array(recon.cal_slopes) + rng.normal(0, 0.5, (n_frames, 2 * recon.n_spots))
+    coords[7, 3] = np.nan
+    return coords
+
+def test_kernel_matches_unfused_path(recon):
+    A, s2z, cal = recon.calibration
+    coords = frames(recon)
+    for row in coords:
+        rc, a_z = reconstruct(recon, row)
+        expected = np.dot(s2z, subtract_mean(row) - cal)
+        if np.isnan(expected).any():
+            assert rc == 4
+        else:
+            assert rc == 0
+            np.testing.assert_allclose(a_z, expected, rtol=1e-10, atol=1e-12)
+
+@pytest.mark.parametrize("screened", [False, True])
+def test_batch_matches_single_frames(recon, screened):
+    coords = frames(recon)
+    coords[12:15] += 20
+    single_screen = FrameScreen(recon) if screened else None
+    batch_screen = FrameScreen(recon) if screened else None
+
+    single = [reconstruct(recon, row, screen=single_screen) for row in coords]
+    rc, a_z = reconstruct_batch(recon, coords, screen=batch_screen)
+
+    np.testing.assert_array_equal(rc, [r for r, _ in single])
+    assert 4 in rc
+    for k, (r, row) in enumerate(single):
+        if r == 0:
+            np.testing.assert_allclose(a_z[k], row, rtol=1e-10, atol=1e-12)
+        elif r != 4:
+            assert not a_z[k].any() and not row.any()
+
+def test_float32_kernel_is_close_to_float64(recon):
+    recon32 = ZernikeReconstructor(os.path.join(REPO_DIR, "data", "imat.npy"), dtype="float32")
+    coords = frames(recon)
+    coords[7] = recon.cal_slopes
+    rc64, a_z64 = reconstruct_batch(recon, coords)
+    rc32, a_z32 = reconstruct_batch(recon32, coords)
+    assert a_z32.dtype == np.float32
+    np.testing.assert_array_equal(rc32, rc64)
+    np.testing.assert_allclose(a_z32, a_z64, rtol=1e-4, atol=1e-4)
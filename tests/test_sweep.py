@@ -0,0 +1,30 @@
+import glob
+import os
+import numpy as np
+import pytest
+import sweep
+from config import _make_spot_positions
+from spots2zern import ZernikeReconstructor
+
+@pytest.mark.parametrize("method", ["svd", "qr", "zonal"])
+def test_primed_s2z_is_used_by_the_reconstructor(tmp_path, monkeypatch, capsys, method):
+    monkeypatch.setattr(ZernikeReconstructor, "s2z_method", method)
+    rng = np.random.default_rng(0)
+    monkeypatch.setattr(sweep, "load_slopes", lambda patterns: rng.normal(size=(50, 8)))
+    imat_out = str(tmp_path / "imat_sweep.npy")
+    layouts = {"default": np.array(_make_spot_positions(0))}
+    sweep.main([], layouts, [0., 30., 45.], [1.], [1, -1], str(tmp_path / "sweep.npz"),
+               imat_out, n_workers=1)
+    printed = capsys.readouterr().out
+    settings = dict(line.strip().split(" = ") for line in printed.splitlines()
+                    if line.startswith("    "))
+    assert set(settings) == {"IMAT_FNAME", "ROTATION_ANGLE", "SCALE", "FLIP"}
+    primed = glob.glob(os.path.join(tmp_path, "s2z_*.npy"))
+    assert len(primed) == 1
+
+    # The reconstructor that config.py would describe hits the primed entry
+    rotation = float(settings["ROTATION_ANGLE"])
+    ZernikeReconstructor(imat_out, rotation_angle=rotation, scale=float(settings["SCALE"]),
+                         flip=int(settings["FLIP"]),
+                         spot_positions=_make_spot_positions(rotation))
+    assert glob.glob(os.path.join(tmp_path, "s2z_*.npy")) == primed
@@ -0,0 +1,225 @@
+"""Temporal filtering and prediction of the Zernike stream.
+
+Each filter holds its per-mode state in preallocated arrays and processes one
+frame of n_modes coefficients at a fixed cost, vectorized across all modes:
+
+    ema        exponential smoothing, a <- a + alpha (z - a)
+    kalman     per-mode Kalman filter with a random-walk model
+    predict    per-mode autoregressive predictor fitted on recent history by
+               exponentially weighted least squares, returning the estimate of
+               the next frame
+
+Filters are described by short specs such as "ema:0.3", "kalman:1e-4,1e-2" or
+"predict:4,0.99", see make_filter.
+"""
+import numpy as np
+from config import *
+
+class ExponentialFilter:
+    """Exponential smoothing of every mode.
+    """
+
+    def __init__(self, n_modes, alpha=0.5):
+        """Initializes the filter.
+
+        Parameters
+        ----------
+        n_modes: int
+            Number of Zernike coefficients per frame.
+        alpha: float or nd_array of shape (n_modes)
+            Weight of the newest frame in (0, 1]. 1 disables smoothing.
+        """
+        self.n_modes = n_modes
+        self.alpha = np.broadcast_to(np.asarray(alpha, dtype=float), (n_modes,)).copy()
+        self.state = np.zeros(n_modes)
+        self.n = 0
+
+    def reset(self):
+        self.state[:] = 0
+        self.n = 0
+
+    def update(self, a_z):
+        """Adds one frame and returns the smoothed coefficients. The returned
+        array is reused by the next update.
+        """
+        if self.n == 0:
+            self.state[:] = a_z
+        else:
+            self.state += self.alpha * (a_z - self.state)
+        self.n += 1
+        return self.state
+
+class KalmanFilter:
+    """Per-mode Kalman filter that models each coefficient as a random walk
+    measured with white noise.
+    """
+
+    def __init__(self, n_modes, process_var=1e-4, meas_var=1e-2):
+        """Initializes the filter.
+
+        Parameters
+        ----------
+        n_modes: int
+            Number of Zernike coefficients per frame.
+        process_var: float or nd_array of shape (n_modes)
+            Variance of the change of a coefficient between frames.
+        meas_var: float or nd_array of shape (n_modes)
+            Variance of the reconstruction noise of a coefficient.
+        """
+        self.n_modes = n_modes
+        self.process_var = np.broadcast_to(np.asarray(process_var, dtype=float), (n_modes,)).copy()
+        self.meas_var = np.broadcast_to(np.asarray(meas_var, dtype=float), (n_modes,)).copy()
+        self.state = np.zeros(n_modes)
+        self.var = np.zeros(n_modes)
+        self._gain = np.zeros(n_modes)
+        self.n = 0
+
+    def reset(self):
+        self.state[:] = 0
+        self.var[:] = 0
+        self.n = 0
+
+    def update(self, a_z):
+        """Adds one frame and returns the filtered coefficients. The returned
+        array is reused by the next update.
+        """
+        if self.n == 0:
+            self.state[:] = a_z
+            self.var[:] = self.meas_var
+        else:
+            self.var += self.process_var
+            np.divide(self.var, self.var + self.meas_var, out=self._gain)
+            self.state += self._gain * (a_z - self.state)
+            self.var *= 1 - self._gain
+        self.n += 1
+        return self.state
+
+class LinearPredictor:
+    """Per-mode autoregressive predictor of the next frame.
+
+    For every mode the last `order` values are kept in a ring, and the
+    coefficients c of a_{k+1} = c . [a_k, ..., a_{k-order+1}] are refitted on
+    every frame by exponentially weighted least squares, so the fit follows the
+    most recent ~1/(1-forgetting) frames. Until the normal equations are
+    well-conditioned the newest frame is returned unchanged.
+    """
+
+    def __init__(self, n_modes, order=4, forgetting=0.99, reg=1e-6):
+        """Initializes the predictor.
+
+        Parameters
+        ----------
+        n_modes: int
+            Number of Zernike coefficients per frame.
+        order: int, optional
+            Number of past frames each prediction uses.
+        forgetting: float, optional
+            Weight of older frames in (0, 1].
+        reg: float, optional
+            Regularization of the normal equations, relative to their trace.
+        """
+        self.n_modes = n_modes
+        self.order = order
+        self.forgetting = forgetting
+        self.reg = reg
+        self._history = np.zeros((n_modes, order))
+        self._R = np.zeros((n_modes, order, order))
+        self._r = np.zeros((n_modes, order))
+        self._eye = np.eye(order)
+        self.coeffs = np.zeros((n_modes, order))
+        self.state = np.zeros(n_modes)
+        self.n = 0
+
+    def reset(self):
+        self._history[:] = 0
+        self._R[:] = 0
+        self._r[:] = 0
+        self.coeffs[:] = 0
+        self.state[:] = 0
+        self.n = 0
+
+    def update(self, a_z):
+        """Adds one frame and returns the predicted coefficients of the next
+        frame. The returned array is reused by the next update.
+        """
+        past = self._history  # [a_{k-1}, ..., a_{k-order}] per mode
+        if self.n >= self.order:
+            # Fit a_k from the frames before it
+            self._R *= self.forgetting
+            self._R += past[:, :, None] * past[:, None, :]
+            self._r *= self.forgetting
+            self._r += past * a_z[:, None]
+
+        # Shift a_k into the history
+        past[:, 1:] = past[:, :-1]
+        past[:, 0] = a_z
+        self.n += 1
+
+        if self.n <= 2 * self.order:
+            self.state[:] = a_z
+            return self.state
+
+        trace = np.trace(self._R, axis1=1, axis2=2)
+        R = self._R + (self.reg * trace / self.order + 1e-300)[:, None, None] * self._eye
+        self.coeffs[:] = np.linalg.solve(R, self._r[:, :, None])[:, :, 0]
+        np.einsum("mk,mk->m", self.coeffs, past, out=self.state)
+        return self.state
+
+FILTERS = {
+    "ema": ExponentialFilter,
+    "kalman": KalmanFilter,
+    "predict": LinearPredictor,
+}
+
+def make_filter(spec, n_modes=N_MODES):
+    """Builds a filter from a spec of the form name[:arg1,arg2,...].
+
+    Examples are "ema:0.3" (alpha), "kalman:1e-4,1e-2" (process and measurement
+    variance) and "predict:4,0.99" (order and forgetting factor). Missing
+    arguments take the defaults of the filter class. "none", "" or None return
+    None.
+
+    Raises
+    ------
+    ValueError
+        If the spec cannot be parsed.
+    """
+    if spec is None or spec.strip().lower() in ("", "none"):
+        return None
+    name, _, args = spec.strip().partition(":")
+    name = name.lower()
+    if name not in FILTERS:
+        raise ValueError(f"unknown filter {name!r}, expected one of {', '.join(FILTERS)}")
+    try:
+        values = [float(arg) for arg in args.split(",")] if args.strip() else []
+    except ValueError:
+        raise ValueError(f"could not parse filter arguments {args!r}")
+    if name == "predict" and values:
+        values[0] = int(values[0])
+    try:
+        return FILTERS[name](n_modes, *values)
+    except TypeError:
+        raise ValueError(f"too many arguments for filter {name!r}")
+
+def filter_batch(zfilter, a_z, rc=None):
+    """Runs a stack of frames through a filter in order.
+
+    Parameters
+    ----------
+    zfilter: filter object
+        See make_filter. Its state carries over between calls.
+    a_z: nd_array of shape (n_frames, n_modes)
+        Reconstructed coefficients.
+    rc: nd_array of shape (n_frames), optional
+        Return codes. Frames with rc != 0 are left as they are and do not
+        update the filter.
+
+    Returns
+    -------
+    out: nd_array of shape (n_frames, n_modes)
+    """
+    out = np.array(a_z, dtype=float)
+    for k in range(len(out)):
+        if rc is None or rc[k] == 0:
+            out[k] = zfilter.update(out[k])
+    return out
@@ -0,0 +1,127 @@
+"""Zonal wavefront reconstruction with Southwell (1980) finite differences.
+
+Neighbouring spots p and q, a grid spacing apart, give one equation
+
+    phi_q - phi_p = d . (s_p + s_q) / 2
+
+where d = r_q - r_p and s are the measured x and y slopes. The spots do not
+have to fill a square; any subset of a (rotated) regular grid works, e.g. the
+subapertures inside a circular pupil. The least-squares phase solves the
+sparse normal equations D^T D phi = D^T G s, whose factorization is computed
+once, so a frame costs two sparse triangular solves.
+
+The phase can be projected onto the Zernike basis. Because every step is
+linear, the slopes to Zernike map can also be collapsed into a dense s2z
+matrix (s2z_matrix), which is what ZernikeReconstructor uses with
+S2Z_METHOD = "zonal".
+"""
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+from scipy.spatial import cKDTree
+from config import *
+from reconstruction import get_pupil_basis, zernike_norm
+
+def southwell_pairs(points, tol=0.05):
+    """Returns the pairs of neighbouring points, i.e. those that are one grid
+    spacing apart. The spacing is the smallest distance between two points.
+
+    Returns
+    -------
+    pairs: nd_array of shape (n_pairs, 2)
+        Indices (p, q) with p < q.
+    """
+    tree = cKDTree(points)
+    dist, _ = tree.query(points, k=2)
+    spacing = dist[:, 1].min()
+    pairs = tree.query_pairs(spacing * (1 + tol), output_type="ndarray")
+    return pairs[np.lexsort(pairs.T[::-1])]
+
+class ZonalReconstructor:
+    """Least-squares phase from slopes on a Southwell grid, see the module
+    docstring.
+    """
+
+    def __init__(self, points, n_modes=N_MODES, scale=SCALE, flip=FLIP, reg=0.0):
+        """Builds and factorizes the finite-difference system.
+
+        Parameters
+        ----------
+        points: nd_array of shape (n_spots, 2)
+            Spot positions on the pupil, on a regular grid. Pupil radius is 1.
+        n_modes: int, optional
+            Number of Zernike modes of zernikes and s2z_matrix, without piston.
+        scale, flip: optional
+            Normalization of the Zernike coefficients, as for the imat.
+        reg: float, optional
+            Tikhonov regularization of the phase, relative to the mean degree
+            of the grid. A small value is always added to fix piston.
+
+        Raises
+        ------
+        ValueError
+            If some spots have no neighbour.
+        """
+        self.points = np.array(points, dtype=float)
+        self.n_spots = len(self.points)
+        self.n_modes = n_modes
+        self.pairs = southwell_pairs(self.points)
+        p, q = self.pairs.T
+        n_eq = len(self.pairs)
+        if np.setdiff1d(np.arange(self.n_spots), self.pairs).size:
+            raise ValueError("every spot needs a neighbour on the grid")
+
+        # D: phase differences, G: averaged slopes along each edge, for slopes
+        # ordered as [x1, ..., xn, y1, ..., yn]
+        rows = np.arange(n_eq)
+        self.D = sparse.csr_matrix((np.r_[-np.ones(n_eq), np.ones(n_eq)],
+                                    (np.r_[rows, rows], np.r_[p, q])),
+                                   shape=(n_eq, self.n_spots))
+        d = (self.points[q] - self.points[p]) / 2
+        self.G = sparse.csr_matrix((np.r_[d[:, 0], d[:, 0], d[:, 1], d[:, 1]],
+                                    (np.tile(rows, 4),
+                                     np.r_[p, q, self.n_spots + p, self.n_spots + q])),
+                                   shape=(n_eq, 2 * self.n_spots))
+
+        DtD = (self.D.T @ self.D).tocsc()
+        eps = (max(reg, 0.0) + 1e-9) * DtD.diagonal().mean()
+        self._lu = splinalg.splu((DtD + eps * sparse.identity(self.n_spots)).tocsc())
+        self._rhs = (self.D.T @ self.G).tocsr()
+
+        # Least-squares Zernike fit of the phase over the spots in the pupil,
+        # in the normalization of the imat
+        basis = get_pupil_basis(self.points, n_modes + 1)
+        Z = basis.basis[:n_modes + 1].T * basis.mask[:, None]
+        proj = np.linalg.pinv(Z)[1:]  # drop piston
+        self.proj = proj / zernike_norm(n_modes, scale, flip)[:, None]
+
+    def phase(self, slopes):
+        """Returns the piston-free phase at every spot.
+
+        Parameters
+        ----------
+        slopes: nd_array of shape (2*n_spots) or (n_frames, 2*n_spots)
+            Slopes formatted as [x1, ..., xn, y1, ..., yn].
+
+        Returns
+        -------
+        out: nd_array of shape (n_spots) or (n_frames, n_spots)
+        """
+        slopes = np.asarray(slopes, dtype=float)
+        phi = self._lu.solve(np.asarray(self._rhs @ slopes.T)).T
+        return phi - phi.mean(axis=-1, keepdims=True)
+
+    def zernikes(self, slopes):
+        """Returns the Zernike coefficients of the phase, without piston.
+        """
+        return np.dot(self.phase(slopes), self.proj.T)
+
+    def s2z_matrix(self):
+        """Returns the dense slopes to Zernike matrix equivalent to zernikes,
+        of shape (n_modes, 2*n_spots).
+        """
+        # proj C (D^T D)^-1 D^T G with C removing the mean, solved for the
+        # n_modes rows of proj rather than the 2*n_spots columns of G
+        proj_c = self.proj.T - self.proj.T.mean(axis=0)
+        phi_t = self._lu.solve(np.ascontiguousarray(proj_c), trans="T")
+        return np.asarray(self._rhs.T @ phi_t).T